@@ -3,38 +3,43 @@
 import datetime
 import errno
 import hashlib
+import heapq
 import logging
+import math
 import os
 import random
 import time
 from collections import defaultdict
 from concurrent.futures import CancelledError, TimeoutError
 from contextlib import AbstractContextManager
-from io import StringIO, BytesIO
+from functools import partial
+from io import StringIO, BytesIO, TextIOWrapper
+from itertools import islice
 from typing import List, Tuple, TextIO, Optional, Set, Dict, cast, Union, \
-    Sequence, Any, Iterator
+    Sequence, Any, BinaryIO, Callable, Iterable, Iterator
 
 from diskcache import Cache
+from sparsebitfield import SparseBitfield
 
 from benji.blockuidhistory import BlockUidHistory
 from benji.config import Config
+from benji.dedupindex import DedupIndex
 from benji.database import Database, VersionUid, Version, Block, \
-    BlockUid, DereferencedBlock, VersionStatus, Storage, Locking, DeletedBlock, SparseBlockUid
+    BlockUid, DereferencedBlock, VersionStatus, Storage, Locking, BlockReference, SparseBlockUid, MetadataFormat, \
+    SparseBlockRun
 from benji.exception import InputDataError, InternalError, AlreadyLocked, UsageError, ScrubbingError, ConfigurationError
 from benji.io.factory import IOFactory
+from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 from benji.repr import ReprMixIn
 from benji.retentionfilter import RetentionFilter
-from benji.storage.base import InvalidBlockException, BlockNotFoundError
+from benji.storage.base import InvalidBlockException, BlockNotFoundError, StorageBase
 from benji.storage.factory import StorageFactory
 from benji.utils import BlockHash, PrettyPrint, random_string, InputValidation, ProgressReporting
 
 
 class Benji(ReprMixIn, AbstractContextManager):
 
-    # This is in number of blocks (i.e. database rows in the blocks table)
-    _BLOCKS_CREATE_WORK_PACKAGE = 10000
-
     def __init__(self,
                  config: Config,
                  init_database: bool = False,
@@ -47,6 +52,12 @@ class Benji(ReprMixIn, AbstractContextManager):
         self._block_size = config.get('blockSize', types=int)
         self._block_hash = BlockHash(config.get('hashFunction', types=str))
         self._progress = ProgressReporting(config.get('processName', types=str))
+        self._simultaneous_hashes = config.get('simultaneousHashes', types=int)
+        self._compact_block_maps = config.get('compactBlockMaps', types=bool)
+        self._metadata_backup_format = MetadataFormat[config.get('metadataBackup.format', types=str)]
+        self._metadata_backup_compress = config.get('metadataBackup.compression', types=str) == 'zstd'
+        self._metadata_backup_delta_chain_length = config.get('metadataBackup.deltaChainLength', types=int)
+        self._metadata_backup_simultaneous_writes = config.get('metadataBackup.simultaneousWrites', types=int)
 
         Database.configure(config, in_memory=in_memory_database)
         if init_database or in_memory_database:
@@ -86,7 +97,7 @@ class Benji(ReprMixIn, AbstractContextManager):
         else:
             new_storage = Storage.get_by_name(self._default_storage_name)
 
-        old_blocks_iter: Optional[Iterator[Block]] = None
+        old_version: Optional[Version] = None
         if base_version_uid:
             if not base_version_locking and not Locking.is_version_locked(base_version_uid):
                 raise InternalError('Base version is not locked.')
@@ -98,9 +109,6 @@ class Benji(ReprMixIn, AbstractContextManager):
             if old_version.storage != new_storage:
                 raise UsageError(f'Base version and new version have to be in the same storage ({old_version.storage.name} != {new_storage.name}).')
 
-            base_version = Version.get_by_uid(base_version_uid)
-            old_blocks_iter = base_version.blocks
-
             if size is not None:
                 new_size = size
             else:
@@ -127,69 +135,13 @@ class Benji(ReprMixIn, AbstractContextManager):
                                      size=new_size,
                                      block_size=new_version_block_size,
                                      storage_id=new_storage.id,
-                                     status=VersionStatus.incomplete)
+                                     status=VersionStatus.incomplete,
+                                     compact_block_map=self._compact_block_maps)
             Locking.lock_version(version.uid, reason='Preparing version')
 
-            new_block_uid: Optional[BlockUid]
-            new_block_checksum: Optional[str]
-            new_block_block_size: int
-            new_block_valid: bool
-            blocks: List[Dict[str, Any]] = []
-            old_version_exhausted = old_blocks_iter is None
-            for idx in range(version.blocks_count):
-                if not old_version_exhausted:
-                    assert old_blocks_iter is not None
-                    old_block = next(old_blocks_iter, None)
-                    if old_block is not None:
-                        assert old_block.idx == idx
-                        new_block_uid = old_block.uid
-                        new_block_checksum = old_block.checksum
-                        new_block_block_size = old_block.size
-                        new_block_valid = old_block.valid
-                    else:
-                        old_version_exhausted = True
-                        new_block_uid = None
-                        new_block_checksum = None
-                        new_block_block_size = version.block_size
-                        new_block_valid = True
-                else:
-                    new_block_uid = None
-                    new_block_checksum = None
-                    new_block_block_size = version.block_size
-                    new_block_valid = True
-
-                # This catches blocks which changed their size between the base version and the new version.
-                # If the new version is bigger, this affects the last block of the old version and the last block of
-                # the new version.
-                # If the new version is smaller, this affects the last block of the new version.
-                offset = idx * version.block_size
-                new_block_block_size_tmp = min(version.block_size, new_size - offset)
-                if new_block_block_size != new_block_block_size_tmp:
-                    new_block_block_size = new_block_block_size_tmp
-                    new_block_uid = None
-                    new_block_checksum = None
-                    # Forces reread.
-                    new_block_valid = False
-
-                blocks.append({
-                    'idx': idx,
-                    'uid_left': new_block_uid.left if new_block_uid is not None else None,
-                    'uid_right': new_block_uid.right if new_block_uid is not None else None,
-                    'checksum': new_block_checksum,
-                    'size': new_block_block_size,
-                    'valid': new_block_valid
-                })
-
-                self._progress.task_with_blocks('Creating from base version' if base_version_uid else 'Creating version',
-                                                version_uid=version.uid,
-                                                blocks_done=idx + 1,
-                                                blocks_count=version.blocks_count,
-                                                per_thousand=5)
-
-                if len(blocks) == self._BLOCKS_CREATE_WORK_PACKAGE:
-                    version.create_blocks(blocks=blocks)
-                    blocks = []
-            version.create_blocks(blocks=blocks)
+            self._progress.task_with_version('Creating from base version' if base_version_uid else 'Creating version',
+                                             version_uid=version.uid)
+            version.initialize_blocks(base_version=old_version)
         except:
             if version and Locking.is_version_locked(version.uid):
                 Locking.unlock_version(version.uid)
@@ -219,11 +171,18 @@ class Benji(ReprMixIn, AbstractContextManager):
         action = 'deep-scrub' if deep_scrub else 'scrub'
         storage = StorageFactory.get_by_name(version.storage.name)
         read_jobs = 0
-        for idx, block in enumerate(version.blocks):
+        blocks_count = version.blocks_count
+        for block in version.block_runs():
+            if isinstance(block, SparseBlockRun):
+                if log_debug:
+                    logger.debug('{} of blocks {} to {} of version {} skipped (sparse).'.format(
+                        action.capitalize(), block.idx, block.idx + block.count - 1, version.uid))
+                continue
+
             self._progress.task_with_blocks(f'Preparing {action}',
                                             version_uid=version.uid,
-                                            blocks_done=idx + 1,
-                                            blocks_count=version.blocks_count,
+                                            blocks_done=block.idx + 1,
+                                            blocks_count=blocks_count,
                                             per_thousand=5)
 
             if not block.uid:
@@ -236,8 +195,8 @@ class Benji(ReprMixIn, AbstractContextManager):
                     logger.debug('{} of block {} of version {} (UID {}) skipped (already seen).'.format(
                         action.capitalize(), block.idx, version.uid, block.uid))
                 continue
-            # i != 0 ensures that we always scrub at least one block (the first in this case)
-            if idx != 0 and block_percentage < 100 and random.randint(1, 100) > block_percentage:
+            # block.idx != 0 ensures that we always scrub at least one block (the first in this case)
+            if block.idx != 0 and block_percentage < 100 and random.randint(1, 100) > block_percentage:
                 if log_debug:
                     logger.debug('{} of block {} of version {} (UID {}) skipped (percentile is {}).'.format(
                         action.capitalize(), block.idx, version.uid, block.uid, block_percentage))
@@ -543,34 +502,79 @@ class Benji(ReprMixIn, AbstractContextManager):
         return self._batch_scrub('deep_scrub', filter_expression, version_percentage, block_percentage, group_label)
 
     def restore(self, version_uid: VersionUid, target: str, sparse: bool = False, force: bool = False) -> None:
-        block: Union[DereferencedBlock, Block]
-
         Locking.lock_version(version_uid, reason='Restoring version')
         try:
             version = Version.get_by_uid(version_uid)  # raises if version not exists
-            self._progress.task_with_version('Opening target for write', version_uid=version_uid)
-
             self._storage = version.storage_id
 
-            io = IOFactory.get(target, version.block_size)
-            io.open_w(version.size, force=force, sparse=sparse)
-        except:
+            sparse_blocks_count = version.sparse_blocks_count
+            self._restore(version_uid=version_uid,
+                          blocks=version.block_runs(),
+                          size=version.size,
+                          block_size=version.block_size,
+                          storage_name=version.storage.name,
+                          target=target,
+                          sparse=sparse,
+                          force=force,
+                          read_blocks_count=version.blocks_count - sparse_blocks_count,
+                          sparse_blocks_count=sparse_blocks_count,
+                          invalidate_block=lambda block_uid: Version.set_block_valid(block_uid, False))
+        finally:
             Locking.unlock_version(version_uid)
-            raise
+
+    def restore_from_metadata_backup(self,
+                                     version_uid: VersionUid,
+                                     target: str,
+                                     sparse: bool = False,
+                                     force: bool = False,
+                                     storage_name: str = None) -> None:
+        """ Restores a version straight from its metadata backup. The metadata backup is read incrementally and the
+        blocks are queued for reading as they are decoded. The version is never imported into the database, so
+        invalid blocks are only logged.
+        """
+        storage = StorageFactory.get_by_name(storage_name or self._default_storage_name)
+        version_dict, blocks = self._read_metadata_backup(storage, version_uid)
+
+        # The number of sparse blocks is unknown beforehand, all counts are upper bounds
+        blocks_count = math.ceil(version_dict['size'] / version_dict['block_size'])
+        self._restore(version_uid=version_uid,
+                      blocks=blocks,
+                      size=version_dict['size'],
+                      block_size=version_dict['block_size'],
+                      storage_name=version_dict['storage'],
+                      target=target,
+                      sparse=sparse,
+                      force=force,
+                      read_blocks_count=blocks_count,
+                      sparse_blocks_count=blocks_count,
+                      invalidate_block=None)
+
+    def _restore(self, *, version_uid: VersionUid, blocks: Iterable[Union[Block, DereferencedBlock, SparseBlockRun]],
+                 size: int, block_size: int, storage_name: str, target: str, sparse: bool, force: bool,
+                 read_blocks_count: int, sparse_blocks_count: int,
+                 invalidate_block: Optional[Callable[[BlockUid], None]]) -> None:
+        block: Union[DereferencedBlock, Block]
+
+        self._progress.task_with_version('Opening target for write', version_uid=version_uid)
+        io = IOFactory.get(target, block_size)
+        io.open_w(size, force=force, sparse=sparse)
 
         try:
             t1 = time.time()
-            storage = StorageFactory.get_by_name(version.storage.name)
-
-            sparse_blocks_count = version.sparse_blocks_count
-            read_blocks_count = version.blocks_count - sparse_blocks_count
+            storage = StorageFactory.get_by_name(storage_name)
 
             read_jobs = 0
             write_jobs = 0
             done_write_jobs = 0
+            zeroed_blocks = 0
+            # UIDs whose read has been queued, blocks sharing one of these UIDs are written from the same read.
+            # Only UIDs which actually repeat get an entry in duplicate_blocks.
+            queued_uids: Set[BlockUid] = set()
+            duplicate_blocks: Dict[BlockUid, List[DereferencedBlock]] = {}
+            duplicate_blocks_count = 0
             written = 0
             log_debug = logger.isEnabledFor(logging.DEBUG)
-            sparse_data_block = b'\0' * version.block_size
+            sparse_data_block = b'\0' * block_size
 
             def handle_sparse_write_completed(timeout: int = None):
                 nonlocal done_write_jobs, written, sparse_blocks_count, version_uid, target
@@ -584,23 +588,53 @@ class Benji(ReprMixIn, AbstractContextManager):
 
                         self._progress.task_with_blocks('Writing sparse blocks',
                                                         version_uid=version_uid,
-                                                        blocks_done=done_write_jobs,
+                                                        blocks_done=done_write_jobs + zeroed_blocks,
                                                         blocks_count=sparse_blocks_count,
                                                         per_thousand=5)
 
                 except (TimeoutError, CancelledError):
                     pass
 
-            for block in version.blocks:
+            for block in blocks:
+                if isinstance(block, SparseBlockRun):
+                    if not sparse and io.write_zeroes(block.idx * block_size, block.count * block_size):
+                        # The whole run has been zeroed at once (discarded or hole punched)
+                        zeroed_blocks += block.count
+                        written += block.count * block_size
+                        if log_debug:
+                            logger.debug('Zeroed sparse blocks {} to {} successfully.'.format(
+                                block.idx, block.idx + block.count - 1))
+                    elif not sparse:
+                        for idx in range(block.idx, block.idx + block.count):
+                            io.write(DereferencedBlock(SparseBlockUid, 0, idx, None, block_size, True),
+                                     sparse_data_block)
+                            write_jobs += 1
+                            handle_sparse_write_completed(timeout=0)
+                        if log_debug:
+                            logger.debug('Queued writes for sparse blocks {} to {} successfully.'.format(
+                                block.idx, block.idx + block.count - 1))
+                    elif log_debug:
+                        logger.debug('Ignored sparse blocks {} to {}.'.format(block.idx, block.idx + block.count - 1))
+                    continue
+
                 if block.uid:
-                    storage.read_block_async(block)
-                    read_jobs += 1
-                    if log_debug:
-                        logger.debug('Queued read for block {} successfully ({} bytes).'.format(block.idx, block.size))
+                    if block.uid in queued_uids:
+                        duplicate_blocks.setdefault(block.uid, []).append(block.deref())
+                        duplicate_blocks_count += 1
+                        if log_debug:
+                            logger.debug('Block {} shares UID {} with a block already queued for read.'.format(
+                                block.idx, block.uid))
+                    else:
+                        storage.read_block_async(block)
+                        queued_uids.add(block.uid)
+                        read_jobs += 1
+                        if log_debug:
+                            logger.debug('Queued read for block {} successfully ({} bytes).'.format(
+                                block.idx, block.size))
 
                     self._progress.task_with_blocks('Queueing blocks for read from storage',
                                                     version_uid=version_uid,
-                                                    blocks_done=read_jobs,
+                                                    blocks_done=read_jobs + duplicate_blocks_count,
                                                     blocks_count=read_blocks_count,
                                                     per_thousand=5)
                 elif not sparse:
@@ -615,6 +649,8 @@ class Benji(ReprMixIn, AbstractContextManager):
                 if not sparse:
                     handle_sparse_write_completed(timeout=0)
 
+            # All reads have been queued, only the repeating UIDs are needed from here on
+            queued_uids.clear()
             handle_sparse_write_completed()
 
             if write_jobs != done_write_jobs:
@@ -627,7 +663,7 @@ class Benji(ReprMixIn, AbstractContextManager):
             done_write_jobs = 0
 
             def handle_write_completed(timeout: int = None):
-                nonlocal done_write_jobs, written, read_jobs, version_uid, target
+                nonlocal done_write_jobs, written, read_jobs, duplicate_blocks_count, version_uid, target
                 try:
                     for written_block in io.write_get_completed(timeout=timeout):
                         if isinstance(written_block, Exception):
@@ -639,33 +675,43 @@ class Benji(ReprMixIn, AbstractContextManager):
                         self._progress.task_with_blocks('Restoring',
                                                         version_uid=version_uid,
                                                         blocks_done=done_write_jobs,
-                                                        blocks_count=read_jobs,
+                                                        blocks_count=read_jobs + duplicate_blocks_count,
                                                         per_thousand=5)
                 except (TimeoutError, CancelledError):
                     pass
 
+            unrestored_blocks_count = 0
             for entry in storage.read_get_completed():
                 done_read_jobs += 1
                 if isinstance(entry, Exception):
-                    logger.error('Storage backend read failed: {}'.format(entry))
                     # If it really is a data inconsistency mark blocks invalid
-                    if isinstance(entry, (KeyError, ValueError)):
-                        Version.set_block_valid(block.uid, False)
+                    if isinstance(entry, InvalidBlockException):
+                        # None of the blocks referencing this object can be restored
+                        failed_blocks = [entry.block] + duplicate_blocks.pop(entry.block.uid, [])
+                        unrestored_blocks_count += len(failed_blocks)
+                        logger.error('Block UID {} is invalid, block(s) {} have not been restored: {}{}'.format(
+                            entry.block.uid, ', '.join(str(failed_block.idx) for failed_block in failed_blocks), entry,
+                            f' Caused by: {entry.__cause__}' if entry.__cause__ else ''))
+                        if invalidate_block is not None:
+                            invalidate_block(entry.block.uid)
                         continue
                     else:
+                        logger.error('Storage backend read failed: {}'.format(entry))
                         raise entry
                 else:
                     block, data, metadata = cast(Tuple[DereferencedBlock, bytes, Dict], entry)
 
-                # Write what we have
-                io.write(block, data)
-                write_jobs += 1
+                # Write what we have, to all blocks referencing this object
+                for target_block in [block] + duplicate_blocks.pop(block.uid, []):
+                    io.write(target_block, data)
+                    write_jobs += 1
 
                 try:
                     storage.check_block_metadata(block=block, data_length=len(data), metadata=metadata)
                 except (KeyError, ValueError) as exception:
                     logger.error('Metadata check failed, block is invalid: {}'.format(exception))
-                    Version.set_block_valid(block.uid, False)
+                    if invalidate_block is not None:
+                        invalidate_block(block.uid)
                     continue
 
                 data_checksum = self._block_hash.data_hexdigest(data)
@@ -674,7 +720,8 @@ class Benji(ReprMixIn, AbstractContextManager):
                                  'block.valid: {}). Block restored is invalid.'.format(
                                      block.idx, block.uid, data_checksum[:16],
                                      cast(str, block.checksum)[:16], block.valid))  # We know that block.checksum is set
-                    Version.set_block_valid(block.uid, False)
+                    if invalidate_block is not None:
+                        invalidate_block(block.uid)
                 elif log_debug:
                     logger.debug('Restored block {} successfully ({} bytes).'.format(block.idx, block.size))
 
@@ -684,7 +731,6 @@ class Benji(ReprMixIn, AbstractContextManager):
         finally:
             io.close()
             t2 = time.time()
-            Locking.unlock_version(version_uid)
             self._progress.reset()
 
         if read_jobs != done_read_jobs:
@@ -697,16 +743,20 @@ class Benji(ReprMixIn, AbstractContextManager):
                 'Number of submitted and completed write jobs inconsistent (submitted: {}, completed {}).'.format(
                     write_jobs, done_write_jobs))
 
+        if unrestored_blocks_count > 0:
+            raise InputDataError('Restore of version {} is incomplete, {} block(s) could not be restored.'.format(
+                version_uid, unrestored_blocks_count))
+
         logger.info('Successfully restored version {} in {} with {}/s.'.format(
-            version.uid, PrettyPrint.duration(max(int(t2 - t1), 1)), PrettyPrint.bytes(written / (t2 - t1))))
+            version_uid, PrettyPrint.duration(max(int(t2 - t1), 1)), PrettyPrint.bytes(written / (t2 - t1))))
 
     @staticmethod
     def protect(version_uid: VersionUid, protected: bool) -> None:
         version = Version.get_by_uid(version_uid)
         version.set(protected=protected)
 
-    @staticmethod
-    def rm(version_uid: VersionUid,
+    def rm(self,
+           version_uid: VersionUid,
            force: bool = True,
            disallow_rm_when_younger_than_days: int = 0,
            keep_metadata_backup: bool = False,
@@ -726,6 +776,9 @@ class Benji(ReprMixIn, AbstractContextManager):
                     raise PermissionError('Version {} cannot be removed without force, it has status {}.'.format(
                         version_uid, version.status.name))
 
+            if not keep_metadata_backup:
+                self._rebase_metadata_backups(version)
+
             num_blocks = version.remove()
 
             if not keep_metadata_backup:
@@ -740,29 +793,64 @@ class Benji(ReprMixIn, AbstractContextManager):
 
             logger.info('Removed backup version {} with {} blocks.'.format(version_uid, num_blocks))
 
+    def _rebase_metadata_backups(self, version: Version) -> None:
+        """ Replaces all incremental metadata backups based on this version with full metadata backups, so that they
+        remain restorable when the metadata backup of this version is removed.
+        """
+        # Incremental metadata backups might still exist when they have been disabled in the meantime. The base of
+        # each incremental metadata backup is recorded in the database when it is written.
+        for dependent_version in Version.find(metadata_backup_base_uid=version.uid):
+            logger.info('Replacing incremental metadata backup of version {} with a full one.'.format(
+                dependent_version.uid))
+            self.metadata_backup([dependent_version.uid], overwrite=True, locking=False)
+
     @staticmethod
-    def _blocks_from_hints(hints: Sequence[Tuple[int, int, bool]], block_size: int) -> Tuple[Set[int], Set[int]]:
-        sparse_blocks = set()
-        read_blocks = set()
+    def _blocks_from_hints(hints: Sequence[Tuple[int, int, bool]],
+                           block_size: int) -> Tuple[SparseBitfield, SparseBitfield]:
+        sparse_intervals = []
+        read_intervals = []
         for offset, length, exists in hints:
+            if length == 0:
+                continue
             start_block = offset // block_size
             end_block = (offset + length - 1) // block_size
             if exists:
-                for i in range(start_block, end_block + 1):
-                    read_blocks.add(i)
+                read_intervals.append((start_block, end_block + 1))
             else:
                 if offset % block_size > 0:
                     # Start block is only partially sparse, make sure it is read
-                    read_blocks.add(start_block)
+                    read_intervals.append((start_block, start_block + 1))
 
                 if (offset + length) % block_size > 0:
                     # End block is only partially sparse, make sure it is read
-                    read_blocks.add(end_block)
+                    read_intervals.append((end_block, end_block + 1))
+
+                sparse_intervals.append((start_block, end_block + 1))
 
-                for i in range(start_block, end_block + 1):
-                    sparse_blocks.add(i)
+        return Benji._bitfield_from_intervals(sparse_intervals), Benji._bitfield_from_intervals(read_intervals)
 
-        return sparse_blocks, read_blocks
+    @staticmethod
+    def _bitfield_from_intervals(intervals: Iterable[Tuple[int, int]]) -> SparseBitfield:
+        # SparseBitfield.from_intervals doesn't accept empty intervals, these result from empty sources or from
+        # resuming a backup which has already committed all of its blocks.
+        return SparseBitfield.from_intervals([(start, end) for start, end in intervals if start < end])
+
+    @staticmethod
+    def _sample_blocks(blocks: SparseBitfield, count: int, blocks_count: int) -> List[int]:
+        # Draws count distinct random elements from blocks (a subset of range(blocks_count)) without building a list
+        # of all its elements.
+        count = min(count, len(blocks))
+        if len(blocks) * 2 >= blocks_count:
+            # The elements are dense, rejection sampling needs less than two attempts per element on average.
+            sample: Set[int] = set()
+            while len(sample) < count:
+                idx = random.randrange(blocks_count)
+                if idx in blocks:
+                    sample.add(idx)
+            return list(sample)
+        else:
+            ranks = set(random.sample(range(len(blocks)), count))
+            return [idx for rank, idx in enumerate(blocks) if rank in ranks]
 
     def backup(self,
                *,
@@ -773,11 +861,14 @@ class Benji(ReprMixIn, AbstractContextManager):
                hints: List[Tuple[int, int, bool]] = None,
                base_version_uid: VersionUid = None,
                storage_name: str = None,
-               block_size: int = None) -> Version:
+               block_size: int = None,
+               resume: bool = False) -> Version:
         """ Create a backup from source.
         If hints are given, they must be tuples of (offset, length, exists) where offset and length are integers and
         exists is a boolean. In this case only data within hints will be backed up.
         Otherwise, the backup reads source and looks if checksums match with the target.
+        If resume is True, the existing incomplete version version_uid is completed instead. Only the blocks from the
+        first block which hasn't been committed by the earlier backup run onwards and invalid blocks are read.
         """
         log_debug = logger.isEnabledFor(logging.DEBUG)
 
@@ -796,23 +887,44 @@ class Benji(ReprMixIn, AbstractContextManager):
             'start_time': time.time(),
         }
 
-        new_version_block_size = block_size if block_size else self._block_size
+        if resume:
+            if hints is not None or base_version_uid or storage_name or block_size:
+                raise UsageError('Hints, a base version, a storage or a block size can\'t be specified when resuming a backup.')
+            version = Version.get_by_uid(version_uid)  # raise if not exists
+            if version.status != VersionStatus.incomplete:
+                raise UsageError(f'Only incomplete versions can be resumed, version {version_uid} is {version.status.name}.')
+            if version.volume != volume or version.snapshot != snapshot:
+                raise UsageError(f'Version {version_uid} was created from {version.volume}@{version.snapshot}, '
+                                 f'it can\'t be resumed from {volume}@{snapshot}.')
+            new_version_block_size = version.block_size
+        else:
+            new_version_block_size = block_size if block_size else self._block_size
 
         io = IOFactory.get(source, block_size=new_version_block_size)
         io.open_r()
 
         source_size = io.size()
 
-        version = self.create_version(version_uid=version_uid,
-                                      volume=volume,
-                                      snapshot=snapshot,
-                                      size=source_size,
-                                      block_size=new_version_block_size,
-                                      base_version_uid=base_version_uid,
-                                      storage_name=storage_name)
-        Locking.update_version_lock(version.uid, reason='Backing up')
-
-        if hints is not None:
+        if resume:
+            if source_size != version.size:
+                raise InputDataError(f'Source size {source_size} differs from size {version.size} of version {version.uid}.')
+            Locking.lock_version(version.uid, reason='Backing up')
+        else:
+            version = self.create_version(version_uid=version_uid,
+                                          volume=volume,
+                                          snapshot=snapshot,
+                                          size=source_size,
+                                          block_size=new_version_block_size,
+                                          base_version_uid=base_version_uid,
+                                          storage_name=storage_name)
+            Locking.update_version_lock(version.uid, reason='Backing up')
+
+        if resume:
+            # All blocks starting with the first one which hasn't been committed by the earlier backup run are read
+            # again. Invalid blocks are picked up below.
+            sparse_blocks = SparseBitfield()
+            read_blocks = self._bitfield_from_intervals([(version.resume_idx or 0, version.blocks_count)])
+        elif hints is not None:
             if len(hints) > 0:
                 # Sanity check: check hints for validity, i.e. too high offsets, ...
                 max_offset = max(h[0] + h[1] for h in hints)
@@ -823,28 +935,33 @@ class Benji(ReprMixIn, AbstractContextManager):
             else:
                 # Two snapshots can be completely identical between one backup and the next.
                 logger.warning('Hints are empty, assuming nothing has changed.')
-                sparse_blocks = set()
-                read_blocks = set()
+                sparse_blocks = SparseBitfield()
+                read_blocks = SparseBitfield()
         else:
-            sparse_blocks = set()
-            read_blocks = set(range(version.blocks_count))
+            sparse_blocks = SparseBitfield()
+            read_blocks = self._bitfield_from_intervals([(0, version.blocks_count)])
 
-        if base_version_uid and hints is not None:
+        if (base_version_uid and hints is not None) or resume:
             # SANITY CHECK:
             # Check some blocks outside of hints if they are the same in the
             # base_version backup and in the current backup. If they
             # aren't, either hints are wrong (e.g. from a wrong snapshot diff)
             # or source doesn't match. In any case, the resulting backup won't
-            # be good.
-            self._progress.task_with_version('Sanity checking hints', version_uid=version.uid)
-
-            ignored_blocks = sorted(set(range(version.blocks_count)) - read_blocks - sparse_blocks)
+            # be good. When resuming a backup the blocks already committed
+            # are checked, this makes sure that the source is still the same.
+            self._progress.task_with_version('Sanity checking source' if resume else 'Sanity checking hints',
+                                             version_uid=version.uid)
+
+            ignored_blocks = self._bitfield_from_intervals([(0, version.blocks_count)]) - read_blocks - sparse_blocks
+            if resume:
+                ignored_blocks = ignored_blocks - SparseBitfield(version.invalid_blocks_by_idx())
             # 0.1% but at least ten. If there are less than ten blocks check them all.
             check_blocks_count = max(min(len(ignored_blocks), 10), len(ignored_blocks) // 1000)
             # 50% from the start
-            check_blocks = set(ignored_blocks[:check_blocks_count // 2])
+            check_blocks = SparseBitfield(islice(ignored_blocks, check_blocks_count // 2))
             # and 50% from random locations
-            check_blocks = check_blocks.union(random.sample(ignored_blocks, check_blocks_count // 2))
+            check_blocks.update(
+                SparseBitfield(self._sample_blocks(ignored_blocks, check_blocks_count // 2, version.blocks_count)))
             read_jobs = 0
             for block in [version.get_block_by_idx(idx) for idx in check_blocks]:
                 if block.uid and block.valid:  # no uid = sparse block in backup. Can't check.
@@ -860,22 +977,55 @@ class Benji(ReprMixIn, AbstractContextManager):
                 # check metadata checksum with the newly read one
                 source_data_checksum = self._block_hash.data_hexdigest(source_data)
                 if source_block.checksum != source_data_checksum:
-                    logger.error("Source and backup don't match in regions outside of the ones indicated by the hints.")
-                    logger.error("Looks like the hints don't match or the source is different.")
                     logger.error("Found wrong source data at block {}: offset {}, length {}".format(
                         source_block.idx, source_block.idx * version.block_size, version.block_size))
+                    if resume:
+                        # Keep the version, it can still be resumed from the right source.
+                        Locking.unlock_version(version.uid)
+                        raise InputDataError('Source is different from the one the backup was started with.')
+                    logger.error("Source and backup don't match in regions outside of the ones indicated by the hints.")
+                    logger.error("Looks like the hints don't match or the source is different.")
                     # remove version
                     version.remove()
                     Locking.unlock_version(version.uid)
                     raise InputDataError('Source changed in regions outside of ones indicated by the hints.')
             logger.info('Finished sanity check. Checked {} blocks.'.format(read_jobs))
 
-        logger.info(f'Starting backup of {io.sanitized_url} to storage {version.storage.name}, the newly created version is {version.uid}.')
+        if resume:
+            logger.info(f'Resuming backup of {io.sanitized_url} to storage {version.storage.name}, the resumed version is {version.uid}.')
+        else:
+            logger.info(f'Starting backup of {io.sanitized_url} to storage {version.storage.name}, the newly created version is {version.uid}.')
+        block_writer = version.block_writer()
+        hash_executor = JobExecutor(name='Backup-Hash', workers=self._simultaneous_hashes, blocking_submit=True)
         try:
             storage = StorageFactory.get_by_name(version.storage.name)
+            dedup_index = DedupIndex.create(config=self.config, version=version)
+            invalid_blocks = SparseBitfield(version.invalid_blocks_by_idx())
+            # Only blocks which are hinted or invalid need to be considered, all other blocks are kept as they are.
+            candidate_blocks = read_blocks | sparse_blocks | invalid_blocks
+            candidate_blocks_count = len(candidate_blocks)
+
+            # The first candidate which hasn't been passed to the block writer yet is recorded together with the
+            # block updates, an interrupted backup is resumed from there. Candidates finish roughly in order, so
+            # only the few finished out of order need to be remembered.
+            resume_candidates = iter(candidate_blocks)
+            resume_idx = next(resume_candidates, version.blocks_count)
+            finished_candidates: Set[int] = set()
+
+            def candidate_finished(idx: int) -> None:
+                nonlocal resume_idx
+                finished_candidates.add(idx)
+                if idx == resume_idx:
+                    while resume_idx in finished_candidates:
+                        finished_candidates.remove(resume_idx)
+                        resume_idx = next(resume_candidates, version.blocks_count)
+                    block_writer.set_resume_idx(resume_idx)
+
+            if log_debug:
+                logger.debug('Keeping {} blocks.'.format(version.blocks_count - candidate_blocks_count))
             read_jobs = 0
-            for block in version.blocks:
-                if block.idx in read_blocks or not block.valid:
+            for candidate_blocks_done, block in enumerate(version.blocks_by_idx(candidate_blocks), start=1):
+                if block.idx in read_blocks or block.idx in invalid_blocks:
                     io.read(block)
                     read_jobs += 1
                 elif block.idx in sparse_blocks:
@@ -884,27 +1034,24 @@ class Benji(ReprMixIn, AbstractContextManager):
 
                     # Only update the database when the block wasn't sparse to begin with
                     if block.uid:
-                        version.set_block(idx=block.idx,
-                                          block_uid=SparseBlockUid,
-                                          checksum=None,
-                                          size=block.size,
-                                          valid=True)
+                        block_writer.set_block(idx=block.idx,
+                                               block_uid=SparseBlockUid,
+                                               checksum=None,
+                                               size=block.size,
+                                               valid=True)
                         if log_debug:
                             logger.debug('Skipping block (had data, turned sparse) {}'.format(block.idx))
                     else:
                         assert block.checksum is None
                         if log_debug:
                             logger.debug('Skipping block (sparse) {}'.format(block.idx))
+                    candidate_finished(block.idx)
                     stats['bytes_sparse'] += block.size
 
-                elif log_debug:
-                    # Block is already in database, no need to update it
-                    logger.debug('Keeping block {}'.format(block.idx))
-
                 self._progress.task_with_blocks('Considering blocks for read from source',
                                                 version_uid=version.uid,
-                                                blocks_done=block.idx + 1,
-                                                blocks_count=version.blocks_count,
+                                                blocks_done=candidate_blocks_done,
+                                                blocks_count=candidate_blocks_count,
                                                 per_thousand=5)
 
             # Precompute checksum of a sparse block.
@@ -924,16 +1071,81 @@ class Benji(ReprMixIn, AbstractContextManager):
                         written_block = cast(DereferencedBlock, written_block)
 
                         assert written_block.version_id == version.id
-                        version.set_block(idx=written_block.idx,
-                                          block_uid=written_block.uid,
-                                          checksum=written_block.checksum,
-                                          size=written_block.size,
-                                          valid=True)
+                        block_writer.set_block(idx=written_block.idx,
+                                               block_uid=written_block.uid,
+                                               checksum=written_block.checksum,
+                                               size=written_block.size,
+                                               valid=True)
+                        candidate_finished(written_block.idx)
+                        dedup_index.add(written_block.checksum, written_block.uid, written_block.size)
                         done_write_jobs += 1
                         stats['bytes_written'] += written_block.size
                 except (TimeoutError, CancelledError):
                     pass
 
+            def hash_job(block: DereferencedBlock, data: bytes) -> Tuple[DereferencedBlock, bytes, str]:
+                return block, data, self._block_hash.data_hexdigest(data)
+
+            def handle_hash_completed(timeout: int = None):
+                nonlocal done_read_jobs, write_jobs
+                try:
+                    for entry in hash_executor.get_completed(timeout=timeout):
+                        if isinstance(entry, Exception):
+                            raise entry
+
+                        block, data, data_checksum = cast(Tuple[DereferencedBlock, bytes, str], entry)
+                        if data_checksum == sparse_block_checksum and block.size == version.block_size:
+                            # It's a sparse block.
+                            stats['bytes_sparse'] += block.size
+                            if log_debug:
+                                logger.debug('Skipping block (detected sparse) {}'.format(block.idx))
+                            block_writer.set_block(idx=block.idx,
+                                                   block_uid=SparseBlockUid,
+                                                   checksum=None,
+                                                   size=block.size,
+                                                   valid=True)
+                            candidate_finished(block.idx)
+                        else:
+                            existing_block = dedup_index.lookup(data_checksum)
+                            if existing_block and existing_block[1] == block.size:
+                                # It's a known block.
+                                existing_block_uid, existing_block_size = existing_block
+                                block_writer.set_block(idx=block.idx,
+                                                       block_uid=existing_block_uid,
+                                                       checksum=data_checksum,
+                                                       size=existing_block_size,
+                                                       valid=True)
+                                candidate_finished(block.idx)
+                                stats['bytes_deduplicated'] += len(data)
+                                if log_debug:
+                                    logger.debug('Found existing block for id {} with UID {}'.format(
+                                        block.idx, existing_block_uid))
+                            else:
+                                # It's a new block.
+                                # Generate a unique block id by combining the version id and the block index.
+                                block.uid = BlockUid(version.id, block.idx + 1)
+                                block.checksum = data_checksum
+                                storage.write_block_async(block, data)
+                                write_jobs += 1
+                                if log_debug:
+                                    logger.debug('Queued block {} for write (checksum {}...)'.format(
+                                        block.idx, data_checksum[:16]))
+
+                        done_read_jobs += 1
+
+                        handle_write_completed(timeout=0)
+
+                        self._progress.task_with_blocks('Backing up',
+                                                        version_uid=version.uid,
+                                                        blocks_done=done_read_jobs,
+                                                        blocks_count=read_jobs,
+                                                        per_thousand=5)
+                except (TimeoutError, CancelledError):
+                    pass
+
+            # The pipeline consists of these stages: reading from the source (I/O module worker threads), hashing
+            # and sparse detection (hash worker threads), deduplication and database updates (this thread) and
+            # transforming and writing to the storage (storage worker threads). Each stage has its own bounded queue.
             for entry in io.read_get_completed():
                 if isinstance(entry, Exception):
                     raise entry
@@ -941,59 +1153,22 @@ class Benji(ReprMixIn, AbstractContextManager):
                     block, data = cast(Tuple[DereferencedBlock, bytes], entry)
 
                 stats['bytes_read'] += len(data)
+                hash_executor.submit(partial(hash_job, block, data))
+                handle_hash_completed(timeout=0)
 
-                data_checksum = self._block_hash.data_hexdigest(data)
-                if data_checksum == sparse_block_checksum and block.size == version.block_size:
-                    # It's a sparse block.
-                    stats['bytes_sparse'] += block.size
-                    if log_debug:
-                        logger.debug('Skipping block (detected sparse) {}'.format(block.idx))
-                    version.set_block(idx=block.idx,
-                                      block_uid=SparseBlockUid,
-                                      checksum=None,
-                                      size=block.size,
-                                      valid=True)
-                else:
-                    existing_block = version.get_block_by_checksum(data_checksum)
-                    if existing_block and existing_block.size == block.size:
-                        # It's a known block.
-                        version.set_block(idx=block.idx,
-                                          block_uid=existing_block.uid,
-                                          checksum=existing_block.checksum,
-                                          size=existing_block.size,
-                                          valid=True)
-                        stats['bytes_deduplicated'] += len(data)
-                        if log_debug:
-                            logger.debug('Found existing block for id {} with UID {}'.format(
-                                block.idx, existing_block.uid))
-                    else:
-                        # It's a new block.
-                        # Generate a unique block id by combining the version id and the block index.
-                        block.uid = BlockUid(version.id, block.idx + 1)
-                        block.checksum = data_checksum
-                        storage.write_block_async(block, data)
-                        write_jobs += 1
-                        if log_debug:
-                            logger.debug('Queued block {} for write (checksum {}...)'.format(
-                                block.idx, data_checksum[:16]))
-
-                done_read_jobs += 1
-
-                handle_write_completed(timeout=0)
-
-                self._progress.task_with_blocks('Backing up',
-                                                version_uid=version.uid,
-                                                blocks_done=done_read_jobs,
-                                                blocks_count=read_jobs,
-                                                per_thousand=5)
-
+            handle_hash_completed()
+            # Write out any partially filled packs
+            storage.flush_writes()
             handle_write_completed()
+            dedup_index.close()
         except:
             Locking.unlock_version(version.uid)
             raise
         finally:
             # This will also cancel any outstanding read jobs
             io.close()
+            hash_executor.shutdown()
+            block_writer.close()
             version.commit()
 
         if read_jobs != done_read_jobs:
@@ -1007,7 +1182,7 @@ class Benji(ReprMixIn, AbstractContextManager):
                     write_jobs, done_write_jobs))
 
         version.set(status=VersionStatus.valid)
-        self.metadata_backup([version.uid], overwrite=True, locking=False)
+        self.metadata_backup([version.uid], overwrite=True, locking=False, base_version_uid=base_version_uid)
 
         logger.debug('Stats: {}'.format(stats))
         version.set_stats(
@@ -1029,14 +1204,13 @@ class Benji(ReprMixIn, AbstractContextManager):
                                locked_msg='Another cleanup is already running.',
                                override_lock=override_lock):
             self._progress.task('Cleanup')
-            for hit_list in DeletedBlock.get_unused_block_uids(dt):
+            for hit_list in BlockReference.get_unused_block_uids(dt):
                 for storage_name, uids in hit_list.items():
                     storage = StorageFactory.get_by_name(storage_name)
                     logger.debug('Deleting UIDs from storage {}: {}'.format(storage_name,
                                                                             ', '.join(str(uid) for uid in uids)))
 
-                    for uid in uids:
-                        storage.rm_block_async(uid)
+                    storage.rm_many_blocks_async(uids)
 
                     no_del_uids = []
                     for entry in storage.rm_get_completed():
@@ -1068,21 +1242,37 @@ class Benji(ReprMixIn, AbstractContextManager):
         Database.close()
 
     @staticmethod
-    def metadata_export(version_uids: Sequence[VersionUid], f: TextIO) -> None:
+    def metadata_export(version_uids: Sequence[VersionUid],
+                        f: Union[TextIO, BinaryIO],
+                        metadata_format: MetadataFormat = MetadataFormat.json,
+                        compress: bool = False) -> None:
         try:
             locked_version_uids = []
             for version_uid in version_uids:
                 Locking.lock_version(version_uid, reason='Exporting version metadata')
                 locked_version_uids.append(version_uid)
 
-            Database.export(version_uids, f)
+            Database.export(version_uids, f, metadata_format=metadata_format, compress=compress)
             logger.info('Exported metadata of version(s): {}.'.format(', '.join(version_uids)))
         finally:
             for version_uid in locked_version_uids:
                 Locking.unlock_version(version_uid)
 
-    @staticmethod
-    def metadata_backup(version_uids: Sequence[VersionUid], overwrite: bool = False, locking: bool = True) -> None:
+    def metadata_backup(self,
+                        version_uids: Sequence[VersionUid],
+                        overwrite: bool = False,
+                        locking: bool = True,
+                        metadata_format: MetadataFormat = None,
+                        compress: bool = None,
+                        base_version_uid: VersionUid = None) -> None:
+        """ Writes the metadata backups of the given versions to their storage. If a base version is given and
+        incremental metadata backups are enabled, only the changes relative to the base version are written as long as
+        the maximum length of the chain of incremental metadata backups isn't exceeded.
+        """
+        metadata_format = metadata_format if metadata_format is not None else self._metadata_backup_format
+        compress = compress if compress is not None else self._metadata_backup_compress
+        if metadata_format == MetadataFormat.json:
+            compress = False
         versions = [Version.get_by_uid(version_uid) for version_uid in version_uids]
         try:
             locked_version_uids = []
@@ -1091,24 +1281,168 @@ class Benji(ReprMixIn, AbstractContextManager):
                     Locking.lock_version(version.uid, reason='Backing up version metadata')
                     locked_version_uids.append(version.uid)
 
-            for version in versions:
-                with StringIO() as metadata_export:
-                    Database.export([version.uid], metadata_export)
+            # The metadata is exported from the database one version after the other, but the transformation
+            # and the upload to the storage, which usually take the most time, are done in parallel.
+            write_executor = JobExecutor(name='Metadata-Backup',
+                                         workers=self._metadata_backup_simultaneous_writes,
+                                         blocking_submit=True)
+            try:
+                for version in versions:
                     storage = StorageFactory.get_by_name(version.storage.name)
-                    storage.write_version(version.uid, metadata_export.getvalue(), overwrite=overwrite)
-                logger.info('Backed up metadata of version {}.'.format(version.uid))
+                    delta_base_version_uid, delta_depth = self._metadata_backup_delta_base(
+                        version, base_version_uid, storage)
+                    metadata_export = BytesIO()
+                    self._metadata_backup_export(version.uid, delta_base_version_uid, metadata_export, metadata_format,
+                                                 compress)
+
+                    def write_job(
+                            storage: StorageBase = storage,
+                            version_uid: VersionUid = version.uid,
+                            delta_base_version_uid: Optional[VersionUid] = delta_base_version_uid,
+                            delta_depth: int = delta_depth,
+                            metadata_export: BytesIO = metadata_export) -> Tuple[VersionUid, Optional[VersionUid]]:
+                        with metadata_export:
+                            storage.write_version(version_uid,
+                                                  metadata_export.getvalue(),
+                                                  overwrite=overwrite,
+                                                  base_version_uid=delta_base_version_uid,
+                                                  delta_depth=delta_depth)
+                        if delta_base_version_uid is not None:
+                            logger.info('Backed up metadata of version {} relative to version {}.'.format(
+                                version_uid, delta_base_version_uid))
+                        else:
+                            logger.info('Backed up metadata of version {}.'.format(version_uid))
+                        return version_uid, delta_base_version_uid
+
+                    write_executor.submit(write_job)
+
+                write_exception = None
+                versions_by_uid = {version.uid: version for version in versions}
+                for result in write_executor.get_completed():
+                    if isinstance(result, Exception):
+                        logger.error('Metadata backup failed: {}'.format(result))
+                        write_exception = write_exception or result
+                    else:
+                        # The database session isn't shared with the worker threads
+                        written_version_uid, written_base_version_uid = result
+                        versions_by_uid[written_version_uid].set_metadata_backup_base(written_base_version_uid)
+                if write_exception is not None:
+                    raise write_exception
+            finally:
+                write_executor.shutdown()
         finally:
             for version_uid in locked_version_uids:
                 Locking.unlock_version(version_uid)
 
+    @staticmethod
+    def _metadata_backup_export(version_uid: VersionUid,
+                                base_version_uid: Optional[VersionUid],
+                                f: BinaryIO,
+                                metadata_format: MetadataFormat,
+                                compress: bool) -> None:
+        # JSON is encoded directly into the binary buffer to avoid an intermediate copy of the whole document
+        metadata_export: Union[TextIO, BinaryIO]
+        if metadata_format == MetadataFormat.json:
+            metadata_export = TextIOWrapper(f, encoding='utf-8')
+        else:
+            metadata_export = f
+        try:
+            if base_version_uid is not None:
+                Database.export_delta(version_uid,
+                                      base_version_uid,
+                                      metadata_export,
+                                      metadata_format=metadata_format,
+                                      compress=compress)
+            else:
+                Database.export([version_uid], metadata_export, metadata_format=metadata_format, compress=compress)
+        finally:
+            if isinstance(metadata_export, TextIOWrapper):
+                metadata_export.flush()
+                metadata_export.detach()
+
+    def _metadata_backup_delta_base(self, version: Version, base_version_uid: Optional[VersionUid],
+                                    storage: StorageBase) -> Tuple[Optional[VersionUid], int]:
+        """ Returns the base version and the chain length of an incremental metadata backup of this version. If a full
+        metadata backup should be written (None, 0) is returned.
+        """
+        if self._metadata_backup_delta_chain_length == 0 or base_version_uid is None:
+            return None, 0
+
+        try:
+            base_version = Version.get_by_uid(base_version_uid)
+        except KeyError:
+            return None, 0
+        if (base_version.storage_id != version.storage_id or base_version.volume != version.volume or
+                base_version.block_size != version.block_size):
+            return None, 0
+
+        try:
+            _, base_delta_depth = storage.read_version_base(base_version_uid)
+        except FileNotFoundError:
+            logger.warning('Metadata backup of base version {} is missing, writing a full metadata backup.'.format(
+                base_version_uid))
+            return None, 0
+
+        # Write a full metadata backup as a checkpoint once the chain becomes too long
+        if base_delta_depth >= self._metadata_backup_delta_chain_length:
+            return None, 0
+
+        return base_version_uid, base_delta_depth + 1
+
+    def _read_metadata_backup(self, storage: StorageBase,
+                              version_uid: VersionUid) -> Tuple[Dict[str, Any], Iterator[DereferencedBlock]]:
+        """ Reads a metadata backup and resolves the chain of incremental metadata backups. Returns the attributes
+        of the version and an iterator over all of its blocks.
+        """
+        chain: List[Tuple[Dict[str, Any], Iterator[DereferencedBlock]]] = []
+        chain_version_uid = version_uid
+        while True:
+            if chain_version_uid in [version_dict['uid'] for version_dict, _ in chain]:
+                raise InputDataError('Metadata backup of version {} has a circular chain of base versions.'.format(
+                    version_uid))
+            metadata_backup = BytesIO(storage.read_version_data(chain_version_uid))
+            try:
+                version_dict, blocks = next(Database.read_versions(metadata_backup))
+            except StopIteration:
+                raise InputDataError('Metadata backup of version {} is empty.'.format(chain_version_uid)) from None
+            if version_dict['uid'] != chain_version_uid:
+                raise InputDataError('Metadata backup of version {} contains unexpected version {}.'.format(
+                    chain_version_uid, version_dict['uid']))
+            chain.append((version_dict, blocks))
+
+            if 'base_version_uid' not in version_dict:
+                break
+            chain_version_uid = version_dict['base_version_uid']
+
+        version_dict = chain[0][0]
+        if len(chain) == 1:
+            return version_dict, chain[0][1]
+
+        logger.debug('Metadata backup of version {} is based on version(s) {}.'.format(
+            version_uid, ', '.join(chain_version_dict['uid'] for chain_version_dict, _ in chain[1:])))
+        del version_dict['base_version_uid']
+        blocks_count = math.ceil(version_dict['size'] / version_dict['block_size'])
+
+        def merged_blocks() -> Iterator[DereferencedBlock]:
+            # The blocks of each metadata backup are ordered by their index. heapq.merge is stable, so the block from
+            # the newest metadata backup in the chain comes first and takes precedence.
+            last_idx = -1
+            for block in heapq.merge(*[blocks for _, blocks in chain], key=lambda block: block.idx):
+                if block.idx == last_idx or block.idx >= blocks_count:
+                    continue
+                last_idx = block.idx
+                yield block
+
+        return version_dict, merged_blocks()
+
     @staticmethod
     def export_any(*args, **kwargs) -> None:
         Database.export_any(*args, **kwargs)
 
     @staticmethod
-    def metadata_import(f: TextIO) -> None:
+    def metadata_import(f: Union[TextIO, BinaryIO], metadata_format: MetadataFormat = None) -> None:
         # TODO: Find a good way to lock here
-        version_uids = Database.import_(f)
+        version_uids = Database.import_(f, metadata_format=metadata_format)
         logger.info('Imported metadata of version(s): {}.'.format(', '.join(version_uids)))
 
     def metadata_restore(self, version_uids: Sequence[VersionUid], storage_name: str = None) -> None:
@@ -1120,9 +1454,15 @@ class Benji(ReprMixIn, AbstractContextManager):
                 locked_version_uids.append(version_uid)
 
             for version_uid in version_uids:
-                metadata_import_data = storage.read_version(version_uid)
-                with StringIO(metadata_import_data) as metadata_import:
-                    Database.import_(metadata_import)
+                base_version_uid, _ = storage.read_version_base(version_uid)
+                if base_version_uid is not None:
+                    version_dict, blocks = self._read_metadata_backup(storage, version_uid)
+                    Database.import_version(version_dict, blocks)
+                    Version.get_by_uid(version_uid).set_metadata_backup_base(base_version_uid)
+                else:
+                    # The format of the metadata backup is detected automatically
+                    with BytesIO(storage.read_version_data(version_uid)) as metadata_import:
+                        Database.import_(metadata_import)
                 logger.info('Restored metadata of version {}.'.format(version_uid))
         finally:
             for version_uid in locked_version_uids:
@@ -1446,6 +1786,9 @@ class BenjiStore(ReprMixIn):
 
         sparse_block_checksum = self._benji_obj._block_hash.data_hexdigest(b'\0' * cow_version.block_size)
         storage = StorageFactory.get_by_name(cow_version.storage.name)
+        block_writer = cow_version.block_writer()
+        # Blocks written to the storage whose database update is still buffered
+        pending_block_uids: List[BlockUid] = []
         for block in self._cow[cow_version.uid].values():
             logger.debug('Fixating block {}/{} with UID {}'.format(cow_version.uid, block.idx, block.uid))
             data = self._cow_store.read(block.uid)
@@ -1462,17 +1805,29 @@ class BenjiStore(ReprMixIn):
                 # The remove assumes that each block UID appears only once in the list and is not shared in any way.
                 self._cow_store.rm(block.uid)
 
+            if block.uid:
+                pending_block_uids.append(block.uid)
             try:
-                cow_version.set_block(idx=block.idx,
-                                      block_uid=block.uid,
-                                      checksum=block.checksum,
-                                      size=len(data),
-                                      valid=True)
+                block_writer.set_block(idx=block.idx,
+                                       block_uid=block.uid,
+                                       checksum=block.checksum,
+                                       size=len(data),
+                                       valid=True)
+                if not block_writer.pending:
+                    pending_block_uids = []
             except:
                 # Prevent orphaned blocks
-                if block.uid:
-                    storage.rm_block(block.uid)
+                for block_uid in pending_block_uids:
+                    storage.rm_block(block_uid)
+                raise
 
+        try:
+            block_writer.close()
+        except:
+            # Prevent orphaned blocks
+            for block_uid in pending_block_uids:
+                storage.rm_block(block_uid)
+            raise
         cow_version.commit()
         cow_version.set(status=VersionStatus.valid, protected=True)
         self._benji_obj.metadata_backup([cow_version.uid], overwrite=True, locking=False)
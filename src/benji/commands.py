@@ -9,7 +9,7 @@ from prettytable import PrettyTable
 import benji.exception
 from benji import __version__
 from benji.benji import Benji, BenjiStore
-from benji.database import Version, VersionUid
+from benji.database import Version, VersionUid, MetadataFormat
 from benji.logging import logger
 from benji.nbdserver import NbdServer
 from benji.utils import hints_from_rbd_diff, PrettyPrint, InputValidation, random_string
@@ -29,8 +29,12 @@ class Commands:
         self.config = config
 
     def backup(self, version_uid: str, volume: str, snapshot: str, source: str, rbd_hints: str, base_version_uid: str,
-               block_size: int, labels: List[str], storage: str) -> None:
-        if version_uid is None:
+               block_size: int, labels: List[str], storage: str, resume_version_uid: str) -> None:
+        if resume_version_uid is not None:
+            if version_uid is not None:
+                raise benji.exception.UsageError('A version UID can\'t be specified when resuming a backup.')
+            version_uid = resume_version_uid
+        elif version_uid is None:
             version_uid = '{}-{}'.format(volume[:248], random_string(6))
         version_uid_obj = VersionUid(version_uid)
         base_version_uid_obj = VersionUid(base_version_uid) if base_version_uid else None
@@ -50,7 +54,8 @@ class Commands:
                                               hints=hints,
                                               base_version_uid=base_version_uid_obj,
                                               storage_name=storage,
-                                              block_size=block_size)
+                                              block_size=block_size,
+                                              resume=resume_version_uid is not None)
 
             if labels:
                 for key, value in label_add:
@@ -77,8 +82,9 @@ class Commands:
         version_uid_obj = VersionUid(version_uid)
         with Benji(self.config, in_memory_database=database_less) as benji_obj:
             if database_less:
-                benji_obj.metadata_restore([version_uid_obj], storage)
-            benji_obj.restore(version_uid_obj, destination, sparse, force)
+                benji_obj.restore_from_metadata_backup(version_uid_obj, destination, sparse, force, storage)
+            else:
+                benji_obj.restore(version_uid_obj, destination, sparse, force)
 
     def protect(self, version_uids: List[str]) -> None:
         version_uid_objs = [VersionUid(version_uid) for version_uid in version_uids]
@@ -258,30 +264,54 @@ class Commands:
         with Benji(self.config) as benji_obj:
             benji_obj.cleanup(override_lock=override_lock)
 
-    def metadata_export(self, filter_expression: Optional[str], output_file: Optional[str], force: bool) -> None:
+    def metadata_export(self,
+                        filter_expression: Optional[str],
+                        output_file: Optional[str],
+                        force: bool,
+                        metadata_format: str = 'json',
+                        compression: str = 'none') -> None:
+        metadata_format_obj = MetadataFormat[metadata_format]
+        compress = compression == 'zstd'
+        binary = metadata_format_obj == MetadataFormat.binary
         with Benji(self.config) as benji_obj:
             version_uid_objs = [version.uid for version in benji_obj.find_versions_with_filter(filter_expression)]
             if output_file is None:
-                benji_obj.metadata_export(version_uid_objs, sys.stdout)
+                benji_obj.metadata_export(version_uid_objs,
+                                          sys.stdout.buffer if binary else sys.stdout,
+                                          metadata_format=metadata_format_obj,
+                                          compress=compress)
             else:
                 if os.path.exists(output_file) and not force:
                     raise FileExistsError('The output file already exists.')
 
-                with open(output_file, 'w') as f:
-                    benji_obj.metadata_export(version_uid_objs, f)
-
-    def metadata_backup(self, filter_expression: str, force: bool = False) -> None:
+                with open(output_file, 'wb' if binary else 'w') as f:
+                    benji_obj.metadata_export(version_uid_objs,
+                                              f,
+                                              metadata_format=metadata_format_obj,
+                                              compress=compress)
+
+    def metadata_backup(self,
+                        filter_expression: str,
+                        force: bool = False,
+                        metadata_format: str = None,
+                        compression: str = None) -> None:
+        metadata_format_obj = MetadataFormat[metadata_format] if metadata_format is not None else None
+        compress = compression == 'zstd' if compression is not None else None
         with Benji(self.config) as benji_obj:
             version_uid_objs = [version.uid for version in benji_obj.find_versions_with_filter(filter_expression)]
-            benji_obj.metadata_backup(version_uid_objs, overwrite=force)
+            benji_obj.metadata_backup(version_uid_objs,
+                                      overwrite=force,
+                                      metadata_format=metadata_format_obj,
+                                      compress=compress)
 
-    def metadata_import(self, input_file: str = None) -> None:
+    def metadata_import(self, input_file: str = None, metadata_format: str = 'auto') -> None:
+        metadata_format_obj = MetadataFormat[metadata_format] if metadata_format != 'auto' else None
         with Benji(self.config) as benji_obj:
             if input_file is None:
-                benji_obj.metadata_import(sys.stdin)
+                benji_obj.metadata_import(sys.stdin.buffer, metadata_format=metadata_format_obj)
             else:
-                with open(input_file, 'r') as f:
-                    benji_obj.metadata_import(f)
+                with open(input_file, 'rb') as f:
+                    benji_obj.metadata_import(f, metadata_format=metadata_format_obj)
 
     def metadata_restore(self, version_uids: List[str], storage: str = None) -> None:
         version_uid_objs = [VersionUid(version_uid) for version_uid in version_uids]
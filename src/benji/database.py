@@ -4,6 +4,7 @@ import collections
 import datetime
 import enum
 import inspect
+import io
 import json
 import math
 import operator
@@ -11,6 +12,7 @@ import os
 import platform
 import re
 import sqlite3
+import struct
 import threading
 import time
 import uuid
@@ -19,8 +21,9 @@ from binascii import hexlify, unhexlify
 from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
 from functools import total_ordering
-from itertools import chain
-from typing import Union, List, Tuple, TextIO, Dict, cast, Iterator, Set, Any, Optional, Sequence, Callable
+from itertools import chain, islice
+from typing import Union, List, Tuple, TextIO, Dict, cast, Iterator, Set, Any, Optional, Sequence, Callable, \
+    Iterable, BinaryIO, NamedTuple
 
 import pyparsing
 import semantic_version
@@ -63,7 +66,9 @@ class BenjiDateTime(sqlalchemy.types.TypeDecorator):
     cache_ok = False
 
     def process_bind_param(self, value: Optional[Union[datetime.datetime, str]], dialect) -> Optional[datetime.datetime]:
-        if isinstance(value, datetime.datetime):
+        if value is None:
+            return None
+        elif isinstance(value, datetime.datetime):
             if value.tzinfo is None:
                 return value
             else:
@@ -282,6 +287,9 @@ class BlockUid(sqlalchemy.ext.mutable.MutableComposite, StorageKeyMixIn['BlockUi
 
 SparseBlockUid = BlockUid(None, None)
 
+# A block of a version with a compact block map: uid_left, uid_right, checksum, size and valid
+BlockEntry = Tuple[Optional[int], Optional[int], Optional[str], int, bool]
+
 # Explicit naming helps Alembic to auto-generate versions
 metadata = sqlalchemy.MetaData(
     naming_convention={
@@ -302,6 +310,8 @@ class Version(Base, ReprMixIn):
 
     TIMED_COMMIT_INTERVAL = 20  # in seconds
     BLOCKS_PER_CALL = 10000
+    # Runs of at least this many consecutive indices are queried as a range instead of a list of indices
+    MIN_IDX_RANGE_LENGTH = 64
     REPR_SQL_ATTR_SORT_FIRST = ['uid', 'volume', 'snapshot']
 
     _last_timed_commit = time.monotonic()
@@ -325,6 +335,13 @@ class Version(Base, ReprMixIn):
                                                           name='status'),
                                nullable=False)
     protected = sqlalchemy.Column(sqlalchemy.Boolean(name='protected'), nullable=False)
+    # The blocks of versions with a compact block map are stored in table block_chunks instead of table blocks.
+    compact_block_map = sqlalchemy.Column(sqlalchemy.Boolean(name='compact_block_map'), nullable=False, default=False)
+    # Index of the first block a backup hasn't committed yet, all blocks before it are final. This is updated together
+    # with the blocks, so an interrupted backup can be resumed from here.
+    resume_idx = sqlalchemy.Column(sqlalchemy.BigInteger)
+    # Base version of the incremental metadata backup of this version, NULL if the metadata backup is a full one.
+    metadata_backup_base_uid = sqlalchemy.Column(VersionUidType)
 
     # Statistics
     bytes_read = sqlalchemy.Column(sqlalchemy.BigInteger)
@@ -360,7 +377,8 @@ class Version(Base, ReprMixIn):
                storage_id: int,
                block_size: int,
                status: VersionStatus = VersionStatus.incomplete,
-               protected: bool = False) -> 'Version':
+               protected: bool = False,
+               compact_block_map: bool = False) -> 'Version':
         version = cls(
             uid=version_uid,
             volume=volume,
@@ -370,6 +388,7 @@ class Version(Base, ReprMixIn):
             block_size=block_size,
             status=status,
             protected=protected,
+            compact_block_map=compact_block_map,
             date=datetime.datetime.utcnow(),
         )
         try:
@@ -383,16 +402,15 @@ class Version(Base, ReprMixIn):
 
     def remove(self) -> int:
         try:
-            affected_blocks = Session.scalars(select(Block).filter(Block.version_id == self.id)).all()
-            num_blocks = len(affected_blocks)
-            for affected_block in affected_blocks:
-                if affected_block.uid:
-                    deleted_block = DeletedBlock(
-                        storage_id=self.storage_id,
-                        uid=affected_block.uid,
-                        date=datetime.datetime.utcnow(),
-                    )
-                    Session.add(deleted_block)
+            if self.compact_block_map:
+                num_blocks = 0
+                for entries in self._iter_chunks():
+                    num_blocks += len(entries)
+                    BlockReference.adjust(self.storage_id, self._entries_references(entries.values(), -1))
+            else:
+                num_blocks = Session.scalar(
+                    select(func.count()).select_from(Block).filter(Block.version_id == self.id))
+                BlockReference.adjust_by_version(self.id, -1)
             # The following delete statement will cascade this delete to the blocks table
             # and delete all blocks
             Session.delete(self)
@@ -425,23 +443,239 @@ class Version(Base, ReprMixIn):
                 block for block in blocks if block['uid_left'] is not None or block['uid_right'] is not None or block['size'] != self.block_size
             ]
 
-            for block in blocks:
-                block['version_id'] = self.id
-
-            Session.bulk_insert_mappings(Block, blocks)
+            if self.compact_block_map:
+                self._update_chunks({
+                    block['idx']: (block['uid_left'], block['uid_right'], block['checksum'], block['size'],
+                                   block['valid']) for block in blocks
+                })
+            else:
+                deltas: Dict[BlockUid, int] = defaultdict(int)
+                for block in blocks:
+                    block['version_id'] = self.id
+                    if block['uid_left'] is not None and block['uid_right'] is not None:
+                        deltas[BlockUid(block['uid_left'], block['uid_right'])] += 1
+
+                Block.insert_many(blocks)
+                BlockReference.adjust(self.storage_id, deltas)
+            BlockChecksum.add(
+                self.storage_id, {
+                    block['checksum']: (BlockUid(block['uid_left'], block['uid_right']), block['size'])
+                    for block in blocks
+                    if block['valid'] and block['checksum'] is not None and block['uid_left'] is not None and
+                    block['uid_right'] is not None
+                })
             self._timed_commit()
         except:
             Session.rollback()
             raise
 
+    def initialize_blocks(self, *, base_version: 'Version' = None) -> None:
+        """ Populates the blocks of a newly created version. If a base version is given its blocks are copied on the
+        database server. Blocks whose size differs from the size they have in the new version are reset so that they
+        are reread during the backup.
+        """
+        try:
+            resize_candidates = {self.blocks_count - 1}
+            if base_version is not None:
+                if not self.compact_block_map and not base_version.compact_block_map:
+                    columns = ('idx', 'uid_left', 'uid_right', 'checksum', 'size', 'valid')
+                    Session.execute(
+                        sqlalchemy.insert(Block.__table__).from_select(
+                            ('version_id',) + columns,
+                            select(sqlalchemy.literal(self.id, sqlalchemy.Integer),
+                                   *[Block.__table__.c[column] for column in columns]).filter(
+                                       Block.version_id == base_version.id, Block.idx < self.blocks_count)))
+                    # All block UIDs of the base version are already referenced, so this only needs to update counts.
+                    BlockReference.adjust_by_version(self.id, 1)
+                elif self.compact_block_map and base_version.compact_block_map:
+                    self._clone_chunks(base_version)
+                else:
+                    self._copy_blocks(base_version)
+                resize_candidates.add(base_version.blocks_count - 1)
+
+            # Only the last block of the base version and the last block of the new version can change their size.
+            for idx in sorted(resize_candidates):
+                if idx < 0 or idx >= self.blocks_count:
+                    continue
+                # Sparse blocks are synthesized with the full block size.
+                current_size = self.get_block_by_idx(idx).size
+                new_size = min(self.block_size, self.size - idx * self.block_size)
+                if current_size != new_size:
+                    # Forces reread.
+                    self.set_block(idx=idx, block_uid=SparseBlockUid, checksum=None, size=new_size, valid=False)
+
+            Session.commit()
+        except:
+            Session.rollback()
+            raise
+
+    def _clone_chunks(self, base_version: 'Version') -> None:
+        """ Copies the chunks of a base version with a compact block map on the database server. """
+        chunks_count = self._chunks_count()
+        Session.execute(
+            sqlalchemy.insert(BlockChunk.__table__).from_select(
+                ('version_id', 'chunk_idx', 'data'),
+                select(sqlalchemy.literal(self.id, sqlalchemy.Integer), BlockChunk.chunk_idx,
+                       BlockChunk.data).filter(BlockChunk.version_id == base_version.id,
+                                               BlockChunk.chunk_idx < chunks_count)))
+        Session.execute(
+            sqlalchemy.insert(BlockChunkUidLeft.__table__).from_select(
+                ('uid_left', 'version_id'),
+                select(BlockChunkUidLeft.uid_left,
+                       sqlalchemy.literal(self.id, sqlalchemy.Integer)).filter(BlockChunkUidLeft.version_id ==
+                                                                               base_version.id)))
+        for entries in self._iter_chunks():
+            BlockReference.adjust(self.storage_id, self._entries_references(entries.values(), 1))
+        # Remove the blocks beyond the end of this version from the last chunk
+        end_idx = min(base_version.blocks_count, chunks_count * BlockChunk.BLOCKS_PER_CHUNK)
+        if end_idx > self.blocks_count:
+            self._update_chunks({idx: None for idx in range(self.blocks_count, end_idx)})
+
+    def _copy_blocks(self, base_version: 'Version') -> None:
+        """ Copies the blocks of a base version with a different block map layout. """
+        entries: Dict[int, Optional[BlockEntry]] = {}
+        for block in base_version.dereferenced_blocks:
+            if block.idx >= self.blocks_count:
+                break
+            if not block.uid and block.size == self.block_size and block.valid:
+                continue
+            entries[block.idx] = (block.uid_left, block.uid_right, block.checksum, block.size, block.valid)
+            if len(entries) >= self.BLOCKS_PER_CALL:
+                self._write_entries(entries)
+                entries = {}
+        self._write_entries(entries)
+
+    def _write_entries(self, entries: Dict[int, Optional[BlockEntry]]) -> None:
+        """ Inserts new blocks without checking for existing blocks with the same index. """
+        if self.compact_block_map:
+            self._update_chunks(entries)
+        else:
+            rows = [{
+                'version_id': self.id,
+                'idx': idx,
+                'uid_left': entry[0],
+                'uid_right': entry[1],
+                'checksum': entry[2],
+                'size': entry[3],
+                'valid': entry[4],
+            } for idx, entry in entries.items() if entry is not None]
+            Block.insert_many(rows)
+            BlockReference.adjust(
+                self.storage_id,
+                self._entries_references((entry for entry in entries.values() if entry is not None), 1))
+
+    def _chunks_count(self) -> int:
+        return math.ceil(self.blocks_count / BlockChunk.BLOCKS_PER_CHUNK)
+
+    def _read_chunks(self, chunk_idxs: Iterable[int]) -> Dict[int, Dict[int, BlockEntry]]:
+        """ Returns the decoded blocks of the given chunks by chunk index. Missing chunks are returned empty. """
+        chunk_idxs = list(chunk_idxs)
+        chunks: Dict[int, Dict[int, BlockEntry]] = {chunk_idx: {} for chunk_idx in chunk_idxs}
+        # Older SQLite versions only support up to 999 parameters per statement
+        for offset in range(0, len(chunk_idxs), 500):
+            for row in Session.execute(
+                    select(BlockChunk.chunk_idx,
+                           BlockChunk.data).filter(BlockChunk.version_id == self.id,
+                                                   BlockChunk.chunk_idx.in_(chunk_idxs[offset:offset + 500]))):
+                chunks[row.chunk_idx] = BlockChunk.decode(row.chunk_idx, row.data)
+        return chunks
+
+    def _iter_chunks(self) -> Iterator[Dict[int, BlockEntry]]:
+        """ Yields the decoded blocks of all chunks in order. """
+        chunks_count = self._chunks_count()
+        chunks_per_call = max(self.BLOCKS_PER_CALL // BlockChunk.BLOCKS_PER_CHUNK, 1)
+        for first_chunk_idx in range(0, chunks_count, chunks_per_call):
+            chunks = self._read_chunks(range(first_chunk_idx, min(first_chunk_idx + chunks_per_call, chunks_count)))
+            for chunk_idx in sorted(chunks.keys()):
+                yield chunks[chunk_idx]
+
+    def _update_chunks(self, updates: Dict[int, Optional[BlockEntry]]) -> None:
+        """ Updates the blocks of a version with a compact block map. An entry of None removes the block, i.e. makes it
+        sparse. The reference counts are adjusted accordingly. This doesn't commit.
+        """
+        chunk_updates: Dict[int, Dict[int, Optional[BlockEntry]]] = defaultdict(dict)
+        for idx, entry in updates.items():
+            chunk_updates[idx // BlockChunk.BLOCKS_PER_CHUNK][idx] = entry
+
+        chunk_idxs = sorted(chunk_updates.keys())
+        chunks = self._read_chunks(chunk_idxs)
+        deltas: Dict[BlockUid, int] = defaultdict(int)
+        rows = []
+        for chunk_idx in chunk_idxs:
+            entries = chunks[chunk_idx]
+            for idx, entry in chunk_updates[chunk_idx].items():
+                old_entry = entries.pop(idx, None)
+                if old_entry is not None and old_entry[0] is not None and old_entry[1] is not None:
+                    deltas[BlockUid(old_entry[0], old_entry[1])] -= 1
+                if entry is not None:
+                    entries[idx] = entry
+                    if entry[0] is not None and entry[1] is not None:
+                        deltas[BlockUid(entry[0], entry[1])] += 1
+            if entries:
+                rows.append({'version_id': self.id, 'chunk_idx': chunk_idx, 'data': BlockChunk.encode(entries)})
+
+        # Older SQLite versions only support up to 999 parameters per statement
+        for offset in range(0, len(chunk_idxs), 500):
+            Session.execute(
+                delete(BlockChunk).filter(BlockChunk.version_id == self.id,
+                                          BlockChunk.chunk_idx.in_(chunk_idxs[offset:offset + 500])).execution_options(
+                                              synchronize_session=False))
+        if rows:
+            Session.execute(BlockChunk.__table__.insert(), rows)
+        BlockReference.adjust(self.storage_id, deltas)
+        BlockChunkUidLeft.add(self.id, {block_uid.left for block_uid, delta in deltas.items() if delta > 0})
+
+    @staticmethod
+    def _entries_references(entries: Iterable[BlockEntry], direction: int) -> Dict[BlockUid, int]:
+        deltas: Dict[BlockUid, int] = defaultdict(int)
+        for uid_left, uid_right, _, _, _ in entries:
+            if uid_left is not None and uid_right is not None:
+                deltas[BlockUid(uid_left, uid_right)] += direction
+        return deltas
+
+    def _block_entry(self, *, block_uid: BlockUid, checksum: Optional[str], size: int,
+                     valid: bool) -> Optional[BlockEntry]:
+        if not block_uid and size == self.block_size:
+            # Block should be fully sparse
+            return None
+        return block_uid.left, block_uid.right, checksum, size, valid
+
+    def _block_from_entry(self, idx: int, entry: Optional[BlockEntry]) -> 'Block':
+        if entry is None:
+            return self._create_sparse_block(idx)
+        # This block isn't part of the database session either.
+        return Block(version_id=self.id,
+                     idx=idx,
+                     uid=BlockUid(entry[0], entry[1]),
+                     checksum=entry[2],
+                     size=entry[3],
+                     valid=entry[4])
+
     def set_block(self, *, idx: int, block_uid: BlockUid, checksum: Optional[str], size: int, valid: bool) -> None:
         try:
+            if valid and block_uid and checksum is not None:
+                BlockChecksum.add(self.storage_id, {checksum: (block_uid, size)})
+
+            if self.compact_block_map:
+                self._update_chunks(
+                    {idx: self._block_entry(block_uid=block_uid, checksum=checksum, size=size, valid=valid)})
+                self._timed_commit()
+                return
+
             block = Session.scalars(select(Block).filter(Block.version_id == self.id, Block.idx == idx)).one_or_none()
 
             if not block and not block_uid and size == self.block_size:
                 # Block is not present and it should be fully sparse now -> Nothing to do.
                 return
-            elif block and not block_uid and size == self.block_size:
+
+            deltas: Dict[BlockUid, int] = defaultdict(int)
+            if block and block.uid:
+                deltas[block.uid] -= 1
+            if block_uid:
+                deltas[block_uid] += 1
+            BlockReference.adjust(self.storage_id, deltas)
+
+            if block and not block_uid and size == self.block_size:
                 # Block is present but it should be fully sparse now -> Delete it.
                 Session.delete(block)
             elif not block:
@@ -460,6 +694,9 @@ class Version(Base, ReprMixIn):
             Session.rollback()
             raise
 
+    def block_writer(self) -> 'BlockWriter':
+        return BlockWriter(self)
+
     def set_stats(self, *, bytes_read: int, bytes_written: int, bytes_deduplicated: int, bytes_sparse: int,
                   duration: int) -> None:
         try:
@@ -473,6 +710,14 @@ class Version(Base, ReprMixIn):
             Session.rollback()
             raise
 
+    def set_metadata_backup_base(self, base_version_uid: Optional[VersionUid]) -> None:
+        try:
+            self.metadata_backup_base_uid = base_version_uid
+            Session.commit()
+        except:
+            Session.rollback()
+            raise
+
     def set(self, *, status: VersionStatus = None, protected: bool = None) -> None:
         try:
             if status is not None:
@@ -500,6 +745,37 @@ class Version(Base, ReprMixIn):
 
             Session.execute(
                 update(Block).filter(Block.uid == block_uid).values(valid=valid).execution_options(synchronize_session=False))
+            if not valid:
+                BlockChecksum.remove([block_uid])
+
+            # Versions with a compact block map can only be searched by decoding their chunks. The reference count
+            # tells us how many references are left after the regular blocks, so decoding stops once all are found.
+            reference_count = Session.scalar(select(BlockReference.count).filter(BlockReference.uid == block_uid))
+            remaining_references = (reference_count or 0) - len(affected_version_uids_query)
+            if remaining_references > 0:
+                # Only versions which reference blocks written by the same version can reference this block. Most of
+                # the time a block is referenced at the index it was written to, so this chunk is searched first.
+                versions = Session.scalars(
+                    select(cls).join(BlockChunkUidLeft, BlockChunkUidLeft.version_id == cls.id).filter(
+                        BlockChunkUidLeft.uid_left == block_uid.left).order_by(cls.id).with_for_update()).all()
+                original_chunk_idx = (block_uid.right - 1) // BlockChunk.BLOCKS_PER_CHUNK
+                for version in versions:
+                    if remaining_references <= 0:
+                        break
+                    found = version._set_chunk_blocks_valid(block_uid, valid,
+                                                            version._read_chunks([original_chunk_idx]).values())
+                    if found > 0:
+                        affected_version_uids.add(version.uid)
+                        remaining_references -= found
+                for version in versions:
+                    if remaining_references <= 0:
+                        break
+                    found = version._set_chunk_blocks_valid(
+                        block_uid, valid, (entries for chunk_idx, entries in enumerate(version._iter_chunks())
+                                           if chunk_idx != original_chunk_idx))
+                    if found > 0:
+                        affected_version_uids.add(version.uid)
+                        remaining_references -= found
 
             if len(affected_version_uids) > 0:
                 logger.error('Marked block with UID {} as {} in all affected versions: {}.'.format(
@@ -522,6 +798,21 @@ class Version(Base, ReprMixIn):
 
         return affected_version_uids
 
+    def _set_chunk_blocks_valid(self, block_uid: BlockUid, valid: bool,
+                                chunks: Iterable[Dict[int, BlockEntry]]) -> int:
+        """ Sets the valid flag of all blocks with the given UID in the given decoded chunks. Returns their number. """
+        updated = 0
+        for entries in chunks:
+            updates: Dict[int, Optional[BlockEntry]] = {
+                idx: (entry[0], entry[1], entry[2], entry[3], valid)
+                for idx, entry in entries.items()
+                if entry[0] == block_uid.left and entry[1] == block_uid.right
+            }
+            if updates:
+                self._update_chunks(updates)
+                updated += len(updates)
+        return updated
+
     def _create_sparse_block(self, idx: int) -> 'Block':
         # This block isn't part if the database session and probably never will be.
         return Block(version_id=self.id, idx=idx, uid=SparseBlockUid, checksum=None, size=self.block_size, valid=True)
@@ -530,6 +821,13 @@ class Version(Base, ReprMixIn):
     # See: https://github.com/sqlalchemy/sqlalchemy/wiki/WindowedRangeQuery
     @property
     def blocks(self) -> Iterator['Block']:
+        if self.compact_block_map:
+            for chunk_idx, entries in enumerate(self._iter_chunks()):
+                start_idx = chunk_idx * BlockChunk.BLOCKS_PER_CHUNK
+                for idx in range(start_idx, min(start_idx + BlockChunk.BLOCKS_PER_CHUNK, self.blocks_count)):
+                    yield self._block_from_entry(idx, entries.get(idx))
+            return
+
         next_start_idx = 0
         while True:
             start_idx = next_start_idx
@@ -558,24 +856,169 @@ class Version(Base, ReprMixIn):
             if next_start_idx == self.blocks_count:
                 break
 
-    def _sparse_blocks_by_idx(self) -> List[int]:
-        # noinspection PyComparisonWithNone
-        non_sparse_blocks_query = object_session(self).execute(
-            select(Block.idx, Block.uid_left,
-                   Block.uid_right).filter(Block.version_id == self.id, Block.uid_left != None,
-                                           Block.uid_right != None)).all()
-        non_sparse_blocks = {row.idx for row in non_sparse_blocks_query}
+    def block_runs(self) -> Iterator[Union['DereferencedBlock', 'SparseBlockRun']]:
+        """ Yields all blocks of this version in order of their index. Consecutive sparse blocks are yielded as one
+        SparseBlockRun. The blocks are read with keyset pagination without going through the ORM, so this is
+        considerably cheaper than iterating over blocks for large versions.
+        """
+        blocks_count = self.blocks_count
+        next_idx = 0
+        if self.compact_block_map:
+            for entries in self._iter_chunks():
+                for idx in sorted(entries.keys()):
+                    if idx >= blocks_count:
+                        break
+                    if next_idx < idx:
+                        yield SparseBlockRun(next_idx, idx - next_idx)
+                    uid_left, uid_right, checksum, size, valid = entries[idx]
+                    yield DereferencedBlock(BlockUid(uid_left, uid_right), self.id, idx, checksum, size, valid)
+                    next_idx = idx + 1
+        else:
+            blocks_table = Block.__table__
+            query = select(blocks_table.c.idx, blocks_table.c.uid_left, blocks_table.c.uid_right,
+                           blocks_table.c.checksum, blocks_table.c.size,
+                           blocks_table.c.valid).filter(blocks_table.c.version_id == self.id,
+                                                        blocks_table.c.idx < blocks_count).order_by(
+                                                            blocks_table.c.idx).limit(self.BLOCKS_PER_CALL)
+            while True:
+                rows = Session.execute(query.filter(blocks_table.c.idx >= next_idx)).all()
+                for idx, uid_left, uid_right, checksum, size, valid in rows:
+                    if next_idx < idx:
+                        yield SparseBlockRun(next_idx, idx - next_idx)
+                    yield DereferencedBlock(BlockUid(uid_left, uid_right), self.id, idx, checksum, size, valid)
+                    next_idx = idx + 1
+                if len(rows) < self.BLOCKS_PER_CALL:
+                    break
+
+        if next_idx < blocks_count:
+            yield SparseBlockRun(next_idx, blocks_count - next_idx)
 
-        return [idx for idx in range(self.blocks_count) if idx not in non_sparse_blocks]
+    @property
+    def dereferenced_blocks(self) -> Iterator['DereferencedBlock']:
+        """ Like blocks but yields lightweight dereferenced blocks. """
+        for block in self.block_runs():
+            if isinstance(block, SparseBlockRun):
+                for idx in range(block.idx, block.idx + block.count):
+                    yield DereferencedBlock(SparseBlockUid, self.id, idx, None, self.block_size, True)
+            else:
+                yield block
+
+    @classmethod
+    def _idx_batches(cls, idxs: Iterable[int]) -> Iterator[Union[range, List[int]]]:
+        """ Splits the indices into batches keeping their order. Runs of consecutive indices are returned as ranges of
+        up to BLOCKS_PER_CALL indices, all other indices as lists of up to 500 indices.
+        """
+        scattered_idxs: List[int] = []
+        run_start, run_stop = 0, 0
+        for idx in chain(idxs, (None,)):
+            if idx is not None and idx == run_stop and run_stop > run_start:
+                run_stop += 1
+                continue
+
+            if run_stop - run_start >= cls.MIN_IDX_RANGE_LENGTH:
+                if scattered_idxs:
+                    yield scattered_idxs
+                    scattered_idxs = []
+                for start in range(run_start, run_stop, cls.BLOCKS_PER_CALL):
+                    yield range(start, min(start + cls.BLOCKS_PER_CALL, run_stop))
+            else:
+                for run_idx in range(run_start, run_stop):
+                    scattered_idxs.append(run_idx)
+                    # Older SQLite versions only support up to 999 parameters per statement
+                    if len(scattered_idxs) == 500:
+                        yield scattered_idxs
+                        scattered_idxs = []
+
+            if idx is not None:
+                run_start, run_stop = idx, idx + 1
+        if scattered_idxs:
+            yield scattered_idxs
+
+    def blocks_by_idx(self, idxs: Iterable[int]) -> Iterator['Block']:
+        """ Yields the blocks with the given indices in the order given. Sparse blocks are synthesized. """
+        for idxs_batch in self._idx_batches(idxs):
+            if self.compact_block_map:
+                if isinstance(idxs_batch, range):
+                    chunk_idxs: Iterable[int] = range(idxs_batch.start // BlockChunk.BLOCKS_PER_CHUNK,
+                                                      (idxs_batch.stop - 1) // BlockChunk.BLOCKS_PER_CHUNK + 1)
+                else:
+                    chunk_idxs = {idx // BlockChunk.BLOCKS_PER_CHUNK for idx in idxs_batch}
+                chunks = self._read_chunks(chunk_idxs)
+                for idx in idxs_batch:
+                    yield self._block_from_entry(idx, chunks[idx // BlockChunk.BLOCKS_PER_CHUNK].get(idx))
+                continue
+
+            if isinstance(idxs_batch, range):
+                idx_filter = Block.idx.between(idxs_batch.start, idxs_batch.stop - 1)
+            else:
+                idx_filter = Block.idx.in_(idxs_batch)
+            blocks = {
+                block.idx: block
+                for block in object_session(self).scalars(select(Block).filter(Block.version_id == self.id, idx_filter))
+            }
+            for idx in idxs_batch:
+                yield blocks[idx] if idx in blocks else self._create_sparse_block(idx)
+
+    def invalid_blocks_by_idx(self) -> List[int]:
+        if self.compact_block_map:
+            return [idx for entries in self._iter_chunks() for idx in sorted(entries.keys()) if not entries[idx][4]]
+
+        return list(
+            object_session(self).scalars(
+                select(Block.idx).filter(Block.version_id == self.id, Block.valid == False).order_by(Block.idx)))
+
+    def sparse_extents(self) -> Iterator['SparseBlockRun']:
+        """ Yields the runs of consecutive blocks without a block UID in order of their index. Only the indices of
+        the blocks with data are read from the database.
+        """
+        blocks_count = self.blocks_count
+        next_idx = 0
+        if self.compact_block_map:
+            for entries in self._iter_chunks():
+                for idx in sorted(entries.keys()):
+                    entry = entries[idx]
+                    if idx >= blocks_count or entry[0] is None or entry[1] is None:
+                        continue
+                    if next_idx < idx:
+                        yield SparseBlockRun(next_idx, idx - next_idx)
+                    next_idx = idx + 1
+        else:
+            blocks_table = Block.__table__
+            # noinspection PyComparisonWithNone
+            query = select(blocks_table.c.idx).filter(blocks_table.c.version_id == self.id,
+                                                      blocks_table.c.uid_left != None,
+                                                      blocks_table.c.uid_right != None,
+                                                      blocks_table.c.idx < blocks_count).order_by(
+                                                          blocks_table.c.idx).limit(self.BLOCKS_PER_CALL)
+            while True:
+                idxs = Session.scalars(query.filter(blocks_table.c.idx >= next_idx)).all()
+                for idx in idxs:
+                    if next_idx < idx:
+                        yield SparseBlockRun(next_idx, idx - next_idx)
+                    next_idx = idx + 1
+                if len(idxs) < self.BLOCKS_PER_CALL:
+                    break
+
+        if next_idx < blocks_count:
+            yield SparseBlockRun(next_idx, blocks_count - next_idx)
 
     @property
     def sparse_blocks(self) -> Iterator['Block']:
-        for idx in self._sparse_blocks_by_idx():
-            yield self._create_sparse_block(idx)
+        for extent in self.sparse_extents():
+            for idx in range(extent.idx, extent.idx + extent.count):
+                yield self._create_sparse_block(idx)
 
     @property
     def sparse_blocks_count(self) -> int:
-        return len(self._sparse_blocks_by_idx())
+        if self.compact_block_map:
+            return self.blocks_count - sum(
+                1 for entries in self._iter_chunks() for idx, entry in entries.items()
+                if idx < self.blocks_count and entry[0] is not None and entry[1] is not None)
+
+        # noinspection PyComparisonWithNone
+        return self.blocks_count - Session.scalar(
+            select(func.count()).select_from(Block).filter(Block.version_id == self.id, Block.uid_left != None,
+                                                           Block.uid_right != None, Block.idx < self.blocks_count))
 
     @classmethod
     def get_by_uid(cls, version_uid: VersionUid) -> 'Version':
@@ -587,28 +1030,85 @@ class Version(Base, ReprMixIn):
         return version
 
     def get_block_by_idx(self, idx: int) -> 'Block':
+        if self.compact_block_map:
+            chunk_idx = idx // BlockChunk.BLOCKS_PER_CHUNK
+            return self._block_from_entry(idx, self._read_chunks([chunk_idx])[chunk_idx].get(idx))
+
         block = Session.scalars(select(Block).filter(Block.version_id == self.id, Block.idx == idx)).one_or_none()
         if not block:
             block = self._create_sparse_block(idx)
 
         return block
 
-    def get_block_by_checksum(self, checksum) -> 'Block':
+    def get_block_by_checksum(self, checksum: str) -> Optional['BlockChecksum']:
+        # Block UIDs which aren't referenced anymore are about to be removed from the storage. Of the remaining ones
+        # the most recently written is used as it is likely to stay around the longest.
         return Session.scalars(
-            select(Block).join(Version).filter(Block.checksum == checksum, Block.valid == True,
-                                               Version.storage_id == self.storage_id).limit(1)).first()
+            select(BlockChecksum).join(BlockReference, (BlockChecksum.uid_left == BlockReference.uid_left) &
+                                       (BlockChecksum.uid_right == BlockReference.uid_right)).filter(
+                                           BlockChecksum.storage_id == self.storage_id,
+                                           BlockChecksum.checksum == checksum, BlockReference.count > 0).order_by(
+                                               BlockChecksum.uid_left.desc(),
+                                               BlockChecksum.uid_right.desc()).limit(1)).one_or_none()
+
+    @classmethod
+    def storage_checksums(cls, storage_id: int, min_version_id: int = None) -> Iterator[Tuple[bytes, int, int, int]]:
+        """ Yields distinct tuples of (binary checksum, uid_left, uid_right, size) for all valid blocks in a storage.
+        When min_version_id is given only blocks belonging to versions with an id above it are returned. The blocks
+        of versions with a compact block map are yielded afterwards and might repeat earlier tuples in this case.
+        """
+        # The checksum is selected in its raw binary form to avoid the conversion to a hexadecimal string.
+        if min_version_id is None:
+            query = select(sqlalchemy.type_coerce(BlockChecksum.checksum, sqlalchemy.LargeBinary),
+                           BlockChecksum.uid_left, BlockChecksum.uid_right, BlockChecksum.size).join(
+                               BlockReference, (BlockChecksum.uid_left == BlockReference.uid_left) &
+                               (BlockChecksum.uid_right == BlockReference.uid_right)).filter(
+                                   BlockChecksum.storage_id == storage_id, BlockReference.count > 0)
+            for row in Session.execute(query.execution_options(yield_per=cls.BLOCKS_PER_CALL)):
+                yield bytes(row[0]), row[1], row[2], row[3]
+            return
+
+        # noinspection PyComparisonWithNone
+        query = select(sqlalchemy.type_coerce(Block.checksum, sqlalchemy.LargeBinary), Block.uid_left,
+                       Block.uid_right, Block.size).join(Version).filter(Version.storage_id == storage_id,
+                                                                         Block.valid == True,
+                                                                         Block.checksum != None,
+                                                                         Version.id > min_version_id).distinct()
+
+        for row in Session.execute(query.execution_options(yield_per=cls.BLOCKS_PER_CALL)):
+            yield bytes(row[0]), row[1], row[2], row[3]
+
+        for version in Session.scalars(
+                select(Version).filter(Version.storage_id == storage_id, Version.compact_block_map == True,
+                                       Version.id > min_version_id)).all():
+            for entries in version._iter_chunks():
+                for uid_left, uid_right, checksum, size, valid in entries.values():
+                    if valid and checksum is not None:
+                        yield unhexlify(checksum), uid_left, uid_right, size
+
+    @classmethod
+    def storage_checksums_count(cls, storage_id: int) -> int:
+        return Session.scalar(select(func.count()).select_from(BlockChecksum).filter(
+            BlockChecksum.storage_id == storage_id))
+
+    @classmethod
+    def max_id(cls) -> int:
+        return Session.scalar(select(func.coalesce(func.max(Version.id), 0)))
 
     @classmethod
     def find(cls,
              version_uid: VersionUid = None,
              volume: str = None,
              snapshot: str = None,
-             labels: List[Tuple[str, str]] = None) -> List['Version']:
+             labels: List[Tuple[str, str]] = None,
+             metadata_backup_base_uid: VersionUid = None) -> List['Version']:
         query = select(Version)
         if version_uid:
             query = query.filter(Version.uid == version_uid)
         if volume:
             query = query.filter(Version.volume == volume)
+        if metadata_backup_base_uid:
+            query = query.filter(Version.metadata_backup_base_uid == metadata_backup_base_uid)
         if snapshot:
             query = query.filterby(Version.snapshot == snapshot)
         if labels:
@@ -647,28 +1147,56 @@ class Version(Base, ReprMixIn):
         for _, storage_name, size in Session.execute(virtual).all():
             usage[storage_name]['virtual'] = int(size)  # func.sum()/SUM() returns type Decimal
 
-        sq_block, sq_storage, sq_version = aliased(Block), aliased(Storage), aliased(Version)
-        share_count_overall_sq = select(func.count('*')).select_from(sq_block).join(sq_version).join(
-            sq_storage).filter((Storage.id == sq_storage.id) & (Block.uid_left == sq_block.uid_left) &
-                               (Block.uid_right == sq_block.uid_right)).scalar_subquery()
-
+        # The reference count of a block UID is the number of blocks referencing it in all versions.
         # noinspection PyComparisonWithNone
         share_count_query = select(
-            Storage.id.label('storage_id'), Storage.name.label('storage_name'), Block.uid, Block.size.label('size'),
+            Storage.name.label('storage_name'), Block.uid_left, Block.uid_right, Block.size.label('size'),
             func.count('*').label('share_count_subset'),
-            share_count_overall_sq.label('share_count_overall')).select_from(Block).join(Version).join(Storage).filter(
-                (Block.uid_left != None) & (Block.uid_right != None)).group_by(Storage.id, Storage.name, Block.uid,
-                                                                               Block.size)
+            BlockReference.count.label('share_count_overall')).select_from(Block).join(Version).join(Storage).join(
+                BlockReference, (Block.uid_left == BlockReference.uid_left) &
+                (Block.uid_right == BlockReference.uid_right)).filter((Block.uid_left != None) &
+                                                                      (Block.uid_right != None)).group_by(
+                                                                          Storage.name, Block.uid_left, Block.uid_right,
+                                                                          Block.size, BlockReference.count)
 
         if version_ids is not None:
             share_count_query = share_count_query.filter(Block.version_id.in_(version_ids))
 
+        # The blocks of versions with a compact block map are counted here.
+        compact_share_counts: Dict[Tuple[str, int, int, int], int] = defaultdict(int)
+        compact_query = select(Version).filter(Version.compact_block_map == True)
+        if version_ids is not None:
+            compact_query = compact_query.filter(Version.id.in_(version_ids))
+        for version in Session.scalars(compact_query).all():
+            for entries in version._iter_chunks():
+                for uid_left, uid_right, _, size, _ in entries.values():
+                    if uid_left is not None and uid_right is not None:
+                        compact_share_counts[(version.storage.name, uid_left, uid_right, size)] += 1
+
+        share_counts = []
         for row in Session.execute(share_count_query).all():
-            if row.share_count_overall == row.share_count_subset:
-                usage[row.storage_name]['exclusive'] += row.size * row.share_count_subset
-                usage[row.storage_name]['deduplicated_exclusive'] += row.size
+            share_count_subset = row.share_count_subset + compact_share_counts.pop(
+                (row.storage_name, row.uid_left, row.uid_right, row.size), 0)
+            share_counts.append((row.storage_name, row.size, share_count_subset, row.share_count_overall))
+
+        compact_keys = list(compact_share_counts.keys())
+        for offset in range(0, len(compact_keys), BlockReference.UIDS_PER_CALL):
+            keys = compact_keys[offset:offset + BlockReference.UIDS_PER_CALL]
+            share_counts_overall = {
+                BlockUid(row.uid_left, row.uid_right): row.count for row in Session.execute(
+                    select(BlockReference.uid_left, BlockReference.uid_right, BlockReference.count).filter(
+                        BlockReference.uid.in_([BlockUid(key[1], key[2]) for key in keys])))
+            }
+            for key in keys:
+                share_counts.append(
+                    (key[0], key[3], compact_share_counts[key], share_counts_overall[BlockUid(key[1], key[2])]))
+
+        for storage_name, size, share_count_subset, share_count_overall in share_counts:
+            if share_count_overall == share_count_subset:
+                usage[storage_name]['exclusive'] += size * share_count_subset
+                usage[storage_name]['deduplicated_exclusive'] += size
             else:
-                usage[row.storage_name]['shared'] += row.size * row.share_count_subset
+                usage[storage_name]['shared'] += size * share_count_subset
 
         for storage_name, entry in usage.items():
             usage[storage_name]['sparse'] = usage[storage_name]['virtual'] - usage[storage_name]['exclusive'] - usage[storage_name]['shared']
@@ -766,6 +1294,12 @@ class DereferencedBlock(ReprMixIn):
         return self
 
 
+class SparseBlockRun(NamedTuple):
+    """ Consecutive sparse blocks of full block size starting at index idx. """
+    idx: int
+    count: int
+
+
 class Block(Base, ReprMixIn):
     __tablename__ = 'blocks'
 
@@ -788,11 +1322,56 @@ class Block(Base, ReprMixIn):
     __table_args__ = (
         sqlalchemy.PrimaryKeyConstraint('version_id', 'idx'),
         sqlalchemy.Index(None, 'uid_left', 'uid_right'),
-        # Maybe using an hash index on PostgeSQL might be beneficial in the future
-        # Index(None, 'checksum', postgresql_using='hash'),
-        sqlalchemy.Index(None, 'checksum', mysql_length=MAXIMUM_CHECKSUM_LENGTH),
     )
 
+    _COPY_COLUMNS = ('version_id', 'idx', 'uid_left', 'uid_right', 'checksum', 'size', 'valid')
+
+    @classmethod
+    def insert_many(cls, blocks: List[Dict[str, Any]]) -> None:
+        """ Inserts many blocks at once. With PostgreSQL the rows are streamed to the database server with COPY which
+        is much faster than a multi-row INSERT. Other database engines fall back to a bulk insert.
+        """
+        if not blocks:
+            return
+
+        connection = Session.connection()
+        if connection.dialect.name == 'postgresql' and connection.dialect.driver in ('psycopg2', 'psycopg'):
+            # COPY bypasses the ORM, so pending objects (like the version itself) need to be written out first
+            Session.flush()
+            statement = 'COPY {} ({}) FROM STDIN'.format(cls.__tablename__, ', '.join(cls._COPY_COLUMNS))
+            cursor = connection.connection.cursor()
+            try:
+                if connection.dialect.driver == 'psycopg2':
+                    cursor.copy_expert(statement, io.StringIO(''.join(cls._copy_row(block) for block in blocks)))
+                else:
+                    with cursor.copy(statement) as copy:
+                        for block in blocks:
+                            copy.write_row([
+                                unhexlify(block[column]) if column == 'checksum' and block[column] is not None else
+                                block[column] for column in cls._COPY_COLUMNS
+                            ])
+            finally:
+                cursor.close()
+        else:
+            Session.bulk_insert_mappings(Block, blocks)
+
+    @classmethod
+    def _copy_row(cls, block: Dict[str, Any]) -> str:
+        """ Encodes a block as a row of the text format of COPY. """
+        fields = []
+        for column in cls._COPY_COLUMNS:
+            value = block[column]
+            if value is None:
+                fields.append('\\N')
+            elif column == 'valid':
+                fields.append('t' if value else 'f')
+            elif column == 'checksum':
+                # bytea in hexadecimal format, the backslash of the \x prefix needs to be escaped
+                fields.append('\\\\x' + value)
+            else:
+                fields.append(str(int(value)))
+        return '\t'.join(fields) + '\n'
+
     def deref(self) -> DereferencedBlock:
         """ Dereference this to a namedtuple so that we can pass it around
         without any thread inconsistencies
@@ -807,78 +1386,425 @@ class Block(Base, ReprMixIn):
         )
 
 
-class DeletedBlock(Base, ReprMixIn):
-    __tablename__ = 'deleted_blocks'
+class BlockChunk(Base, ReprMixIn):
+    """ Stores the blocks of a version with a compact block map. Each chunk holds up to BLOCKS_PER_CHUNK consecutive
+    blocks packed into a binary string. Sparse blocks are omitted like they are in table blocks.
+    """
+    __tablename__ = 'block_chunks'
+
+    BLOCKS_PER_CHUNK = 1024
+    REPR_SQL_ATTR_SORT_FIRST = ['version_id', 'chunk_idx']
+
+    # Offset in chunk, uid_left, uid_right, size, flags and checksum length followed by the checksum itself
+    _ENTRY_STRUCT = struct.Struct('<HiiiBB')
+    _FLAG_VALID = 1
+    _FLAG_UID = 2
+
+    version_id = sqlalchemy.Column(sqlalchemy.Integer,
+                                   sqlalchemy.ForeignKey('versions.id', ondelete='CASCADE'),
+                                   nullable=False)
+    chunk_idx = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    data = sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=False)
+
+    __table_args__ = (sqlalchemy.PrimaryKeyConstraint('version_id', 'chunk_idx'),)
+
+    @classmethod
+    def encode(cls, entries: Dict[int, BlockEntry]) -> bytes:
+        data = bytearray()
+        for idx in sorted(entries.keys()):
+            uid_left, uid_right, checksum, size, valid = entries[idx]
+            flags = cls._FLAG_VALID if valid else 0
+            if uid_left is not None and uid_right is not None:
+                flags |= cls._FLAG_UID
+            checksum_bytes = unhexlify(checksum) if checksum is not None else b''
+            data += cls._ENTRY_STRUCT.pack(idx % cls.BLOCKS_PER_CHUNK, uid_left or 0, uid_right or 0, size, flags,
+                                           len(checksum_bytes))
+            data += checksum_bytes
+        return bytes(data)
+
+    @classmethod
+    def decode(cls, chunk_idx: int, data: bytes) -> Dict[int, BlockEntry]:
+        entries: Dict[int, BlockEntry] = {}
+        offset = 0
+        while offset < len(data):
+            offset_in_chunk, uid_left, uid_right, size, flags, checksum_length = cls._ENTRY_STRUCT.unpack_from(
+                data, offset)
+            offset += cls._ENTRY_STRUCT.size
+            checksum = hexlify(data[offset:offset + checksum_length]).decode('ascii') if checksum_length else None
+            offset += checksum_length
+            if not flags & cls._FLAG_UID:
+                uid_left, uid_right = None, None
+            entries[chunk_idx * cls.BLOCKS_PER_CHUNK + offset_in_chunk] = (uid_left, uid_right, checksum, size,
+                                                                           bool(flags & cls._FLAG_VALID))
+        return entries
+
+
+class BlockWriter(ReprMixIn):
+    """ Buffers block updates of a version and writes them to the database in bulk. The semantics are the same as
+    calling Version.set_block for each block. The buffer is flushed when it holds max_rows updates or when the oldest
+    buffered update is older than max_age seconds. close() must be called to write out the remaining updates.
+    """
+
+    def __init__(self, version: Version, *, max_rows: int = 1000, max_age: float = 5) -> None:
+        self._version = version
+        self._version_id = version.id
+        self._storage_id = version.storage_id
+        self._block_size = version.block_size
+        self._max_rows = max_rows
+        self._max_age = max_age
+        self._buffer: Dict[int, Tuple[BlockUid, Optional[str], int, bool]] = {}
+        self._buffer_start = 0.0
+        self._resume_idx: Optional[int] = None
+
+        dialect_name = Session.get_bind().dialect.name
+        if dialect_name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        elif dialect_name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            upsert = None
+
+        if upsert is not None:
+            statement = upsert(Block.__table__)
+            self._upsert_statement = statement.on_conflict_do_update(
+                index_elements=['version_id', 'idx'],
+                set_={
+                    column: statement.excluded[column] for column in ('uid_left', 'uid_right', 'checksum', 'size', 'valid')
+                })
+        else:
+            self._upsert_statement = None
+
+    def set_block(self, *, idx: int, block_uid: BlockUid, checksum: Optional[str], size: int, valid: bool) -> None:
+        if not self._buffer:
+            self._buffer_start = time.monotonic()
+        self._buffer[idx] = (block_uid, checksum, size, valid)
+        if len(self._buffer) >= self._max_rows or time.monotonic() - self._buffer_start > self._max_age:
+            self.flush()
+
+    def set_resume_idx(self, idx: int) -> None:
+        """ Records that all blocks before idx have been passed to set_block. The index is written to the version
+        together with the next flush.
+        """
+        self._resume_idx = idx
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+
+        checksums = {
+            checksum: (block_uid, size)
+            for block_uid, checksum, size, valid in self._buffer.values()
+            if valid and block_uid and checksum is not None
+        }
+
+        if self._version.compact_block_map:
+            try:
+                BlockChecksum.add(self._storage_id, checksums)
+                self._version._update_chunks({
+                    idx: self._version._block_entry(block_uid=block_uid, checksum=checksum, size=size, valid=valid)
+                    for idx, (block_uid, checksum, size, valid) in self._buffer.items()
+                })
+                if self._resume_idx is not None:
+                    self._version.resume_idx = self._resume_idx
+                self._buffer = {}
+                Version._timed_commit()
+            except:
+                Session.rollback()
+                raise
+            return
+
+        sparse_idxs = []
+        rows = []
+        for idx, (block_uid, checksum, size, valid) in self._buffer.items():
+            if not block_uid and size == self._block_size:
+                # Block should be fully sparse -> Delete it if it is present.
+                sparse_idxs.append(idx)
+            else:
+                rows.append({
+                    'version_id': self._version_id,
+                    'idx': idx,
+                    'uid_left': block_uid.left,
+                    'uid_right': block_uid.right,
+                    'checksum': checksum,
+                    'size': size,
+                    'valid': valid,
+                })
+
+        try:
+            # Decrement the reference counts of the block UIDs which are replaced
+            idxs = list(self._buffer.keys())
+            deltas: Dict[BlockUid, int] = defaultdict(int)
+            for offset in range(0, len(idxs), 500):
+                # noinspection PyComparisonWithNone
+                for row in Session.execute(
+                        select(Block.uid_left,
+                               Block.uid_right).filter(Block.version_id == self._version_id,
+                                                       Block.idx.in_(idxs[offset:offset + 500]), Block.uid_left != None,
+                                                       Block.uid_right != None)):
+                    deltas[BlockUid(row.uid_left, row.uid_right)] -= 1
+            for block_uid, _, _, _ in self._buffer.values():
+                if block_uid:
+                    deltas[block_uid] += 1
+            BlockReference.adjust(self._storage_id, deltas)
+            BlockChecksum.add(self._storage_id, checksums)
+
+            if self._upsert_statement is None and rows:
+                # Generic fallback for dialects without support for INSERT ... ON CONFLICT
+                sparse_idxs.extend(row['idx'] for row in rows)
+            # Older SQLite versions only support up to 999 parameters per statement
+            for offset in range(0, len(sparse_idxs), 500):
+                Session.execute(
+                    delete(Block).filter(Block.version_id == self._version_id,
+                                         Block.idx.in_(sparse_idxs[offset:offset + 500])).execution_options(
+                                             synchronize_session=False))
+            if rows:
+                Session.execute(
+                    self._upsert_statement if self._upsert_statement is not None else Block.__table__.insert(), rows)
+            if self._resume_idx is not None:
+                self._version.resume_idx = self._resume_idx
+            self._buffer = {}
+            Version._timed_commit()
+        except:
+            Session.rollback()
+            raise
+
+    def close(self) -> None:
+        self.flush()
+
+
+class BlockReference(Base, ReprMixIn):
+    """ Counts the references to each block UID by the blocks of all versions. Block UIDs whose reference count
+    dropped to zero are removed from the storage by cleanup after a grace period.
+    """
+    __tablename__ = 'block_references'
 
     REPR_SQL_ATTR_SORT_FIRST = ['storage_id', 'uid']
+    # Older SQLite versions only support up to 999 parameters per statement
+    UIDS_PER_CALL = 250
 
-    date = sqlalchemy.Column("date", BenjiDateTime, nullable=False)
-    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True, nullable=False)
+    uid_left = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    uid_right = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
     storage_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('storages.id'), nullable=False)
     # Force loading of storage so that the attribute can be accessed even when there is no associated session anymore.
     storage = sqlalchemy.orm.relationship('Storage', lazy='joined')
-
-    uid_left = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
-    uid_right = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # Date and time when the reference count dropped to zero, NULL as long as the block UID is referenced
+    date = sqlalchemy.Column(BenjiDateTime, nullable=True)
 
     uid = sqlalchemy.orm.composite(BlockUid, uid_left, uid_right, comparator_factory=BlockUidComparator)
-    __table_args__ = (sqlalchemy.Index(None, 'uid_left', 'uid_right'),)
+    __table_args__ = (
+        sqlalchemy.PrimaryKeyConstraint('uid_left', 'uid_right'),
+        sqlalchemy.Index(None, 'date'),
+    )
+
+    @classmethod
+    def adjust(cls, storage_id: int, deltas: Dict[BlockUid, int]) -> None:
+        """ Adds the deltas to the reference counts of the given block UIDs. This doesn't commit, so that the reference
+        counts are changed in the same transaction as the blocks themselves.
+        """
+        table = cls.__table__
+        now = datetime.datetime.utcnow()
+        # The date is set first as MySQL evaluates the assignments from left to right.
+        new_count = table.c.count + sqlalchemy.bindparam('b_delta')
+        update_statement = update(table).filter(
+            table.c.uid_left == sqlalchemy.bindparam('b_uid_left'),
+            table.c.uid_right == sqlalchemy.bindparam('b_uid_right')).ordered_values(
+                (table.c.date,
+                 sqlalchemy.case((new_count > 0, sqlalchemy.null()),
+                                 else_=sqlalchemy.bindparam('b_date', type_=BenjiDateTime))),
+                (table.c.count, new_count),
+            )
+
+        uids = [uid for uid, delta in deltas.items() if uid and delta != 0]
+        for offset in range(0, len(uids), cls.UIDS_PER_CALL):
+            uids_chunk = uids[offset:offset + cls.UIDS_PER_CALL]
+            present_uids = {
+                BlockUid(row.uid_left, row.uid_right)
+                for row in Session.execute(select(cls.uid_left, cls.uid_right).filter(cls.uid.in_(uids_chunk)))
+            }
+            updates = [{
+                'b_uid_left': uid.left,
+                'b_uid_right': uid.right,
+                'b_delta': deltas[uid],
+                'b_date': now,
+            } for uid in uids_chunk if uid in present_uids]
+            inserts = [{
+                'uid_left': uid.left,
+                'uid_right': uid.right,
+                'storage_id': storage_id,
+                'count': max(deltas[uid], 0),
+                'date': None if deltas[uid] > 0 else now,
+            } for uid in uids_chunk if uid not in present_uids]
+            if updates:
+                Session.execute(update_statement, updates)
+            if inserts:
+                Session.execute(table.insert(), inserts)
+
+    @classmethod
+    def adjust_by_version(cls, version_id: int, direction: int) -> None:
+        """ Increments (direction 1) or decrements (direction -1) the reference counts of all block UIDs referenced
+        by the given version with a single statement. This requires that all of these block UIDs already have a
+        reference count. This doesn't commit either.
+        """
+        table = cls.__table__
+        # noinspection PyComparisonWithNone
+        references = select(Block.uid_left, Block.uid_right, func.count().label('count')).filter(
+            Block.version_id == version_id, Block.uid_left != None,
+            Block.uid_right != None).group_by(Block.uid_left, Block.uid_right).subquery()
+        new_count = table.c.count + direction * references.c.count
+        # The date is set first as MySQL evaluates the assignments from left to right.
+        Session.execute(
+            update(table).where(table.c.uid_left == references.c.uid_left,
+                                table.c.uid_right == references.c.uid_right).ordered_values(
+                                    (table.c.date,
+                                     sqlalchemy.case((new_count > 0, sqlalchemy.null()),
+                                                     else_=sqlalchemy.literal(datetime.datetime.utcnow(),
+                                                                              BenjiDateTime))),
+                                    (table.c.count, new_count),
+                                ).execution_options(synchronize_session=False))
 
     @classmethod
     def get_unused_block_uids(cls, dt: int = 3600) -> Iterator[Dict[str, Set[BlockUid]]]:
-        rounds = 0
-        false_positives_count = 0
         hit_list_count = 0
         cut_off_date = datetime.datetime.utcnow() - datetime.timedelta(seconds=dt)
         while True:
-            # http://stackoverflow.com/questions/7389759/memory-efficient-built-in-sqlalchemy-iterator-generator
-            delete_candidates = Session.scalars(select(DeletedBlock) \
-                .filter(DeletedBlock.date < cut_off_date) \
-                .limit(250)) \
+            # The date is only set for unreferenced block UIDs, so this is a range scan over the index on date.
+            delete_candidates = Session.scalars(select(BlockReference) \
+                .filter(BlockReference.date < cut_off_date, BlockReference.count <= 0) \
+                .limit(cls.UIDS_PER_CALL) \
+                .with_for_update()) \
                 .all()
             if not delete_candidates:
                 break
 
-            false_positives = set()
             hit_list: Dict[str, Set[BlockUid]] = defaultdict(set)
             for candidate in delete_candidates:
-                rounds += 1
-                if rounds % 1000 == 0:
-                    logger.info("Cleanup: {} false positives, {} data deletions.".format(
-                        false_positives_count,
-                        hit_list_count,
-                    ))
-
-                block = Session.scalar(select(Block) \
-                    .filter(Block.uid == candidate.uid) \
-                    .limit(1))
-                if block:
-                    false_positives.add(candidate.uid)
-                    false_positives_count += 1
-                else:
-                    hit_list[candidate.storage.name].add(candidate.uid)
-                    hit_list_count += 1
-
-            if false_positives:
-                logger.debug("Cleanup: Removing {} false positive from delete candidates.".format(len(false_positives)))
-                Session.execute(
-                    delete(DeletedBlock).filter(
-                        DeletedBlock.uid.in_(false_positives)).execution_options(synchronize_session=False))
-
-            if hit_list:
-                for uids in hit_list.values():
-                    Session.execute(delete(DeletedBlock).filter(DeletedBlock.uid.in_(uids)),
-                                    execution_options={"synchronize_session": False})
-                yield hit_list
-                # We expect that the caller has handled all the blocks returned so far, so we can call commit after
-                # the yield to keep the transaction small.
-                Session.commit()
+                hit_list[candidate.storage.name].add(candidate.uid)
+            hit_list_count += len(delete_candidates)
+
+            Session.execute(delete(BlockReference).filter(
+                BlockReference.uid.in_([candidate.uid for candidate in delete_candidates])),
+                            execution_options={"synchronize_session": False})
+            BlockChecksum.remove([candidate.uid for candidate in delete_candidates])
+            yield hit_list
+            # We expect that the caller has handled all the blocks returned so far, so we can call commit after
+            # the yield to keep the transaction small.
+            Session.commit()
+            logger.debug("Cleanup: {} data deletions so far.".format(hit_list_count))
 
         Session.commit()
-        logger.info("Cleanup finished: {} false positives, {} data deletions.".format(
-            false_positives_count,
-            hit_list_count,
-        ))
+        logger.info("Cleanup finished: {} data deletions.".format(hit_list_count))
+
+
+class BlockChunkUidLeft(Base, ReprMixIn):
+    """ Records the left parts of the block UIDs referenced by each version with a compact block map. The left part
+    is the id of the version which has written a block, so this finds the versions which might reference a block
+    without decoding the chunks of all of them. Entries are never removed while the version exists, so it might not
+    reference any blocks with this left part anymore.
+    """
+    __tablename__ = 'block_chunk_uid_lefts'
+
+    REPR_SQL_ATTR_SORT_FIRST = ['uid_left', 'version_id']
+
+    uid_left = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    version_id = sqlalchemy.Column(sqlalchemy.Integer,
+                                   sqlalchemy.ForeignKey('versions.id', ondelete='CASCADE'),
+                                   nullable=False)
+
+    __table_args__ = (sqlalchemy.PrimaryKeyConstraint('uid_left', 'version_id'),)
+
+    @classmethod
+    def add(cls, version_id: int, uid_lefts: Set[int]) -> None:
+        """ Records the given left parts of block UIDs for a version. This doesn't commit. """
+        if not uid_lefts:
+            return
+        # Only the process holding the lock on a version changes its blocks.
+        present_uid_lefts = set(
+            Session.scalars(
+                select(cls.uid_left).filter(cls.version_id == version_id, cls.uid_left.in_(list(uid_lefts)))).all())
+        rows = [{
+            'uid_left': uid_left,
+            'version_id': version_id
+        } for uid_left in sorted(uid_lefts) if uid_left not in present_uid_lefts]
+        if rows:
+            Session.execute(cls.__table__.insert(), rows)
+
+
+class BlockChecksum(Base, ReprMixIn):
+    """ Maps the checksums of the valid blocks of a storage to their block UIDs for deduplication. There is one row
+    per block UID, so this table doesn't grow with the number of versions referencing a block. Different block UIDs
+    with the same data are all recorded, so the data can still be found when some of them are removed.
+    """
+    __tablename__ = 'block_checksums'
+
+    REPR_SQL_ATTR_SORT_FIRST = ['storage_id', 'checksum']
+    # Older SQLite versions only support up to 999 parameters per statement
+    CHECKSUMS_PER_CALL = 250
+
+    storage_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('storages.id'), nullable=False)
+    checksum = sqlalchemy.Column(ChecksumType(Block.MAXIMUM_CHECKSUM_LENGTH), nullable=False)
+    uid_left = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    uid_right = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    uid = sqlalchemy.orm.composite(BlockUid, uid_left, uid_right, comparator_factory=BlockUidComparator)
+    __table_args__ = (
+        sqlalchemy.PrimaryKeyConstraint('storage_id', 'checksum', 'uid_left', 'uid_right'),
+        sqlalchemy.Index(None, 'uid_left', 'uid_right'),
+        # Lookups are always by equality, the B-tree of the primary key is used on other databases.
+        sqlalchemy.Index(None, 'checksum', postgresql_using='hash').ddl_if(
+            dialect='postgresql'),
+    )
+
+    @classmethod
+    def add(cls, storage_id: int, checksums: Dict[str, Tuple[BlockUid, int]]) -> None:
+        """ Records the block UID and size for each checksum. Entries for other block UIDs with the same checksum are
+        kept. This doesn't commit.
+        """
+        table = cls.__table__
+        dialect_name = Session.get_bind().dialect.name
+        if dialect_name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        elif dialect_name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            upsert = None
+
+        if upsert is not None:
+            # Concurrent backups might record the same block at the same time.
+            upsert_statement = upsert(table).on_conflict_do_nothing(
+                index_elements=['storage_id', 'checksum', 'uid_left', 'uid_right'])
+        else:
+            upsert_statement = None
+
+        checksums_list = list(checksums.items())
+        for offset in range(0, len(checksums_list), cls.CHECKSUMS_PER_CALL):
+            checksums_chunk = checksums_list[offset:offset + cls.CHECKSUMS_PER_CALL]
+            present = {(row.checksum, BlockUid(row.uid_left, row.uid_right)) for row in Session.execute(
+                select(cls.checksum, cls.uid_left, cls.uid_right).filter(
+                    cls.storage_id == storage_id, cls.checksum.in_([checksum for checksum, _ in checksums_chunk])))}
+            rows = [{
+                'storage_id': storage_id,
+                'checksum': checksum,
+                'uid_left': block_uid.left,
+                'uid_right': block_uid.right,
+                'size': size,
+            } for checksum, (block_uid, size) in checksums_chunk if (checksum, block_uid) not in present]
+            if not rows:
+                continue
+            Session.execute(upsert_statement if upsert_statement is not None else table.insert(), rows)
+
+    @classmethod
+    def remove(cls, uids: Sequence[BlockUid]) -> None:
+        """ Removes the checksums of the given block UIDs. This doesn't commit. """
+        for offset in range(0, len(uids), cls.CHECKSUMS_PER_CALL):
+            Session.execute(
+                delete(cls).filter(cls.uid.in_(uids[offset:offset + cls.CHECKSUMS_PER_CALL])).execution_options(
+                    synchronize_session=False))
 
 
 class Lock(Base, ReprMixIn):
@@ -928,8 +1854,270 @@ class Storage(Base, ReprMixIn):
             raise
 
 
+class MetadataFormat(enum.Enum):
+    json = 1
+    binary = 2
+
+    def __str__(self):
+        return self.name
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise UsageError('Compressed metadata requires the Python module zstandard.') from None
+    return zstandard
+
+
+class _BinaryMetadata:
+    """ Compact binary format of metadata exports.
+
+    The file starts with a header consisting of the magic number and a flags byte. If FLAG_ZSTD is set the remainder
+    of the file is a single zstd frame. The (uncompressed) remainder is a sequence of records. Each record consists of
+    a one byte record type and the length of the payload followed by the payload itself:
+
+    - RECORD_METADATA: JSON object with the metadata version, always the first record
+    - RECORD_VERSION: JSON object with all attributes of a version except for the blocks
+    - RECORD_BLOCKS: A batch of blocks of the preceding version in columnar layout, see encode_blocks
+    - RECORD_END: Marks the end of the export, it has no payload
+    """
+
+    MAGIC = b'BNJM'
+    FLAG_ZSTD = 1
+
+    RECORD_METADATA = b'M'
+    RECORD_VERSION = b'V'
+    RECORD_BLOCKS = b'B'
+    RECORD_END = b'E'
+
+    _HEADER_STRUCT = struct.Struct('<4sB')
+    _RECORD_STRUCT = struct.Struct('<cI')
+    _COUNT_STRUCT = struct.Struct('<I')
+
+    _BLOCK_FLAG_VALID = 1
+    _BLOCK_FLAG_UID = 2
+
+    @classmethod
+    def detect(cls, f: BinaryIO) -> bool:
+        peek = getattr(f, 'peek', None)
+        if peek is not None:
+            data = peek(len(cls.MAGIC))[:len(cls.MAGIC)]
+        else:
+            position = f.tell()
+            data = f.read(len(cls.MAGIC))
+            f.seek(position)
+        return data == cls.MAGIC
+
+    @classmethod
+    def encode_blocks(cls, blocks: Sequence['DereferencedBlock']) -> bytes:
+        """ Encodes the blocks column by column: the number of blocks followed by the indexes, the left and right
+        parts of the UIDs, the sizes, the flags, the lengths of the checksums and the raw checksums.
+        """
+        count = len(blocks)
+        checksums = [unhexlify(block.checksum) if block.checksum is not None else b'' for block in blocks]
+        return b''.join((
+            cls._COUNT_STRUCT.pack(count),
+            struct.pack('<{}q'.format(count), *(block.idx for block in blocks)),
+            struct.pack('<{}q'.format(count), *(block.uid.left or 0 for block in blocks)),
+            struct.pack('<{}q'.format(count), *(block.uid.right or 0 for block in blocks)),
+            struct.pack('<{}q'.format(count), *(block.size for block in blocks)),
+            bytes((cls._BLOCK_FLAG_VALID if block.valid else 0) | (cls._BLOCK_FLAG_UID if block.uid else 0)
+                  for block in blocks),
+            bytes(len(checksum) for checksum in checksums),
+            *checksums,
+        ))
+
+    @classmethod
+    def decode_blocks(cls, version_id: int, data: bytes) -> List[Dict[str, Any]]:
+        try:
+            count, = cls._COUNT_STRUCT.unpack_from(data, 0)
+            offset = cls._COUNT_STRUCT.size
+            columns = []
+            for _ in range(4):
+                columns.append(struct.unpack_from('<{}q'.format(count), data, offset))
+                offset += count * 8
+            idxs, uids_left, uids_right, sizes = columns
+            flags = data[offset:offset + count]
+            offset += count
+            checksum_lengths = data[offset:offset + count]
+            offset += count
+        except struct.error:
+            raise InputDataError('Import file is invalid.') from None
+        if len(checksum_lengths) != count or offset + sum(checksum_lengths) != len(data):
+            raise InputDataError('Import file is invalid.')
+
+        blocks: List[Dict[str, Any]] = []
+        for i in range(count):
+            has_uid = flags[i] & cls._BLOCK_FLAG_UID
+            checksum_length = checksum_lengths[i]
+            blocks.append({
+                'version_id': version_id,
+                'idx': idxs[i],
+                'uid_left': uids_left[i] if has_uid else None,
+                'uid_right': uids_right[i] if has_uid else None,
+                'checksum': hexlify(data[offset:offset + checksum_length]).decode('ascii') if checksum_length else None,
+                'size': sizes[i],
+                'valid': bool(flags[i] & cls._BLOCK_FLAG_VALID),
+            })
+            offset += checksum_length
+        return blocks
+
+
+class _BinaryMetadataWriter(_BinaryMetadata):
+
+    def __init__(self, f: BinaryIO, compress: bool = False) -> None:
+        self._f = f
+        self._compressor = _zstandard().ZstdCompressor().compressobj() if compress else None
+        f.write(self._HEADER_STRUCT.pack(self.MAGIC, self.FLAG_ZSTD if compress else 0))
+
+    def _write(self, data: bytes) -> None:
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self._f.write(data)
+
+    def write_record(self, record_type: bytes, payload: bytes = b'') -> None:
+        self._write(self._RECORD_STRUCT.pack(record_type, len(payload)))
+        self._write(payload)
+
+    def close(self) -> None:
+        self.write_record(self.RECORD_END)
+        if self._compressor is not None:
+            self._f.write(self._compressor.flush())
+
+
+class _BinaryMetadataReader(_BinaryMetadata):
+
+    _READ_SIZE = 64 * 1024
+
+    def __init__(self, f: BinaryIO) -> None:
+        self._f = f
+        header = f.read(self._HEADER_STRUCT.size)
+        if len(header) != self._HEADER_STRUCT.size:
+            raise InputDataError('Import file is invalid.')
+        magic, flags = self._HEADER_STRUCT.unpack(header)
+        if magic != self.MAGIC:
+            raise InputDataError('Import file is invalid.')
+        self._decompressor = _zstandard().ZstdDecompressor().decompressobj() if flags & self.FLAG_ZSTD else None
+        self._buffer = bytearray()
+
+    def _read(self, length: int) -> bytes:
+        while len(self._buffer) < length:
+            data = self._f.read(self._READ_SIZE)
+            if not data:
+                raise InputDataError('Import file is truncated.')
+            if self._decompressor is not None:
+                try:
+                    data = self._decompressor.decompress(data)
+                except Exception as exception:
+                    raise InputDataError('Import file is invalid.') from exception
+            self._buffer += data
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def read_record(self) -> Tuple[bytes, bytes]:
+        record_type, length = self._RECORD_STRUCT.unpack(self._read(self._RECORD_STRUCT.size))
+        return record_type, self._read(length)
+
+
+class _JSONStreamReader:
+    """ Reads a JSON document incrementally. Objects and arrays can be iterated element by element, all other values
+    are decoded as a whole. Only the part of the document which is currently being decoded is kept in memory.
+    """
+
+    _READ_SIZE = 64 * 1024
+    _WHITESPACE = ' \t\n\r'
+
+    def __init__(self, f: TextIO) -> None:
+        self._f = f
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        data = self._f.read(self._READ_SIZE)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+        return True
+
+    def peek(self) -> str:
+        """ Skips whitespace and returns the next character or an empty string at the end of the document. """
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in self._WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer) or not self._fill():
+                return self._buffer[self._position:self._position + 1]
+
+    def _expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise InputDataError('Import file is invalid.')
+        self._position += 1
+
+    def read_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise InputDataError('Import file is invalid.')
+                continue
+            # A number at the end of the buffer might continue in the next chunk.
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._position = end
+            return value
+
+    def iter_object(self) -> Iterator[str]:
+        """ Yields the keys of an object. The caller has to consume each value before continuing the iteration. """
+        self._expect('{')
+        if self.peek() == '}':
+            self._position += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise InputDataError('Import file is invalid.')
+            self._expect(':')
+            yield key
+            char = self.peek()
+            self._position += 1
+            if char == '}':
+                return
+            elif char != ',':
+                raise InputDataError('Import file is invalid.')
+
+    def iter_array(self) -> Iterator[None]:
+        """ Yields once for each element of an array. The caller has to consume each element before continuing. """
+        self._expect('[')
+        if self.peek() == ']':
+            self._position += 1
+            return
+        while True:
+            yield None
+            char = self.peek()
+            self._position += 1
+            if char == ']':
+                return
+            elif char != ',':
+                raise InputDataError('Import file is invalid.')
+
+    def read_rest(self) -> None:
+        if self.peek() != '':
+            raise InputDataError('Import file has trailing data.')
+
+
 class _Database(ReprMixIn):
     _METADATA_VERSION_KEY = 'metadata_version'
+    _BASE_VERSION_UID_KEY = 'base_version_uid'
     _METADATA_VERSION_REGEX = r'\d+\.\d+\.\d+'
 
     def __init__(self) -> None:
@@ -948,12 +2136,34 @@ class _Database(ReprMixIn):
                 # due to concurrent database access less likely.
                 connect_args['timeout'] = 3 * Version.TIMED_COMMIT_INTERVAL
             self._engine = sqlalchemy.create_engine(url, connect_args=connect_args, pool_pre_ping=True)
+            if url.startswith('sqlite:'):
+                self._configure_sqlite(config)
         else:
             logger.info('Running with ephemeral in-memory database.')
             self._engine = sqlalchemy.create_engine('sqlite://')
 
         self._config = config
 
+    def _configure_sqlite(self, config: Config) -> None:
+        # In WAL mode readers don't block the writer and the writer doesn't block readers, so that concurrent
+        # invocations of Benji (like ls or nbd during a backup) interfere much less with each other. WAL mode is
+        # persistent and is stored in the database file.
+        pragmas = [
+            ('journal_mode', config.get('sqlite.journalMode', types=str)),
+            ('synchronous', config.get('sqlite.synchronous', types=str)),
+            ('cache_size', config.get('sqlite.cacheSize', types=int)),
+            ('mmap_size', config.get('sqlite.mmapSize', types=int)),
+            ('temp_store', config.get('sqlite.tempStore', types=str)),
+        ]
+
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+            cursor.close()
+
+        sqlalchemy.event.listen(self._engine, 'connect', set_pragmas)
+
     @staticmethod
     def _alembic_config():
         return alembic_config_Config(
@@ -1044,6 +2254,9 @@ class _Database(ReprMixIn):
         ignore_fields.append(((Block,), ('uid_left', 'uid_right')))
         # Ignore storage_id as we export the storage attribute
         ignore_fields.append(((Version), ('storage_id')))
+        # The block map layout, the progress of a backup and the base of the metadata backup are properties of the
+        # database only
+        ignore_fields.append(((Version,), ('compact_block_map', 'resume_idx', 'metadata_backup_base_uid')))
 
         # Source: https://stackoverflow.com/questions/21663800/python-make-a-list-generator-json-serializable/46841935#46841935
         # Alternative: simplejson with iterable_as_array=True
@@ -1089,6 +2302,11 @@ class _Database(ReprMixIn):
                 if isinstance(obj, BlockUid):
                     return {'left': obj.left, 'right': obj.right}
 
+                if isinstance(obj, DereferencedBlock):
+                    # Same fields in the same order as for Block
+                    return OrderedDict((('uid', obj.uid), ('idx', obj.idx), ('size', obj.size), ('valid', obj.valid),
+                                        ('checksum', obj.checksum)))
+
                 if isinstance(obj, VersionStatus):
                     return obj.name
 
@@ -1141,7 +2359,7 @@ class _Database(ReprMixIn):
                                 break
 
                         if not ignore:
-                            fields['blocks'] = obj.blocks
+                            fields['blocks'] = obj.dereferenced_blocks
 
                     return fields
 
@@ -1174,40 +2392,353 @@ class _Database(ReprMixIn):
             indent=None if compact else 2,
         )
 
-    def export(self, version_uids: Sequence[VersionUid], f: TextIO):
-        self.export_any({'versions': [Version.get_by_uid(version_uid) for version_uid in version_uids]},
-                        f,
-                        compact=True)
+    def export(self,
+               version_uids: Sequence[VersionUid],
+               f: Union[TextIO, BinaryIO],
+               metadata_format: MetadataFormat = MetadataFormat.json,
+               compress: bool = False) -> None:
+        if metadata_format == MetadataFormat.binary:
+            encoder = self._new_benji_encoder(None, [((Version,), ('blocks',))])
+            versions = [Version.get_by_uid(version_uid) for version_uid in version_uids]
+            self._export_binary([(encoder().default(version), version.dereferenced_blocks) for version in versions],
+                                cast(BinaryIO, f),
+                                compress=compress)
+        else:
+            if compress:
+                raise UsageError('Compression is only supported for the binary metadata format.')
+            self.export_any({'versions': [Version.get_by_uid(version_uid) for version_uid in version_uids]},
+                            cast(TextIO, f),
+                            compact=True)
+
+    def export_delta(self,
+                     version_uid: VersionUid,
+                     base_version_uid: VersionUid,
+                     f: Union[TextIO, BinaryIO],
+                     metadata_format: MetadataFormat = MetadataFormat.json,
+                     compress: bool = False) -> None:
+        """ Exports a version with only the blocks which differ from the base version. The version carries the
+        additional attribute base_version_uid. Such an export can't be imported on its own, it needs to be merged
+        with the export of the base version first.
+        """
+        version = Version.get_by_uid(version_uid)
+        base_version = Version.get_by_uid(base_version_uid)
+        encoder = self._new_benji_encoder(None, [((Version,), ('blocks',))])
+        version_fields = encoder().default(version)
+        version_fields[self._BASE_VERSION_UID_KEY] = base_version.uid
+        blocks = self._changed_blocks(version, base_version)
+
+        if metadata_format == MetadataFormat.binary:
+            self._export_binary([(version_fields, blocks)], cast(BinaryIO, f), compress=compress)
+        else:
+            if compress:
+                raise UsageError('Compression is only supported for the binary metadata format.')
+            version_fields['blocks'] = blocks
+            self.export_any({'versions': [version_fields]}, cast(TextIO, f), compact=True)
 
-    def import_(self, f: TextIO) -> List[VersionUid]:
-        try:
-            json_input = json.load(f)
-        except Exception as exception:
-            raise InputDataError('Import file is invalid.') from exception
-        if json_input is None:
-            raise InputDataError('Import file is empty.')
+    @staticmethod
+    def _changed_blocks(version: Version, base_version: Version) -> Iterator[DereferencedBlock]:
+        # Invalid blocks are always included as the metadata backup of the base version might predate the
+        # invalidation.
+        base_blocks = base_version.dereferenced_blocks
+        base_block = next(base_blocks, None)
+        for block in version.dereferenced_blocks:
+            while base_block is not None and base_block.idx < block.idx:
+                base_block = next(base_blocks, None)
+            if (base_block is None or base_block.idx != block.idx or not block.valid or not base_block.valid or
+                    block.uid != base_block.uid or block.checksum != base_block.checksum or
+                    block.size != base_block.size):
+                yield block
 
-        if self._METADATA_VERSION_KEY not in json_input:
-            raise InputDataError('Import file is missing required key "{}".'.format(self._METADATA_VERSION_KEY))
-        metadata_version = json_input[self._METADATA_VERSION_KEY]
-        if not re.fullmatch(self._METADATA_VERSION_REGEX, metadata_version):
+    def _export_binary(self, versions: Sequence[Tuple[Dict[str, Any], Iterable[DereferencedBlock]]], f: BinaryIO,
+                       compress: bool) -> None:
+        writer = _BinaryMetadataWriter(f, compress=compress)
+        writer.write_record(
+            _BinaryMetadata.RECORD_METADATA,
+            json.dumps({
+                self._METADATA_VERSION_KEY: str(VERSIONS.database_metadata.current)
+            }).encode('utf-8'))
+        # The blocks are written separately in columnar layout
+        encoder = self._new_benji_encoder(None, [((Version,), ('blocks',))])
+        for version_fields, version_blocks in versions:
+            writer.write_record(_BinaryMetadata.RECORD_VERSION,
+                                json.dumps(version_fields, cls=encoder, separators=(',', ':')).encode('utf-8'))
+            blocks: List[DereferencedBlock] = []
+            for block in version_blocks:
+                blocks.append(block)
+                if len(blocks) >= Version.BLOCKS_PER_CALL:
+                    writer.write_record(_BinaryMetadata.RECORD_BLOCKS, _BinaryMetadata.encode_blocks(blocks))
+                    blocks = []
+            if blocks:
+                writer.write_record(_BinaryMetadata.RECORD_BLOCKS, _BinaryMetadata.encode_blocks(blocks))
+        writer.close()
+
+    def _check_metadata_version(self, metadata_version: Any) -> semantic_version.Version:
+        if not isinstance(metadata_version, str) or not re.fullmatch(self._METADATA_VERSION_REGEX, metadata_version):
             raise InputDataError('Import file has an invalid vesion of "{}".'.format(metadata_version))
 
         metadata_version_obj = semantic_version.Version(metadata_version)
         if metadata_version_obj not in VERSIONS.database_metadata.supported:
             raise InputDataError('Unsupported metadata version (1): "{}".'.format(str(metadata_version_obj)))
+        return metadata_version_obj
 
-        import_method_name = 'import_v{}'.format(metadata_version_obj.major)
-        import_method = getattr(self, import_method_name, None)
-        if import_method is None or not callable(import_method):
-            raise InputDataError('Unsupported metadata version (2): "{}".'.format(metadata_version))
+    def import_(self, f: Union[TextIO, BinaryIO], metadata_format: MetadataFormat = None) -> List[VersionUid]:
+        """ Imports the versions from a metadata export. Text streams are always read as JSON. The format of binary
+        streams is detected automatically unless metadata_format is specified.
+        """
+        text_f = None
+        if isinstance(f, io.TextIOBase):
+            if metadata_format == MetadataFormat.binary:
+                raise UsageError('Binary metadata cannot be imported from a text stream.')
+            metadata_format = MetadataFormat.json
+        else:
+            if metadata_format is None:
+                binary = _BinaryMetadata.detect(cast(BinaryIO, f))
+                metadata_format = MetadataFormat.binary if binary else MetadataFormat.json
+            if metadata_format == MetadataFormat.json:
+                text_f = io.TextIOWrapper(cast(BinaryIO, f), encoding='utf-8')
 
         try:
-            version_uids = import_method(metadata_version_obj, json_input)
+            if metadata_format == MetadataFormat.binary:
+                version_uids = self._import_binary(cast(BinaryIO, f))
+            else:
+                version_uids = self._import_json(text_f if text_f is not None else cast(TextIO, f))
             Session.commit()
         except:
             Session.rollback()
             raise
+        finally:
+            # Don't close the underlying binary stream
+            if text_f is not None:
+                text_f.detach()
+
+        return version_uids
+
+    def _open_binary(self, f: BinaryIO) -> _BinaryMetadataReader:
+        reader = _BinaryMetadataReader(f)
+
+        record_type, payload = reader.read_record()
+        if record_type != _BinaryMetadata.RECORD_METADATA:
+            raise InputDataError('Import file is missing the metadata version.')
+        metadata = self._decode_binary_record(payload)
+        if self._METADATA_VERSION_KEY not in metadata:
+            raise InputDataError('Import file is missing required key "{}".'.format(self._METADATA_VERSION_KEY))
+        metadata_version_obj = self._check_metadata_version(metadata[self._METADATA_VERSION_KEY])
+        if metadata_version_obj.major != 3:
+            raise InputDataError('Unsupported metadata version (2): "{}".'.format(str(metadata_version_obj)))
+
+        return reader
+
+    @staticmethod
+    def _decode_binary_record(payload: bytes) -> Dict[str, Any]:
+        try:
+            record = json.loads(payload)
+        except ValueError as exception:
+            raise InputDataError('Import file is invalid.') from exception
+        if not isinstance(record, dict):
+            raise InputDataError('Import file is invalid.')
+        return record
+
+    def import_version(self, version_dict: Dict[str, Any], blocks: Iterable[DereferencedBlock]) -> VersionUid:
+        """ Imports a single version as returned by read_versions. """
+        try:
+            version = self._import_v3_version(version_dict)
+            batch: List[Dict[str, Any]] = []
+            for block in blocks:
+                batch.append({
+                    'version_id': version.id,
+                    'idx': block.idx,
+                    'uid_left': block.uid.left,
+                    'uid_right': block.uid.right,
+                    'checksum': block.checksum,
+                    'size': block.size,
+                    'valid': block.valid,
+                })
+                if len(batch) >= Version.BLOCKS_PER_CALL:
+                    self._import_v3_blocks_batch(version, batch)
+                    batch = []
+            self._import_v3_blocks_batch(version, batch)
+            Session.commit()
+        except:
+            Session.rollback()
+            raise
+
+        return version.uid
+
+    def _import_binary(self, f: BinaryIO) -> List[VersionUid]:
+        reader = self._open_binary(f)
+
+        version_uids: List[VersionUid] = []
+        version = None
+        while True:
+            record_type, payload = reader.read_record()
+            if record_type == _BinaryMetadata.RECORD_VERSION:
+                version = self._import_v3_version(self._decode_binary_record(payload))
+                version_uids.append(version.uid)
+            elif record_type == _BinaryMetadata.RECORD_BLOCKS:
+                if version is None:
+                    raise InputDataError('Import file contains blocks without a version.')
+                self._import_v3_blocks_batch(version, _BinaryMetadata.decode_blocks(version.id, payload))
+            elif record_type == _BinaryMetadata.RECORD_END:
+                break
+            else:
+                raise InputDataError('Import file contains an unknown record type {!r}.'.format(record_type))
+
+        return version_uids
+
+    def read_versions(self,
+                      f: Union[TextIO, BinaryIO]) -> Iterator[Tuple[Dict[str, Any], Iterator[DereferencedBlock]]]:
+        """ Reads the versions of a metadata export without importing them into the database. For each version the
+        attributes except for the blocks and an iterator over its blocks are returned. The blocks are read
+        incrementally, so the iterator needs to be consumed before the next version is requested. Only exports of the
+        current major metadata version with the blocks of each version at the end are supported. Versions exported
+        with export_delta have the additional attribute base_version_uid and only contain the changed blocks.
+        """
+        if not isinstance(f, io.TextIOBase) and _BinaryMetadata.detect(cast(BinaryIO, f)):
+            yield from self._read_versions_binary(cast(BinaryIO, f))
+        elif isinstance(f, io.TextIOBase):
+            yield from self._read_versions_json(cast(TextIO, f))
+        else:
+            text_f = io.TextIOWrapper(cast(BinaryIO, f), encoding='utf-8')
+            try:
+                yield from self._read_versions_json(text_f)
+            finally:
+                text_f.detach()
+
+    def _check_read_version(self, version_dict: Dict[str, Any]) -> None:
+        for attribute in ('uid', 'size', 'block_size', 'storage'):
+            if attribute not in version_dict:
+                raise InputDataError('Missing attribute {} in version {}.'.format(attribute, version_dict.get('uid')))
+        # Will raise ValueError when invalid
+        version_dict['uid'] = VersionUid(version_dict['uid'])
+        if self._BASE_VERSION_UID_KEY in version_dict:
+            version_dict[self._BASE_VERSION_UID_KEY] = VersionUid(version_dict[self._BASE_VERSION_UID_KEY])
+
+    def _read_versions_binary(self, f: BinaryIO) -> Iterator[Tuple[Dict[str, Any], Iterator[DereferencedBlock]]]:
+        reader = self._open_binary(f)
+
+        record_type, payload = reader.read_record()
+        while record_type != _BinaryMetadata.RECORD_END:
+            if record_type != _BinaryMetadata.RECORD_VERSION:
+                raise InputDataError('Import file contains an unexpected record type {!r}.'.format(record_type))
+            version_dict = self._decode_binary_record(payload)
+            self._check_read_version(version_dict)
+
+            def blocks() -> Iterator[DereferencedBlock]:
+                nonlocal record_type, payload
+                while True:
+                    record_type, payload = reader.read_record()
+                    if record_type != _BinaryMetadata.RECORD_BLOCKS:
+                        return
+                    for block in _BinaryMetadata.decode_blocks(0, payload):
+                        yield DereferencedBlock(BlockUid(block['uid_left'], block['uid_right']), 0, block['idx'],
+                                                block['checksum'], block['size'], block['valid'])
+
+            blocks_iterator = blocks()
+            yield version_dict, blocks_iterator
+            # Skip all blocks the caller didn't consume, this also reads the next record
+            for _ in blocks_iterator:
+                pass
+
+    def _read_versions_json(self, f: TextIO) -> Iterator[Tuple[Dict[str, Any], Iterator[DereferencedBlock]]]:
+        reader = _JSONStreamReader(f)
+        if reader.peek() != '{':
+            raise InputDataError('Import file is invalid.')
+
+        metadata_version_seen = False
+        for key in reader.iter_object():
+            if key == self._METADATA_VERSION_KEY:
+                metadata_version_obj = self._check_metadata_version(reader.read_value())
+                if metadata_version_obj.major != 3:
+                    raise InputDataError('Unsupported metadata version (2): "{}".'.format(str(metadata_version_obj)))
+                metadata_version_seen = True
+            elif key == 'versions':
+                if not metadata_version_seen:
+                    raise InputDataError('Import file is missing required key "{}".'.format(
+                        self._METADATA_VERSION_KEY))
+                for _ in reader.iter_array():
+                    if reader.peek() != '{':
+                        raise InputDataError('Wrong data type for versions list element.')
+
+                    version_dict: Dict[str, Any] = {}
+                    blocks_seen = False
+                    for version_key in reader.iter_object():
+                        if version_key != 'blocks':
+                            version_dict[version_key] = reader.read_value()
+                            continue
+
+                        if reader.peek() != '[':
+                            raise InputDataError('Wrong data type for blocks in version {}.'.format(
+                                version_dict.get('uid')))
+                        self._check_read_version(version_dict)
+                        blocks_iterator = (self._dereferenced_block(version_dict['uid'], reader.read_value())
+                                           for _ in reader.iter_array())
+                        yield version_dict, blocks_iterator
+                        # Skip all blocks the caller didn't consume
+                        for _ in blocks_iterator:
+                            pass
+                        blocks_seen = True
+
+                    if not blocks_seen:
+                        raise InputDataError('Missing attribute blocks in version {}.'.format(version_dict.get('uid')))
+            else:
+                reader.read_value()
+        reader.read_rest()
+
+    @staticmethod
+    def _check_block_dict(version_uid: VersionUid, block_dict: Any) -> None:
+        if not isinstance(block_dict, dict):
+            raise InputDataError('Wrong data type for block list element in version {}.'.format(version_uid))
+        for attribute in ('idx', 'uid', 'size', 'valid', 'checksum'):
+            if attribute not in block_dict:
+                raise InputDataError('Missing attribute {} in block of version {}.'.format(attribute, version_uid))
+
+        if not isinstance(block_dict['uid'], dict):
+            raise InputDataError('Wrong data type for block uid in version {}.'.format(version_uid))
+        for attribute in ('left', 'right'):
+            if attribute not in block_dict['uid']:
+                raise InputDataError('Missing attribute {} in block uid of version {}.'.format(attribute, version_uid))
+
+    def _dereferenced_block(self, version_uid: VersionUid, block_dict: Any) -> DereferencedBlock:
+        self._check_block_dict(version_uid, block_dict)
+        return DereferencedBlock(BlockUid(block_dict['uid']['left'], block_dict['uid']['right']), 0, block_dict['idx'],
+                                 block_dict['checksum'], block_dict['size'], block_dict['valid'])
+
+    def _import_json(self, f: TextIO) -> List[VersionUid]:
+        """ Exports written by Benji list the metadata version first and the blocks of each version last, these are
+        imported incrementally with constant memory usage. All other documents are decoded as a whole.
+        """
+        reader = _JSONStreamReader(f)
+        if reader.peek() == '':
+            raise InputDataError('Import file is empty.')
+        if reader.peek() != '{':
+            raise InputDataError('Import file is invalid.')
+
+        json_input: Dict[str, Any] = {}
+        version_uids = None
+        for key in reader.iter_object():
+            if key == 'versions' and self._METADATA_VERSION_KEY in json_input:
+                metadata_version_obj = self._check_metadata_version(json_input[self._METADATA_VERSION_KEY])
+                if metadata_version_obj.major == 3:
+                    version_uids = self._import_v3_stream(reader)
+                    continue
+            json_input[key] = reader.read_value()
+        reader.read_rest()
+
+        if version_uids is None:
+            if self._METADATA_VERSION_KEY not in json_input:
+                raise InputDataError('Import file is missing required key "{}".'.format(self._METADATA_VERSION_KEY))
+            metadata_version_obj = self._check_metadata_version(json_input[self._METADATA_VERSION_KEY])
+
+            import_method_name = 'import_v{}'.format(metadata_version_obj.major)
+            import_method = getattr(self, import_method_name, None)
+            if import_method is None or not callable(import_method):
+                raise InputDataError('Unsupported metadata version (2): "{}".'.format(
+                    json_input[self._METADATA_VERSION_KEY]))
+
+            if 'versions' not in json_input or not isinstance(json_input['versions'], list):
+                raise InputDataError('Import file is missing the list of versions.')
+
+            version_uids = import_method(metadata_version_obj, json_input)
 
         return version_uids
 
@@ -1286,129 +2817,176 @@ class _Database(ReprMixIn):
         # The v3 format doesn't list sparse blocks anymore.
         return self.import_v3(metadata_version, json_input)
 
-    @staticmethod
-    def import_v3(metadata_version: semantic_version.Version, json_input: Dict) -> List[VersionUid]:
+    def import_v3(self, metadata_version: semantic_version.Version, json_input: Dict) -> List[VersionUid]:
         version_uids: List[VersionUid] = []
         for version_dict in json_input['versions']:
             if not isinstance(version_dict, dict):
                 raise InputDataError('Wrong data type for versions list element.')
 
-            if 'uid' not in version_dict:
-                raise InputDataError('Missing attribute uid in version.')
-
-            # Will raise ValueError when invalid
-            version_uid = VersionUid(version_dict['uid'])
-
-            attributes_to_check = [
-                'date',
-                'volume',
-                'snapshot',
-                'size',
-                'storage',
-                'block_size',
-                'status',
-                'protected',
-                'blocks',
-                'labels',
-                'bytes_read',
-                'bytes_written',
-                'bytes_deduplicated',
-                'bytes_sparse',
-                'duration',
-            ]
-
-            for attribute in attributes_to_check:
-                if attribute not in version_dict:
-                    raise InputDataError('Missing attribute {} in version {}.'.format(attribute, version_uid))
+            version = self._import_v3_version(version_dict)
+            if 'blocks' not in version_dict:
+                raise InputDataError('Missing attribute blocks in version {}.'.format(version.uid))
+            if not isinstance(version_dict['blocks'], list):
+                raise InputDataError('Wrong data type for blocks in version {}.'.format(version.uid))
+            self._import_v3_blocks(version, version_dict['blocks'])
 
-            if not InputValidation.is_volume_name(version_dict['volume']):
-                raise InputDataError('Volume name {} in version {} is invalid.'.format(
-                    version_dict['name'], version_uid))
+            version_uids.append(version.uid)
 
-            if not InputValidation.is_snapshot_name(version_dict['snapshot']):
-                raise InputDataError('Snapshot name {} in version {} is invalid.'.format(
-                    version_dict['snapshot'], version_uid))
+        return version_uids
 
-            if not isinstance(version_dict['labels'], dict):
-                raise InputDataError('Wrong data type for labels in version {}.'.format(version_uid))
+    def _import_v3_stream(self, reader: _JSONStreamReader) -> List[VersionUid]:
+        """ Imports the list of versions incrementally. The blocks are imported in batches as they are read. """
+        version_uids: List[VersionUid] = []
+        for _ in reader.iter_array():
+            if reader.peek() != '{':
+                raise InputDataError('Wrong data type for versions list element.')
 
-            if not isinstance(version_dict['blocks'], list):
-                raise InputDataError('Wrong data type for blocks in version {}.'.format(version_uid))
+            version_dict: Dict[str, Any] = {}
+            version = None
+            for key in reader.iter_object():
+                if key != 'blocks':
+                    version_dict[key] = reader.read_value()
+                    continue
 
-            for name, value in version_dict['labels'].items():
-                if not InputValidation.is_label_name(name):
-                    raise InputDataError('Label name {} in version {} is invalid.'.format(name, version_uid))
-                if not InputValidation.is_label_value(value):
-                    raise InputDataError('Label value {} in version {} is invalid.'.format(value, version_uid))
+                if reader.peek() != '[':
+                    raise InputDataError('Wrong data type for blocks in version {}.'.format(version_dict.get('uid')))
+                # All other attributes precede the blocks in exports written by Benji.
+                version = self._import_v3_version(version_dict)
+                self._import_v3_blocks(version, (reader.read_value() for _ in reader.iter_array()))
 
-            for block_dict in version_dict['blocks']:
-                if not isinstance(block_dict, dict):
-                    raise InputDataError('Wrong data type for block list element in version {}.'.format(version_uid))
-                for attribute in ['uid', 'size', 'valid', 'checksum']:
-                    if attribute not in block_dict:
-                        raise InputDataError('Missing attribute {} in block list in version {}.'.format(
-                            attribute, version_uid))
+            if version is None:
+                raise InputDataError('Missing attribute blocks in version {}.'.format(version_dict.get('uid')))
+            version_uids.append(version.uid)
 
-            storage = Session.scalars(select(Storage).filter(Storage.name == version_dict['storage'])).one_or_none()
-            if not storage:
-                raise InputDataError('Storage {} is not defined in the configuration.'.format(version_dict['storage']))
+        return version_uids
 
-            try:
-                Version.get_by_uid(VersionUid(version_dict['uid']))
-            except KeyError:
-                pass  # does not exist
-            else:
-                raise FileExistsError('Version {} already exists and so cannot be imported.'.format(version_uid))
-
-            version = Version(
-                uid=version_uid,
-                date=datetime.datetime.strptime(version_dict['date'], '%Y-%m-%dT%H:%M:%S.%fZ'),
-                volume=version_dict['volume'],
-                snapshot=version_dict['snapshot'],
-                size=version_dict['size'],
-                storage=storage,
-                block_size=version_dict['block_size'],
-                status=VersionStatus[version_dict['status']],
-                protected=version_dict['protected'],
-                bytes_read=version_dict['bytes_read'],
-                bytes_written=version_dict['bytes_written'],
-                bytes_deduplicated=version_dict['bytes_deduplicated'],
-                bytes_sparse=version_dict['bytes_sparse'],
-                duration=version_dict['duration'],
-            )
-            Session.add(version)
-            Session.flush()
+    def _import_v3_version(self, version_dict: Dict[str, Any]) -> Version:
+        """ Validates the attributes of a version except the blocks and creates the version and its labels. """
+        if 'uid' not in version_dict:
+            raise InputDataError('Missing attribute uid in version.')
+
+        # Will raise ValueError when invalid
+        version_uid = VersionUid(version_dict['uid'])
+
+        if self._BASE_VERSION_UID_KEY in version_dict:
+            raise InputDataError('Version {} only contains the changes relative to version {}, it needs to be restored '
+                                 'with metadata-restore.'.format(version_uid, version_dict[self._BASE_VERSION_UID_KEY]))
+
+        attributes_to_check = [
+            'date',
+            'volume',
+            'snapshot',
+            'size',
+            'storage',
+            'block_size',
+            'status',
+            'protected',
+            'labels',
+            'bytes_read',
+            'bytes_written',
+            'bytes_deduplicated',
+            'bytes_sparse',
+            'duration',
+        ]
+
+        for attribute in attributes_to_check:
+            if attribute not in version_dict:
+                raise InputDataError('Missing attribute {} in version {}.'.format(attribute, version_uid))
+
+        if not InputValidation.is_volume_name(version_dict['volume']):
+            raise InputDataError('Volume name {} in version {} is invalid.'.format(version_dict['volume'], version_uid))
+
+        if not InputValidation.is_snapshot_name(version_dict['snapshot']):
+            raise InputDataError('Snapshot name {} in version {} is invalid.'.format(
+                version_dict['snapshot'], version_uid))
+
+        if not isinstance(version_dict['labels'], dict):
+            raise InputDataError('Wrong data type for labels in version {}.'.format(version_uid))
+
+        for name, value in version_dict['labels'].items():
+            if not InputValidation.is_label_name(name):
+                raise InputDataError('Label name {} in version {} is invalid.'.format(name, version_uid))
+            if not InputValidation.is_label_value(value):
+                raise InputDataError('Label value {} in version {} is invalid.'.format(value, version_uid))
+
+        storage = Session.scalars(select(Storage).filter(Storage.name == version_dict['storage'])).one_or_none()
+        if not storage:
+            raise InputDataError('Storage {} is not defined in the configuration.'.format(version_dict['storage']))
 
-            assert isinstance(version_dict['blocks'], list)
-            for block_dict in version_dict['blocks']:
-                assert isinstance(block_dict, dict)
-                for attribute in ('idx', 'uid', 'size', 'checksum'):
-                    if attribute not in block_dict:
-                        raise InputDataError('Missing attribute {} in block of version {}.'.format(
-                            attribute, version_uid))
+        try:
+            Version.get_by_uid(version_uid)
+        except KeyError:
+            pass  # does not exist
+        else:
+            raise FileExistsError('Version {} already exists and so cannot be imported.'.format(version_uid))
 
-                assert isinstance(block_dict['uid'], dict)
-                for attribute in ('left', 'right'):
-                    if attribute not in block_dict['uid']:
-                        raise InputDataError('Missing attribute {} in block uid of version {}.'.format(
-                            attribute, version_uid))
+        version = Version(
+            uid=version_uid,
+            date=datetime.datetime.strptime(version_dict['date'], '%Y-%m-%dT%H:%M:%S.%fZ'),
+            volume=version_dict['volume'],
+            snapshot=version_dict['snapshot'],
+            size=version_dict['size'],
+            storage=storage,
+            block_size=version_dict['block_size'],
+            status=VersionStatus[version_dict['status']],
+            protected=version_dict['protected'],
+            bytes_read=version_dict['bytes_read'],
+            bytes_written=version_dict['bytes_written'],
+            bytes_deduplicated=version_dict['bytes_deduplicated'],
+            bytes_sparse=version_dict['bytes_sparse'],
+            duration=version_dict['duration'],
+            compact_block_map=self._config.get('compactBlockMaps', types=bool) if self._config is not None else False,
+        )
+        Session.add(version)
+        Session.flush()
 
-                block_dict['version_id'] = version.id
-                block_uid = BlockUid(block_dict['uid']['left'], block_dict['uid']['right'])
-                block_dict['uid_left'] = block_uid.left
-                block_dict['uid_right'] = block_uid.right
-                del block_dict['uid']
-            Session.bulk_insert_mappings(Block, version_dict['blocks'])
+        labels: List[Dict[str, Any]] = []
+        for name, value in version_dict['labels'].items():
+            labels.append({'version_id': version.id, 'name': name, 'value': value})
+        Session.bulk_insert_mappings(Label, labels)
 
-            labels: List[Dict[str, Any]] = []
-            assert isinstance(version_dict['labels'], dict)
-            for name, value in version_dict['labels'].items():
-                labels.append({'version_id': version.id, 'name': name, 'value': value})
-            Session.bulk_insert_mappings(Label, labels)
+        return version
 
-            version_uids.append(version_uid)
+    def _import_v3_blocks(self, version: Version, block_dicts: Iterable[Any]) -> None:
+        """ Validates and inserts the blocks of a version in batches. """
+        batch: List[Dict[str, Any]] = []
+        for block_dict in block_dicts:
+            self._check_block_dict(version.uid, block_dict)
+            batch.append({
+                'version_id': version.id,
+                'idx': block_dict['idx'],
+                'uid_left': block_dict['uid']['left'],
+                'uid_right': block_dict['uid']['right'],
+                'checksum': block_dict['checksum'],
+                'size': block_dict['size'],
+                'valid': block_dict['valid'],
+            })
+            if len(batch) >= Version.BLOCKS_PER_CALL:
+                self._import_v3_blocks_batch(version, batch)
+                batch = []
+        self._import_v3_blocks_batch(version, batch)
 
-        return version_uids
+    @staticmethod
+    def _import_v3_blocks_batch(version: Version, blocks: List[Dict[str, Any]]) -> None:
+        if version.compact_block_map:
+            version._update_chunks({
+                block['idx']: (block['uid_left'], block['uid_right'], block['checksum'], block['size'], block['valid'])
+                for block in blocks
+            })
+        else:
+            deltas: Dict[BlockUid, int] = defaultdict(int)
+            for block in blocks:
+                if block['uid_left'] is not None and block['uid_right'] is not None:
+                    deltas[BlockUid(block['uid_left'], block['uid_right'])] += 1
+            Block.insert_many(blocks)
+            BlockReference.adjust(version.storage_id, deltas)
+        BlockChecksum.add(
+            version.storage_id, {
+                block['checksum']: (BlockUid(block['uid_left'], block['uid_right']), block['size'])
+                for block in blocks
+                if block['valid'] and block['checksum'] is not None and block['uid_left'] is not None and
+                block['uid_right'] is not None
+            })
 
     def close(self):
         Session.commit()
@@ -0,0 +1,240 @@
+import hashlib
+import math
+import os
+import struct
+import time
+from abc import ABCMeta, abstractmethod
+from binascii import unhexlify
+from typing import Dict, Optional, Tuple, Set
+
+from benji.database import BlockUid, Version
+from benji.exception import ConfigurationError
+from benji.logging import logger
+from benji.repr import ReprMixIn
+
+
+class DedupIndex(ReprMixIn, metaclass=ABCMeta):
+    """ Maps block checksums to existing blocks of one storage. It is used during backup to find blocks which
+    already exist in the storage without issuing a database query for each block read.
+    """
+
+    def __init__(self, *, version: Version) -> None:
+        self._version = version
+
+    @abstractmethod
+    def lookup(self, checksum: str) -> Optional[Tuple[BlockUid, int]]:
+        """ Returns a tuple of (block uid, size) of an existing block with the given checksum or None. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, checksum: str, block_uid: BlockUid, size: int) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def create(*, config, version: Version) -> 'DedupIndex':
+        mode = config.get('dedupIndex.mode', types=str)
+        if mode == 'database':
+            return DatabaseDedupIndex(version=version)
+        elif mode == 'memory':
+            return MemoryDedupIndex(version=version)
+        elif mode == 'bloomFilter':
+            return BloomFilterDedupIndex(version=version,
+                                         directory=config.get('dedupIndex.bloomFilter.directory', types=str),
+                                         false_positive_rate=config.get('dedupIndex.bloomFilter.falsePositiveRate',
+                                                                        types=float))
+        else:
+            raise ConfigurationError('Unknown deduplication index mode {}.'.format(mode))
+
+
+class DatabaseDedupIndex(DedupIndex):
+    """ Queries the database for every lookup. """
+
+    def __init__(self, *, version: Version) -> None:
+        super().__init__(version=version)
+        # Block updates are written to the database in batches, so blocks written during this backup are kept
+        # here until then.
+        self._added: Dict[str, Tuple[BlockUid, int]] = {}
+
+    def lookup(self, checksum: str) -> Optional[Tuple[BlockUid, int]]:
+        if checksum in self._added:
+            return self._added[checksum]
+
+        existing_block = self._version.get_block_by_checksum(checksum)
+        if existing_block:
+            return existing_block.uid, existing_block.size
+        else:
+            return None
+
+    def add(self, checksum: str, block_uid: BlockUid, size: int) -> None:
+        self._added[checksum] = (block_uid, size)
+
+
+class MemoryDedupIndex(DedupIndex):
+    """ Loads the checksums of all valid blocks of a storage into memory once. The block uid and the size are packed
+    into a single integer to keep the memory footprint per entry small.
+    """
+
+    # Blocks of versions removed after the index has been loaded are still part of it. Cleanup only removes blocks
+    # after a grace period (one hour by default), so hits are confirmed by a database query once the index is older
+    # than this (in seconds).
+    _TRUST_PERIOD = 1800
+
+    def __init__(self, *, version: Version) -> None:
+        super().__init__(version=version)
+        self._loaded = time.monotonic()
+        self._index: Dict[bytes, int] = {}
+        # Blocks written during this backup aren't necessarily in the database yet, but they can always be trusted.
+        self._added: Set[bytes] = set()
+        index = self._index
+        for checksum, uid_left, uid_right, size in Version.storage_checksums(version.storage_id):
+            index[checksum] = self._pack(uid_left, uid_right, size)
+        logger.debug('Loaded {} checksums into deduplication index.'.format(len(index)))
+
+    @staticmethod
+    def _pack(uid_left: int, uid_right: int, size: int) -> int:
+        return (uid_left << 96) | (uid_right << 32) | size
+
+    def lookup(self, checksum: str) -> Optional[Tuple[BlockUid, int]]:
+        binary_checksum = unhexlify(checksum)
+        value = self._index.get(binary_checksum)
+        if value is None:
+            return None
+
+        if binary_checksum not in self._added and time.monotonic() - self._loaded > self._TRUST_PERIOD:
+            existing_block = self._version.get_block_by_checksum(checksum)
+            if existing_block:
+                return existing_block.uid, existing_block.size
+            else:
+                del self._index[binary_checksum]
+                return None
+
+        return BlockUid(value >> 96, (value >> 32) & 0xffffffffffffffff), value & 0xffffffff
+
+    def add(self, checksum: str, block_uid: BlockUid, size: int) -> None:
+        binary_checksum = unhexlify(checksum)
+        self._index[binary_checksum] = self._pack(block_uid.left, block_uid.right, size)
+        self._added.add(binary_checksum)
+
+
+class BloomFilterDedupIndex(DedupIndex):
+    """ Keeps a Bloom filter of the checksums of all valid blocks of a storage. The filter is persisted to local disk
+    and updated incrementally with the blocks of versions created since it was last saved. Lookups only hit the
+    database when the filter reports a possible match. Removed blocks are never removed from the filter, they only
+    lead to an unnecessary database query. Blocks missing from the filter only lead to a missed deduplication.
+    The filter is saved as covering the versions which existed when it was loaded, blocks of versions created
+    concurrently are added on the next load.
+    """
+
+    _HEADER = struct.Struct('!8sQQQQI')
+    _MAGIC = b'BENJIBF1'
+    _MINIMUM_CAPACITY = 1 << 20
+
+    def __init__(self, *, version: Version, directory: str, false_positive_rate: float) -> None:
+        super().__init__(version=version)
+        self._storage_id = version.storage_id
+        self._filename = os.path.join(directory, 'storage-{}.bloom'.format(self._storage_id))
+        self._false_positive_rate = false_positive_rate
+        # Block updates are written to the database in batches, so blocks written during this backup are kept
+        # here until then.
+        self._added: Dict[str, Tuple[BlockUid, int]] = {}
+
+        # Versions with a higher id than this are added to the filter on the next load.
+        self._max_version_id = Version.max_id()
+        if not self._load():
+            self._build()
+
+    def _setup(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._bits_count = int(math.ceil(-capacity * math.log(self._false_positive_rate) / (math.log(2)**2)))
+        self._hashes_count = max(1, int(round(self._bits_count / capacity * math.log(2))))
+        self._bits = bytearray((self._bits_count + 7) // 8)
+        self._count = 0
+
+    def _load(self) -> bool:
+        try:
+            with open(self._filename, 'rb') as f:
+                header = f.read(self._HEADER.size)
+                if len(header) != self._HEADER.size:
+                    raise ValueError('Short header.')
+                magic, storage_id, max_version_id, count, capacity, hashes_count = self._HEADER.unpack(header)
+                if magic != self._MAGIC or storage_id != self._storage_id:
+                    raise ValueError('Invalid magic or storage id.')
+                self._setup(capacity)
+                if hashes_count != self._hashes_count:
+                    raise ValueError('Parameters have changed.')
+                bits = f.read()
+                if len(bits) != len(self._bits):
+                    raise ValueError('Invalid length.')
+                self._bits = bytearray(bits)
+                self._count = count
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error) as exception:
+            logger.warning('Ignoring deduplication Bloom filter {}: {}'.format(self._filename, str(exception)))
+            return False
+
+        added = 0
+        for checksum, _, _, _ in Version.storage_checksums(self._storage_id, min_version_id=max_version_id):
+            self._add(checksum)
+            added += 1
+        if self._count > self._capacity:
+            logger.info('Deduplication Bloom filter {} is over capacity, rebuilding it.'.format(self._filename))
+            return False
+        logger.debug('Loaded deduplication Bloom filter {}, added {} checksums.'.format(self._filename, added))
+        return True
+
+    def _build(self) -> None:
+        self._setup(max(2 * Version.storage_checksums_count(self._storage_id), self._MINIMUM_CAPACITY))
+        for checksum, _, _, _ in Version.storage_checksums(self._storage_id):
+            self._add(checksum)
+        logger.debug('Built deduplication Bloom filter with {} checksums.'.format(self._count))
+
+    def _positions(self, checksum: bytes):
+        digest = hashlib.blake2b(checksum, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self._hashes_count):
+            yield (h1 + i * h2) % self._bits_count
+
+    def _add(self, checksum: bytes) -> None:
+        bits = self._bits
+        new = False
+        for position in self._positions(checksum):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                bits[position >> 3] |= 1 << (position & 7)
+                new = True
+        # Checksums which are already part of the filter (or look like they are) don't use up any capacity.
+        if new:
+            self._count += 1
+
+    def lookup(self, checksum: str) -> Optional[Tuple[BlockUid, int]]:
+        if checksum in self._added:
+            return self._added[checksum]
+
+        bits = self._bits
+        for position in self._positions(unhexlify(checksum)):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return None
+
+        existing_block = self._version.get_block_by_checksum(checksum)
+        if existing_block:
+            return existing_block.uid, existing_block.size
+        else:
+            return None
+
+    def add(self, checksum: str, block_uid: BlockUid, size: int) -> None:
+        self._add(unhexlify(checksum))
+        self._added[checksum] = (block_uid, size)
+
+    def close(self) -> None:
+        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+        temporary_filename = '{}.{}.tmp'.format(self._filename, os.getpid())
+        with open(temporary_filename, 'wb') as f:
+            f.write(
+                self._HEADER.pack(self._MAGIC, self._storage_id, self._max_version_id, self._count, self._capacity,
+                                  self._hashes_count))
+            f.write(self._bits)
+        os.replace(temporary_filename, self._filename)
@@ -86,3 +86,9 @@ class IOBase(ReprMixIn, metaclass=ABCMeta):
     @abstractmethod
     def write_get_completed(self, timeout: Optional[int] = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
         raise NotImplementedError
+
+    def write_zeroes(self, offset: int, length: int) -> bool:
+        """ Zeroes a range of the target synchronously, for example by discarding it. Returns False if this isn't
+        supported, in which case the caller needs to write the zeroes itself. I/O modules can override this.
+        """
+        return False
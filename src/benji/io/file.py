@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
+import ctypes
+import fcntl
 import os
+import stat
+import struct
 import threading
 import time
-from typing import Tuple, Optional, Union, Iterator
+from typing import Tuple, Optional, Union, Iterator, Callable
 
 from benji.config import ConfigDict, Config
 from benji.database import DereferencedBlock, Block
@@ -13,8 +17,27 @@ from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 
 
+def _libc_fallocate() -> Optional[Callable[[int, int, int, int], int]]:
+    """ Returns fallocate() from libc as it isn't exposed by the os module, None when libc doesn't provide it. """
+    libc = ctypes.CDLL(None, use_errno=True)
+    # fallocate64() takes 64 bit offsets on 32 bit platforms, too. On 64 bit platforms both are the same.
+    function = getattr(libc, 'fallocate64', None) or getattr(libc, 'fallocate', None)
+    if function is not None:
+        function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        function.restype = ctypes.c_int
+    return function
+
+
+_fallocate = _libc_fallocate()
+
+
 class IO(IOBase):
 
+    # See linux/falloc.h and linux/fs.h
+    _FALLOC_FL_KEEP_SIZE = 0x01
+    _FALLOC_FL_PUNCH_HOLE = 0x02
+    _BLKZEROOUT = 0x127f
+
     def __init__(self, *, config: Config, name: str, module_configuration: ConfigDict, url: str,
                  block_size: int) -> None:
         super().__init__(config=config,
@@ -31,6 +54,7 @@ class IO(IOBase):
         self._simultaneous_writes = config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
         self._read_executor: Optional[JobExecutor] = None
         self._write_executor: Optional[JobExecutor] = None
+        self._new_file = False
 
     def open_r(self) -> None:
         self._read_executor = JobExecutor(name='IO-Read', workers=self._simultaneous_reads, blocking_submit=False)
@@ -49,6 +73,7 @@ class IO(IOBase):
             with open(self.parsed_url.path, 'wb') as f:
                 f.seek(size - 1)
                 f.write(b'\0')
+            self._new_file = True
 
     def close(self) -> None:
         if self._read_executor:
@@ -138,3 +163,27 @@ class IO(IOBase):
     def write_get_completed(self, timeout: Optional[int] = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
         assert self._write_executor is not None
         return self._write_executor.get_completed(timeout=timeout)
+
+    def write_zeroes(self, offset: int, length: int) -> bool:
+        # A newly created file is sparse and reads back as zeroes already
+        if self._new_file:
+            return True
+
+        with open(self.parsed_url.path, 'rb+') as f:
+            if stat.S_ISBLK(os.fstat(f.fileno()).st_mode):
+                try:
+                    fcntl.ioctl(f.fileno(), self._BLKZEROOUT, struct.pack('QQ', offset, length))
+                except OSError as exception:
+                    logger.debug('Zeroing range of {} failed: {}.'.format(self.url, exception))
+                    return False
+                return True
+
+            if _fallocate is None:
+                return False
+            result = _fallocate(f.fileno(), self._FALLOC_FL_PUNCH_HOLE | self._FALLOC_FL_KEEP_SIZE, offset, length)
+            if result != 0:
+                logger.debug('Punching hole into {} failed: {}.'.format(self.url, os.strerror(ctypes.get_errno())))
+                return False
+
+        logger.debug('Zeroed {} bytes at offset {} of {}.'.format(length, offset, self.url))
+        return True
@@ -61,6 +61,7 @@ class IO(IOBase):
         self._cluster.connect()
         # create a bitwise or'd list of the configured features
         self._new_image_features = 0
+        self._new_image = False
         for feature in config.get_from_dict(module_configuration, 'newImageFeatures', types=list):
             try:
                 self._new_image_features = self._new_image_features | getattr(rbd, feature)
@@ -75,6 +76,8 @@ class IO(IOBase):
         self._simultaneous_writes = config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
         self._read_executor: Optional[JobExecutor] = None
         self._write_executor: Optional[JobExecutor] = None
+        # Image handle used for zeroing ranges, it is opened on first use
+        self._write_zeroes_image = None
 
     def open_r(self) -> None:
         self._read_executor = JobExecutor(name='IO-Read', workers=self._simultaneous_reads, blocking_submit=False)
@@ -122,6 +125,7 @@ class IO(IOBase):
         except rbd.ImageNotFound:
             rbd.RBD().create(ioctx, self._image_name, size, old_format=False, features=self._new_image_features)
             rbd.Image(ioctx, self._image_name)
+            self._new_image = True
         else:
             try:
                 if not force:
@@ -153,6 +157,9 @@ class IO(IOBase):
             self._read_executor.shutdown()
         if self._write_executor:
             self._write_executor.shutdown()
+        if self._write_zeroes_image is not None:
+            self._write_zeroes_image.close()
+            self._write_zeroes_image = None
 
     def size(self) -> int:
         assert self._pool_name is not None and self._image_name is not None
@@ -238,3 +245,31 @@ class IO(IOBase):
     def write_get_completed(self, timeout: Optional[int] = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
         assert self._write_executor is not None
         return self._write_executor.get_completed(timeout=timeout)
+
+    def write_zeroes(self, offset: int, length: int) -> bool:
+        # A newly created image reads back as zeroes already
+        if self._new_image:
+            return True
+
+        # A discard isn't guaranteed to zero the range (see rbd_skip_partial_discard), so the caller needs to write
+        # the zeroes itself when write_zeroes isn't supported by librbd.
+        if not hasattr(rbd.Image, 'write_zeroes'):
+            return False
+
+        if self._write_zeroes_image is None:
+            ioctx = self._cluster.open_ioctx(self._pool_name)
+            if self._namespace_name is not None and len(self._namespace_name) > 0:
+                ioctx.set_namespace(self._namespace_name)
+            self._write_zeroes_image = rbd.Image(ioctx, self._image_name)
+
+        t1 = time.time()
+        # Limit the length of a single request like it is done for discards.
+        while length > 0:
+            region_length = min(0x7fffffff, length)
+            self._write_zeroes_image.write_zeroes(offset, region_length)
+            offset += region_length
+            length -= region_length
+        t2 = time.time()
+
+        logger.debug('Zeroed range of RBD image {} in {:.3f}s.'.format(self.url, t2 - t1))
+        return True
@@ -62,6 +62,7 @@ class IO(IOBase):
         self._cluster.connect()
         # create a bitwise or'd list of the configured features
         self._new_image_features = 0
+        self._new_image = False
         for feature in config.get_from_dict(module_configuration, 'newImageFeatures', types=list):
             try:
                 self._new_image_features = self._new_image_features | getattr(rbd, feature)
@@ -130,6 +131,7 @@ class IO(IOBase):
         except rbd.ImageNotFound:
             rbd.RBD().create(ioctx, self._image_name, size, old_format=False, features=self._new_image_features)
             self._rbd_image = rbd.Image(ioctx, self._image_name)
+            self._new_image = True
         else:
             assert self._rbd_image is not None
             if not force:
@@ -280,6 +282,29 @@ class IO(IOBase):
 
         assert written == block.size
 
+    def write_zeroes(self, offset: int, length: int) -> bool:
+        assert self._rbd_image is not None
+        # A newly created image reads back as zeroes already
+        if self._new_image:
+            return True
+
+        # A discard isn't guaranteed to zero the range (see rbd_skip_partial_discard), so the caller needs to write
+        # the zeroes itself when write_zeroes isn't supported by librbd.
+        if not hasattr(self._rbd_image, 'write_zeroes'):
+            return False
+
+        t1 = time.time()
+        # Limit the length of a single request like it is done for discards.
+        while length > 0:
+            region_length = min(0x7fffffff, length)
+            self._rbd_image.write_zeroes(offset, region_length)
+            offset += region_length
+            length -= region_length
+        t2 = time.time()
+
+        logger.debug('Zeroed range of RBD image {} in {:.3f}s.'.format(self.url, t2 - t1))
+        return True
+
     def _writes_finished(self) -> bool:
         return len(self._write_queue) == 0 and self._outstanding_aio_writes == 0
 
@@ -204,7 +204,7 @@ class RestAPI:
     @route(f'/apis/{CORE_API_GROUP}/{CORE_API_VERSION_V1}/versions/metadata/import', method='POST')
     def _api_v1_versions_metadata_import_create(self) -> None:
         with Benji(self._config) as benji_obj:
-            benji_obj.metadata_import(request.body.read())
+            benji_obj.metadata_import(request.body)
 
     @route(f'/apis/{CORE_API_GROUP}/{CORE_API_VERSION_V1}/storages', method='GET')
     def _api_v1_storages_list(self) -> List[str]:
@@ -86,6 +86,11 @@ def main():
                    default=None,
                    help='Labels for this version (can be repeated)')
     p.add_argument('-S', '--storage', default='', help='Destination storage (if unspecified the default is used)')
+    p.add_argument('-R',
+                   '--resume',
+                   dest='resume_version_uid',
+                   default=None,
+                   help='Resume the interrupted backup of this incomplete version')
     p.add_argument('source', help='Source URL')
     p.add_argument('volume', help='Volume name')
     p.set_defaults(func='backup')
@@ -184,6 +189,15 @@ def main():
     p = subparsers_root.add_parser('metadata-backup', help='Back up the metadata of one or more versions')
     p.add_argument('filter_expression', help="Version filter expression")
     p.add_argument('-f', '--force', action='store_true', help='Overwrite existing metadata backups')
+    p.add_argument('--format',
+                   dest='metadata_format',
+                   choices=['json', 'binary'],
+                   default=None,
+                   help='Metadata format (if unspecified the configured format is used)')
+    p.add_argument('--compression',
+                   choices=['none', 'zstd'],
+                   default=None,
+                   help='Compression of the binary metadata format (if unspecified the configured compression is used)')
     p.set_defaults(func='metadata_backup')
 
     # METADATA EXPORT
@@ -192,12 +206,26 @@ def main():
     p.add_argument('filter_expression', nargs='?', default=None, help="Version filter expression")
     p.add_argument('-f', '--force', action='store_true', help='Overwrite an existing output file')
     p.add_argument('-o', '--output-file', default=None, help='Output file (standard output if missing)')
+    p.add_argument('--format',
+                   dest='metadata_format',
+                   choices=['json', 'binary'],
+                   default='json',
+                   help='Metadata format')
+    p.add_argument('--compression',
+                   choices=['none', 'zstd'],
+                   default='none',
+                   help='Compression of the binary metadata format')
     p.set_defaults(func='metadata_export')
 
     # METADATA-IMPORT
     p = subparsers_root.add_parser('metadata-import',
                                    help='Import the metadata of one or more versions from a file or standard input')
     p.add_argument('-i', '--input-file', default=None, help='Input file (standard input if missing)')
+    p.add_argument('--format',
+                   dest='metadata_format',
+                   choices=['auto', 'json', 'binary'],
+                   default='auto',
+                   help='Metadata format (detected automatically by default)')
     p.set_defaults(func='metadata_import')
 
     # METADATA-LS
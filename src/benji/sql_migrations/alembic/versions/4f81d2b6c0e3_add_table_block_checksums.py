@@ -0,0 +1,103 @@
+"""Add table block_checksums
+
+Revision ID: 4f81d2b6c0e3
+Revises: 9c3f5e8a1b27
+Create Date: 2026-10-16 16:05:52.904137
+
+"""
+import struct
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '4f81d2b6c0e3'
+down_revision = '9c3f5e8a1b27'
+branch_labels = None
+depends_on = None
+
+# Layout of the block_chunks table entries as of revision 9c3f5e8a1b27
+_BLOCKS_PER_CHUNK = 1024
+_ENTRY_STRUCT = struct.Struct('<HiiiBB')
+_FLAG_VALID = 1
+_FLAG_UID = 2
+
+
+def _compact_block_map_checksums(connection):
+    for row in connection.execute(
+            sa.text('SELECT versions.storage_id, block_chunks.data FROM block_chunks '
+                    'JOIN versions ON block_chunks.version_id = versions.id')):
+        storage_id, data = row[0], bytes(row[1])
+        offset = 0
+        while offset < len(data):
+            _, uid_left, uid_right, size, flags, checksum_length = _ENTRY_STRUCT.unpack_from(data, offset)
+            offset += _ENTRY_STRUCT.size
+            checksum = data[offset:offset + checksum_length]
+            offset += checksum_length
+            if flags & _FLAG_VALID and flags & _FLAG_UID and checksum_length > 0:
+                yield (storage_id, checksum), (uid_left, uid_right, size)
+
+
+def upgrade():
+    op.create_table('block_checksums', sa.Column('storage_id', sa.Integer(), nullable=False),
+                    sa.Column('checksum', sa.LargeBinary(length=64), nullable=False),
+                    sa.Column('uid_left', sa.Integer(), nullable=False),
+                    sa.Column('uid_right', sa.Integer(), nullable=False), sa.Column('size', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['storage_id'], ['storages.id'],
+                                            name=op.f('fk_block_checksums_storage_id_storages')),
+                    sa.PrimaryKeyConstraint('storage_id', 'checksum', name=op.f('pk_block_checksums')))
+    with op.batch_alter_table('block_checksums', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_block_checksums_uid_left'), ['uid_left', 'uid_right'], unique=False)
+    if (op.get_context().dialect.name == 'postgresql'):
+        op.create_index(op.f('ix_block_checksums_checksum'),
+                        'block_checksums', ['checksum'],
+                        unique=False,
+                        postgresql_using='hash')
+
+    # Pick one block UID per checksum
+    op.execute('INSERT INTO block_checksums (storage_id, checksum, uid_left, uid_right, size) '
+               'SELECT storage_id, checksum, uid_left, uid_right, size FROM '
+               '(SELECT versions.storage_id, blocks.checksum, blocks.uid_left, blocks.uid_right, blocks.size, '
+               'ROW_NUMBER() OVER (PARTITION BY versions.storage_id, blocks.checksum '
+               'ORDER BY blocks.uid_left, blocks.uid_right) AS row_number '
+               'FROM blocks JOIN versions ON blocks.version_id = versions.id '
+               'WHERE blocks.valid AND blocks.checksum IS NOT NULL AND blocks.uid_left IS NOT NULL '
+               'AND blocks.uid_right IS NOT NULL) AS candidates WHERE row_number = 1')
+
+    # Add the checksums of versions with a compact block map which aren't known yet
+    connection = op.get_bind()
+    block_checksums = sa.table('block_checksums', sa.column('storage_id', sa.Integer),
+                               sa.column('checksum', sa.LargeBinary), sa.column('uid_left', sa.Integer),
+                               sa.column('uid_right', sa.Integer), sa.column('size', sa.Integer))
+    candidates = dict(_compact_block_map_checksums(connection))
+    keys = list(candidates.keys())
+    for offset in range(0, len(keys), 250):
+        keys_chunk = keys[offset:offset + 250]
+        present_keys = set()
+        for storage_id in {storage_id for storage_id, _ in keys_chunk}:
+            for row in connection.execute(
+                    sa.select(block_checksums.c.checksum).where(
+                        block_checksums.c.storage_id == storage_id,
+                        block_checksums.c.checksum.in_([checksum for key_storage_id, checksum in keys_chunk
+                                                        if key_storage_id == storage_id]))):
+                present_keys.add((storage_id, bytes(row[0])))
+        rows = [{
+            'storage_id': key[0],
+            'checksum': key[1],
+            'uid_left': candidates[key][0],
+            'uid_right': candidates[key][1],
+            'size': candidates[key][2],
+        } for key in keys_chunk if key not in present_keys]
+        if rows:
+            connection.execute(block_checksums.insert(), rows)
+
+    # Deduplication lookups don't use the checksum index of table blocks anymore
+    with op.batch_alter_table('blocks', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_blocks_checksum'))
+
+
+def downgrade():
+    with op.batch_alter_table('blocks', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_blocks_checksum'), ['checksum'], unique=False)
+
+    op.drop_table('block_checksums')
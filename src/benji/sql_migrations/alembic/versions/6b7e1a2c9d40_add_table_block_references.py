@@ -0,0 +1,61 @@
+"""Add table block_references
+
+Revision ID: 6b7e1a2c9d40
+Revises: 3d014d45493f
+Create Date: 2026-10-16 10:12:41.318254
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6b7e1a2c9d40'
+down_revision = '3d014d45493f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('block_references', sa.Column('uid_left', sa.Integer(), nullable=False),
+                    sa.Column('uid_right', sa.Integer(), nullable=False),
+                    sa.Column('storage_id', sa.Integer(), nullable=False),
+                    sa.Column('count', sa.Integer(), nullable=False), sa.Column('date', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['storage_id'], ['storages.id'],
+                                            name=op.f('fk_block_references_storage_id_storages')),
+                    sa.PrimaryKeyConstraint('uid_left', 'uid_right', name=op.f('pk_block_references')))
+    with op.batch_alter_table('block_references', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_block_references_date'), ['date'], unique=False)
+
+    # Count the references of all blocks
+    op.execute('INSERT INTO block_references (uid_left, uid_right, storage_id, count, date) '
+               'SELECT blocks.uid_left, blocks.uid_right, MIN(versions.storage_id), COUNT(*), NULL '
+               'FROM blocks JOIN versions ON blocks.version_id = versions.id '
+               'WHERE blocks.uid_left IS NOT NULL AND blocks.uid_right IS NOT NULL '
+               'GROUP BY blocks.uid_left, blocks.uid_right')
+    # Carry over all delete candidates which are still unreferenced
+    op.execute('INSERT INTO block_references (uid_left, uid_right, storage_id, count, date) '
+               'SELECT deleted_blocks.uid_left, deleted_blocks.uid_right, MIN(deleted_blocks.storage_id), 0, '
+               'MAX(deleted_blocks.date) FROM deleted_blocks WHERE NOT EXISTS '
+               '(SELECT 1 FROM blocks WHERE blocks.uid_left = deleted_blocks.uid_left '
+               'AND blocks.uid_right = deleted_blocks.uid_right) '
+               'GROUP BY deleted_blocks.uid_left, deleted_blocks.uid_right')
+
+    op.drop_table('deleted_blocks')
+
+
+def downgrade():
+    op.create_table('deleted_blocks', sa.Column('date', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                    sa.Column('storage_id', sa.Integer(), nullable=False),
+                    sa.Column('uid_left', sa.Integer(), nullable=False),
+                    sa.Column('uid_right', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['storage_id'], ['storages.id'],
+                                            name=op.f('fk_deleted_blocks_storage_id_storages')),
+                    sa.PrimaryKeyConstraint('id', name=op.f('pk_deleted_blocks')))
+    with op.batch_alter_table('deleted_blocks', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_deleted_blocks_uid_left'), ['uid_left', 'uid_right'], unique=False)
+
+    op.execute('INSERT INTO deleted_blocks (date, storage_id, uid_left, uid_right) '
+               'SELECT date, storage_id, uid_left, uid_right FROM block_references WHERE count <= 0')
+
+    op.drop_table('block_references')
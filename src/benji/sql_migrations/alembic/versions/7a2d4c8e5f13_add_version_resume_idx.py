@@ -0,0 +1,25 @@
+"""Add column resume_idx to table versions
+
+Revision ID: 7a2d4c8e5f13
+Revises: 4f81d2b6c0e3
+Create Date: 2026-10-17 09:41:27.512830
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7a2d4c8e5f13'
+down_revision = '4f81d2b6c0e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('versions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('resume_idx', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('versions', schema=None) as batch_op:
+        batch_op.drop_column('resume_idx')
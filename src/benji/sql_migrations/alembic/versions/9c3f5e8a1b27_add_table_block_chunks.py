@@ -0,0 +1,38 @@
+"""Add table block_chunks
+
+Revision ID: 9c3f5e8a1b27
+Revises: 6b7e1a2c9d40
+Create Date: 2026-10-16 14:37:05.482716
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c3f5e8a1b27'
+down_revision = '6b7e1a2c9d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('block_chunks', sa.Column('version_id', sa.Integer(), nullable=False),
+                    sa.Column('chunk_idx', sa.Integer(), nullable=False),
+                    sa.Column('data', sa.LargeBinary(), nullable=False),
+                    sa.ForeignKeyConstraint(['version_id'], ['versions.id'],
+                                            name=op.f('fk_block_chunks_version_id_versions'),
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('version_id', 'chunk_idx', name=op.f('pk_block_chunks')))
+    with op.batch_alter_table('versions', schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column('compact_block_map',
+                      sa.Boolean(name=op.f('ck_versions_compact_block_map')),
+                      nullable=False,
+                      server_default=sa.false()))
+
+
+def downgrade():
+    with op.batch_alter_table('versions', schema=None) as batch_op:
+        batch_op.drop_column('compact_block_map')
+
+    op.drop_table('block_chunks')
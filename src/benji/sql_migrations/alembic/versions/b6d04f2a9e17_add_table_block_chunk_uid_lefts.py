@@ -0,0 +1,51 @@
+"""Add table block_chunk_uid_lefts
+
+Revision ID: b6d04f2a9e17
+Revises: e3b7a95d1c40
+Create Date: 2026-10-17 16:48:12.730925
+
+"""
+import struct
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b6d04f2a9e17'
+down_revision = 'e3b7a95d1c40'
+branch_labels = None
+depends_on = None
+
+# Layout of the block_chunks table entries as of revision e3b7a95d1c40
+_ENTRY_STRUCT = struct.Struct('<HiiiBB')
+_FLAG_UID = 2
+
+
+def upgrade():
+    op.create_table('block_chunk_uid_lefts', sa.Column('uid_left', sa.Integer(), nullable=False),
+                    sa.Column('version_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['version_id'], ['versions.id'],
+                                            name=op.f('fk_block_chunk_uid_lefts_version_id_versions'),
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('uid_left', 'version_id', name=op.f('pk_block_chunk_uid_lefts')))
+
+    connection = op.get_bind()
+    uid_lefts = set()
+    for row in connection.execute(sa.text('SELECT version_id, data FROM block_chunks')):
+        version_id, data = row[0], bytes(row[1])
+        offset = 0
+        while offset < len(data):
+            _, uid_left, _, _, flags, checksum_length = _ENTRY_STRUCT.unpack_from(data, offset)
+            offset += _ENTRY_STRUCT.size + checksum_length
+            if flags & _FLAG_UID:
+                uid_lefts.add((uid_left, version_id))
+
+    block_chunk_uid_lefts = sa.table('block_chunk_uid_lefts', sa.column('uid_left', sa.Integer),
+                                     sa.column('version_id', sa.Integer))
+    rows = [{'uid_left': uid_left, 'version_id': version_id} for uid_left, version_id in sorted(uid_lefts)]
+    for offset in range(0, len(rows), 1000):
+        connection.execute(block_chunk_uid_lefts.insert(), rows[offset:offset + 1000])
+
+
+def downgrade():
+    op.drop_table('block_chunk_uid_lefts')
@@ -0,0 +1,25 @@
+"""Add column metadata_backup_base_uid to table versions
+
+Revision ID: c5e8f1a3b692
+Revises: 7a2d4c8e5f13
+Create Date: 2026-10-17 11:02:53.207416
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8f1a3b692'
+down_revision = '7a2d4c8e5f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('versions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('metadata_backup_base_uid', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('versions', schema=None) as batch_op:
+        batch_op.drop_column('metadata_backup_base_uid')
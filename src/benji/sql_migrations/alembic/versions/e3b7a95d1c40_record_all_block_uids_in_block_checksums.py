@@ -0,0 +1,94 @@
+"""Record all block UIDs in table block_checksums
+
+Revision ID: e3b7a95d1c40
+Revises: c5e8f1a3b692
+Create Date: 2026-10-17 15:21:37.518204
+
+"""
+import struct
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e3b7a95d1c40'
+down_revision = 'c5e8f1a3b692'
+branch_labels = None
+depends_on = None
+
+# Layout of the block_chunks table entries as of revision c5e8f1a3b692
+_ENTRY_STRUCT = struct.Struct('<HiiiBB')
+_FLAG_VALID = 1
+_FLAG_UID = 2
+
+
+def _compact_block_map_checksums(connection):
+    for row in connection.execute(
+            sa.text('SELECT versions.storage_id, block_chunks.data FROM block_chunks '
+                    'JOIN versions ON block_chunks.version_id = versions.id')):
+        storage_id, data = row[0], bytes(row[1])
+        offset = 0
+        while offset < len(data):
+            _, uid_left, uid_right, size, flags, checksum_length = _ENTRY_STRUCT.unpack_from(data, offset)
+            offset += _ENTRY_STRUCT.size
+            checksum = data[offset:offset + checksum_length]
+            offset += checksum_length
+            if flags & _FLAG_VALID and flags & _FLAG_UID and checksum_length > 0:
+                yield storage_id, checksum, uid_left, uid_right, size
+
+
+def upgrade():
+    with op.batch_alter_table('block_checksums', schema=None) as batch_op:
+        batch_op.drop_constraint(batch_op.f('pk_block_checksums'))
+        batch_op.create_primary_key(batch_op.f('pk_block_checksums'),
+                                    ['storage_id', 'checksum', 'uid_left', 'uid_right'])
+
+    # Only one block UID per checksum has been recorded so far, add the others
+    op.execute('INSERT INTO block_checksums (storage_id, checksum, uid_left, uid_right, size) '
+               'SELECT DISTINCT versions.storage_id, blocks.checksum, blocks.uid_left, blocks.uid_right, blocks.size '
+               'FROM blocks JOIN versions ON blocks.version_id = versions.id '
+               'WHERE blocks.valid AND blocks.checksum IS NOT NULL AND blocks.uid_left IS NOT NULL '
+               'AND blocks.uid_right IS NOT NULL AND NOT EXISTS (SELECT 1 FROM block_checksums '
+               'WHERE block_checksums.storage_id = versions.storage_id AND block_checksums.checksum = blocks.checksum '
+               'AND block_checksums.uid_left = blocks.uid_left AND block_checksums.uid_right = blocks.uid_right)')
+
+    connection = op.get_bind()
+    block_checksums = sa.table('block_checksums', sa.column('storage_id', sa.Integer),
+                               sa.column('checksum', sa.LargeBinary), sa.column('uid_left', sa.Integer),
+                               sa.column('uid_right', sa.Integer), sa.column('size', sa.Integer))
+    candidates = {entry[:4]: entry[4] for entry in _compact_block_map_checksums(connection)}
+    keys = list(candidates.keys())
+    for offset in range(0, len(keys), 100):
+        keys_chunk = keys[offset:offset + 100]
+        present_keys = set()
+        for storage_id in {storage_id for storage_id, _, _, _ in keys_chunk}:
+            for row in connection.execute(
+                    sa.select(block_checksums.c.checksum, block_checksums.c.uid_left,
+                              block_checksums.c.uid_right).where(
+                                  block_checksums.c.storage_id == storage_id,
+                                  block_checksums.c.checksum.in_([
+                                      checksum for key_storage_id, checksum, _, _ in keys_chunk
+                                      if key_storage_id == storage_id
+                                  ]))):
+                present_keys.add((storage_id, bytes(row[0]), row[1], row[2]))
+        rows = [{
+            'storage_id': key[0],
+            'checksum': key[1],
+            'uid_left': key[2],
+            'uid_right': key[3],
+            'size': candidates[key],
+        } for key in keys_chunk if key not in present_keys]
+        if rows:
+            connection.execute(block_checksums.insert(), rows)
+
+
+def downgrade():
+    # Keep the most recently written block UID for each checksum
+    op.execute('DELETE FROM block_checksums WHERE EXISTS (SELECT 1 FROM block_checksums AS newer '
+               'WHERE newer.storage_id = block_checksums.storage_id AND newer.checksum = block_checksums.checksum '
+               'AND (newer.uid_left > block_checksums.uid_left OR (newer.uid_left = block_checksums.uid_left '
+               'AND newer.uid_right > block_checksums.uid_right)))')
+
+    with op.batch_alter_table('block_checksums', schema=None) as batch_op:
+        batch_op.drop_constraint(batch_op.f('pk_block_checksums'))
+        batch_op.create_primary_key(batch_op.f('pk_block_checksums'), ['storage_id', 'checksum'])
@@ -110,6 +110,29 @@ class Storage(ReadCacheStorageBase):
 
         return data_io.getvalue()
 
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        for i in range(self._read_object_attempts):
+            data_io = BytesIO()
+            try:
+                self.bucket.download_file_by_name(key, range_=(offset, offset + length - 1)).save(data_io)
+            # This is overly broad!
+            except B2Error as exception:
+                if isinstance(exception, FileNotPresent):
+                    raise FileNotFoundError('Object {} not found.'.format(key)) from None
+                else:
+                    if i + 1 < self._read_object_attempts:
+                        sleep_time = (2**(i + 1)) + (random.randint(0, 1000) / 1000)
+                        logger.warning(
+                            'Ranged download of object with key {} from B2 failed, will try again in {:.2f} seconds. Exception thrown was {}'.format(
+                                key, sleep_time, str(exception)))
+                        time.sleep(sleep_time)
+                        continue
+                    raise
+            else:
+                break
+
+        return data_io.getvalue()
+
     def _read_object_length(self, key: str) -> int:
         for i in range(self._read_object_attempts):
             try:
@@ -142,18 +165,6 @@ class Storage(ReadCacheStorageBase):
             else:
                 raise
 
-    # def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
-    #     """ Deletes many keys from the storage and returns a list of keys that couldn't be deleted.
-    #     """
-    #     errors = []
-    #     for key in keys:
-    #         try:
-    #             file_version_info = self._file_info(key)
-    #             self.bucket.delete_file_version(file_version_info.id_, file_version_info.file_name)
-    #         except (B2Error, FileNotFoundError):
-    #             errors.append(key)
-    #     return errors
-
     def _list_objects(self,
                       prefix: str = None,
                       include_size: bool = False) -> Union[Iterable[str], Iterable[Tuple[str, int]]]:
@@ -7,7 +7,10 @@ import os
 import threading
 import time
 from abc import ABCMeta, abstractmethod
-from typing import Union, Optional, Dict, Tuple, List, Sequence, cast, Iterator, Iterable
+from collections import OrderedDict, defaultdict
+from functools import partial
+from io import BytesIO
+from typing import Union, Optional, Dict, Tuple, List, Sequence, Set, Any, Callable, Type, cast, Iterator, Iterable
 
 import semantic_version
 from diskcache import FanoutCache
@@ -19,6 +22,7 @@ from benji.jobexecutor import JobExecutor
 from benji.logging import logger
 from benji.repr import ReprMixIn
 from benji.storage.dicthmac import DictHMAC
+from benji.storage.key import StorageKeyMixIn
 from benji.transform.base import TransformBase
 from benji.transform.factory import TransformFactory
 from benji.utils import TokenBucket, derive_key
@@ -59,9 +63,26 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     _OBJECT_SIZE_KEY = 'object_size'
     _SIZE_KEY = 'size'
     _TRANSFORMS_KEY = 'transforms'
+    # Only present in the object metadata of incremental version metadata backups
+    _BASE_VERSION_UID_KEY = 'base_version_uid'
+    _DELTA_DEPTH_KEY = 'delta_depth'
 
     _META_SUFFIX = '.meta'
 
+    # Packed blocks are grouped into ranges by their UID. Each range has an index object which records the pack object,
+    # offset, length and object metadata of each block. Changing this breaks the lookup of existing packed blocks.
+    _PACK_PREFIX = 'packs/'
+    _PACK_INDEX_SUFFIX = '.index'
+    _PACK_RANGE_BLOCKS = 1024
+    _PACK_INDEX_CACHE_SIZE = 256
+
+    # StorageKeyMixIn._to_path spreads the keys below each prefix over 256 first level shards which are listed
+    # concurrently
+    _LIST_SHARDS = 256
+
+    # Number of blocks removed by one job of rm_many_blocks_async
+    _RM_MANY_BLOCKS_BATCH_SIZE = 500
+
     def __init__(self, *, config: Config, name: str, module_configuration: ConfigDict) -> None:
         self._name = name
         self._active_transforms: List[TransformBase] = []
@@ -77,6 +98,7 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         simultaneous_writes = Config.get_from_dict(module_configuration, 'simultaneousWrites', types=int)
         simultaneous_reads = Config.get_from_dict(module_configuration, 'simultaneousReads', types=int)
         simultaneous_removals = Config.get_from_dict(module_configuration, 'simultaneousRemovals', types=int)
+        self._simultaneous_listings = Config.get_from_dict(module_configuration, 'simultaneousListings', types=int)
         bandwidth_read = Config.get_from_dict(module_configuration, 'bandwidthRead', types=int)
         bandwidth_write = Config.get_from_dict(module_configuration, 'bandwidthWrite', types=int)
 
@@ -108,6 +130,22 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         self.write_throttling = TokenBucket()
         self.write_throttling.set_rate(bandwidth_write)  # 0 disables throttling
 
+        self._pack_size = Config.get_from_dict(module_configuration, 'packing.packSize', None, types=int)
+        self._pack_compaction_threshold = Config.get_from_dict(module_configuration,
+                                                               'packing.compactionThreshold',
+                                                               0.5,
+                                                               types=float)
+        if self._pack_size is not None:
+            logger.info('Enabling packing of blocks into objects of {} bytes for storage {}.'.format(
+                self._pack_size, name))
+        # Blocks waiting to be written to a pack object, indexed by range key
+        self._pack_buffers: Dict[str, List[Tuple[DereferencedBlock, bytes, Dict]]] = OrderedDict()
+        self._pack_buffers_size = 0
+        self._pack_buffers_lock = threading.Lock()
+        self._pack_range_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._pack_index_cache: Dict[str, Dict] = OrderedDict()
+        self._pack_index_cache_lock = threading.Lock()
+
         self._read_executor = JobExecutor(name='Storage-Read', workers=simultaneous_reads, blocking_submit=False)
         self._write_executor = JobExecutor(name='Storage-Write', workers=simultaneous_writes, blocking_submit=True)
         self._remove_executor = JobExecutor(name='Storage-Remove', workers=simultaneous_removals, blocking_submit=True)
@@ -121,7 +159,8 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
                         size: int,
                         object_size: int,
                         transforms_metadata: List[Dict] = None,
-                        checksum: str = None) -> Tuple[Dict, bytes]:
+                        checksum: str = None,
+                        extra_metadata: Dict = None) -> Tuple[Dict, bytes]:
 
         timestamp = datetime.datetime.utcnow().isoformat(timespec='microseconds') + 'Z'
         metadata: Dict = {
@@ -138,14 +177,20 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         if transforms_metadata:
             metadata[self._TRANSFORMS_KEY] = transforms_metadata
 
+        if extra_metadata:
+            metadata.update(extra_metadata)
+
         if self._dict_hmac:
             self._dict_hmac.add_digest(metadata)
 
         return metadata, json.dumps(metadata, separators=(',', ':')).encode('utf-8')
 
     def _decode_metadata(self, *, metadata_json: bytes, key: str, data_length: int) -> Dict:
-        metadata = json.loads(metadata_json.decode('utf-8'))
+        return self._verify_metadata(metadata=json.loads(metadata_json.decode('utf-8')),
+                                     key=key,
+                                     data_length=data_length)
 
+    def _verify_metadata(self, *, metadata: Dict, key: str, data_length: int) -> Dict:
         if self._dict_hmac:
             self._dict_hmac.verify_digest(metadata)
 
@@ -167,9 +212,9 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
 
         return metadata
 
-    def _check_write(self, *, key: str, metadata_key: str, data_expected: bytes) -> None:
-        data_actual = self._read_object(key)
-        metadata_actual_json = self._read_object(metadata_key)
+    def _check_write(self, *, key: str, data_expected: bytes) -> None:
+        data_actual, _, metadata_actual_json = self._read_object_with_metadata(key, metadata_only=False)
+        assert data_actual is not None
 
         # Return value is ignored
         self._decode_metadata(metadata_json=metadata_actual_json, key=key, data_length=len(data_actual))
@@ -187,17 +232,14 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
                                                        transforms_metadata=transforms_metadata)
 
         key = block.uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
 
         time.sleep(self.write_throttling.consume(len(data) + len(metadata_json)))
         t1 = time.time()
         try:
-            self._write_object(key, data)
-            self._write_object(metadata_key, metadata_json)
+            self._write_object_with_metadata(key, data, metadata_json)
         except:
             try:
-                self._rm_object(key)
-                self._rm_object(metadata_key)
+                self._rm_object_with_metadata(key)
             except FileNotFoundError:
                 pass
             raise
@@ -207,55 +249,292 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
 
         if self._consistency_check_writes:
             try:
-                self._check_write(key=key, metadata_key=metadata_key, data_expected=data)
+                self._check_write(key=key, data_expected=data)
             except (KeyError, ValueError) as exception:
                 raise InvalidBlockException('Check write of block {} (UID {}) failed.'.format(block.idx, block.uid),
                                             block) from exception
 
         return block
 
+    def _pack_range_key(self, uid: BlockUid) -> str:
+        assert uid.left is not None and uid.right is not None
+        range_start = uid.right - uid.right % self._PACK_RANGE_BLOCKS
+        return StorageKeyMixIn._to_path(self._PACK_PREFIX, '{:016x}-{:016x}'.format(uid.left, range_start))
+
+    @staticmethod
+    def _pack_key(range_key: str, pack: int) -> str:
+        return '{}-{:08x}'.format(range_key, pack)
+
+    def _pack_range_lock(self, range_key: str) -> threading.Lock:
+        with self._pack_index_cache_lock:
+            return self._pack_range_locks[range_key]
+
+    def _read_pack_index(self, range_key: str, cached: bool = True) -> Dict:
+        """ Returns the index of a range of packed blocks. The index is a dictionary with the keys packs (maps the
+        pack number to the size of the pack object), blocks (maps the right part of the block UID to a list of pack
+        number, offset, length and object metadata) and next_pack (number of the next pack object to write). An empty
+        index is returned if there are no packed blocks in this range. Other processes might change the index, so
+        it is always read from the storage when cached is False. Missing indexes are never cached.
+        """
+        if cached:
+            with self._pack_index_cache_lock:
+                if range_key in self._pack_index_cache:
+                    self._pack_index_cache.move_to_end(range_key)  # type: ignore
+                    return self._pack_index_cache[range_key]
+
+        try:
+            index = json.loads(self._read_object(range_key + self._PACK_INDEX_SUFFIX).decode('utf-8'))
+        except FileNotFoundError:
+            self._uncache_pack_index(range_key)
+            return {'packs': {}, 'blocks': {}, 'next_pack': 0}
+        self._cache_pack_index(range_key, index)
+        return index
+
+    def _uncache_pack_index(self, range_key: str) -> None:
+        with self._pack_index_cache_lock:
+            self._pack_index_cache.pop(range_key, None)
+
+    def _cache_pack_index(self, range_key: str, index: Dict) -> None:
+        with self._pack_index_cache_lock:
+            self._pack_index_cache[range_key] = index
+            self._pack_index_cache.move_to_end(range_key)  # type: ignore
+            while len(self._pack_index_cache) > self._PACK_INDEX_CACHE_SIZE:
+                self._pack_index_cache.popitem(last=False)  # type: ignore
+
+    def _write_pack_index(self, range_key: str, index: Dict) -> None:
+        index_key = range_key + self._PACK_INDEX_SUFFIX
+        if index['blocks']:
+            self._write_object(index_key, json.dumps(index, separators=(',', ':')).encode('utf-8'))
+        else:
+            try:
+                self._rm_object(index_key)
+            except FileNotFoundError:
+                pass
+        self._cache_pack_index(range_key, index)
+
+    def _write_pack(self, range_key: str, entries: List[Tuple[DereferencedBlock, bytes, Dict]]) -> None:
+        # Only the process holding the lock on a version writes blocks with its version id as the left part of the
+        # UID, so a range is never updated by two processes at once.
+        with self._pack_range_lock(range_key):
+            index = self._read_pack_index(range_key, cached=False)
+            pack = index['next_pack']
+            pack_key = self._pack_key(range_key, pack)
+            pack_data = b''.join(data for _, data, _ in entries)
+
+            new_index = {
+                'packs': dict(index['packs']),
+                'blocks': dict(index['blocks']),
+                'next_pack': pack + 1,
+            }
+            new_index['packs'][str(pack)] = len(pack_data)
+            offset = 0
+            for block, data, metadata in entries:
+                new_index['blocks'][str(block.uid.right)] = [pack, offset, len(data), metadata]
+                offset += len(data)
+
+            time.sleep(self.write_throttling.consume(len(pack_data)))
+            t1 = time.time()
+            # If writing the index fails the pack object is left behind. It isn't referenced and gets overwritten by
+            # the next pack written for this range.
+            self._write_object(pack_key, pack_data)
+            # Blocks which have been written again might have left unused space behind in older packs.
+            self._update_pack_index(range_key, new_index)
+            t2 = time.time()
+
+        logger.debug('{} wrote pack {} with {} blocks in {:.3f}s'.format(threading.current_thread().name, pack_key,
+                                                                          len(entries), t2 - t1))
+
+        if self._consistency_check_writes:
+            if self._read_object(pack_key) != pack_data:
+                block = entries[0][0]
+                raise InvalidBlockException(
+                    'Check write of pack {} containing block {} (UID {}) failed.'.format(pack_key, block.idx,
+                                                                                         block.uid), block)
+
+    def _update_pack_index(self, range_key: str, index: Dict) -> None:
+        """ Writes a new index for a range. Pack objects which don't contain any used blocks anymore are removed and
+        pack objects whose unused space exceeds the compaction threshold are rewritten. Must be called with the range
+        lock held.
+        """
+        used_sizes: Dict[str, int] = defaultdict(int)
+        for pack, _, length, _ in index['blocks'].values():
+            used_sizes[str(pack)] += length
+
+        removed_packs = [pack for pack in index['packs'].keys() if used_sizes[pack] == 0]
+        repacked_packs = [
+            pack for pack, size in index['packs'].items()
+            if used_sizes[pack] > 0 and (size - used_sizes[pack]) / size > self._pack_compaction_threshold
+        ]
+
+        new_index = {
+            'packs': {
+                pack: size
+                for pack, size in index['packs'].items()
+                if pack not in removed_packs and pack not in repacked_packs
+            },
+            'blocks': dict(index['blocks']),
+            'next_pack': index['next_pack'],
+        }
+        if repacked_packs:
+            new_pack = new_index['next_pack']
+            new_index['next_pack'] += 1
+            pack_data = BytesIO()
+            for right, (pack, offset, length, metadata) in index['blocks'].items():
+                if str(pack) in repacked_packs:
+                    new_index['blocks'][right] = [new_pack, pack_data.tell(), length, metadata]
+                    pack_data.write(self._read_object_range(self._pack_key(range_key, pack), offset, length))
+            new_index['packs'][str(new_pack)] = pack_data.tell()
+            self._write_object(self._pack_key(range_key, new_pack), pack_data.getvalue())
+            logger.debug('Rewrote pack(s) {} of range {} into pack {}.'.format(', '.join(repacked_packs), range_key,
+                                                                               new_pack))
+
+        self._write_pack_index(range_key, new_index)
+
+        # Pack objects are only removed after the index doesn't reference them anymore.
+        for pack in removed_packs + repacked_packs:
+            try:
+                self._rm_object(self._pack_key(range_key, int(pack)))
+            except FileNotFoundError:
+                pass
+
+    def _write_packed(self, block: DereferencedBlock, data: bytes) -> List[DereferencedBlock]:
+        data, transforms_metadata = self._encapsulate(data)
+        metadata, _ = self._build_metadata(size=block.size,
+                                           object_size=len(data),
+                                           checksum=block.checksum,
+                                           transforms_metadata=transforms_metadata)
+
+        range_key = self._pack_range_key(block.uid)
+        with self._pack_buffers_lock:
+            self._pack_buffers.setdefault(range_key, []).append((block, data, metadata))
+            self._pack_buffers_size += len(data)
+            full_buffers = []
+            if sum(len(data) for _, data, _ in self._pack_buffers[range_key]) >= cast(int, self._pack_size):
+                full_buffers.append((range_key, self._pack_buffers.pop(range_key)))
+            # Limit the memory used by partially filled packs, these can accumulate when only a few blocks of each
+            # range are written. The oldest ones are written out first.
+            while self._pack_buffers and self._pack_buffers_size > 2 * cast(int, self._pack_size):
+                full_buffers.append(self._pack_buffers.popitem(last=False))  # type: ignore
+            for _, entries in full_buffers:
+                self._pack_buffers_size -= sum(len(data) for _, data, _ in entries)
+
+        written_blocks: List[DereferencedBlock] = []
+        for range_key, entries in full_buffers:
+            self._write_pack(range_key, entries)
+            written_blocks.extend(block for block, _, _ in entries)
+        return written_blocks
+
+    def _flush_packs(self) -> List[DereferencedBlock]:
+        with self._pack_buffers_lock:
+            buffers = list(self._pack_buffers.items())
+            self._pack_buffers.clear()
+            self._pack_buffers_size = 0
+
+        written_blocks: List[DereferencedBlock] = []
+        for range_key, entries in buffers:
+            self._write_pack(range_key, entries)
+            written_blocks.extend(block for block, _, _ in entries)
+        return written_blocks
+
     def write_block_async(self, block: Union[DereferencedBlock, Block], data: bytes) -> None:
         # We do need to dereference the block outside of the closure otherwise a reference to the block will be held
         # inside of the closure leading to database troubles.
         # See https://github.com/elemental-lf/benji/issues/61.
         block_deref = block.deref()
 
-        def job():
-            return self._write(block_deref, data)
+        if self._pack_size is not None:
+
+            def job():
+                return self._write_packed(block_deref, data)
+        else:
+
+            def job():
+                return self._write(block_deref, data)
 
         self._write_executor.submit(job)
 
     def write_block(self, block: Union[DereferencedBlock, Block], data: bytes) -> None:
+        # Synchronous writes are never packed
         self._write(block.deref(), data)
 
+    def flush_writes(self) -> None:
+        """ Waits for all outstanding asynchronous writes and then writes out all partially filled packs. The blocks
+        contained in them are returned by write_get_completed() afterwards.
+        """
+        if self._pack_size is not None:
+            self._write_executor.wait_for_all()
+            self._write_executor.submit(self._flush_packs)
+
     def write_get_completed(self, timeout: int = None) -> Iterator[Union[DereferencedBlock, BaseException]]:
-        return self._write_executor.get_completed(timeout=timeout)
+        for entry in self._write_executor.get_completed(timeout=timeout):
+            # Packed writes return all blocks written out together
+            if isinstance(entry, list):
+                yield from entry
+            else:
+                yield entry
 
-    def _read(self, block: DereferencedBlock, metadata_only: bool) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
-        key = block.uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
+    def _read_packed(self, block: DereferencedBlock,
+                     metadata_only: bool) -> Optional[Tuple[DereferencedBlock, Optional[bytes], Dict]]:
+        range_key = self._pack_range_key(block.uid)
+        index_entry = self._read_pack_index(range_key)['blocks'].get(str(block.uid.right))
+        if index_entry is None:
+            return None
+
+        pack, offset, length, metadata = index_entry
+        pack_key = self._pack_key(range_key, pack)
         data: Optional[bytes] = None
-        try:
+        if not metadata_only:
+            # A missing pack object raises FileNotFoundError, the cached index might be outdated in this case.
             t1 = time.time()
-            if not metadata_only:
-                data = self._read_object(key)
-                data_length = len(data)
-            else:
-                data_length = self._read_object_length(key)
-            metadata_json = self._read_object(metadata_key)
-            time.sleep(self.read_throttling.consume(len(data) if data else 0 + len(metadata_json)))
+            data = self._read_object_range(pack_key, offset, length)
+            time.sleep(self.read_throttling.consume(len(data)))
             t2 = time.time()
-        except FileNotFoundError as exception:
-            raise InvalidBlockException(
-                'Object metadata or data of block {} (UID {}) not found.'.format(block.idx, block.uid),
-                block) from exception
+            logger.debug('{} read data of uid {} from pack {} in {:.3f}s'.format(threading.current_thread().name,
+                                                                                 block.uid, pack_key, t2 - t1))
 
         try:
-            metadata = self._decode_metadata(metadata_json=metadata_json, key=key, data_length=data_length)
+            # The HMAC digest is removed during verification, so work on a copy of the cached metadata.
+            metadata = self._verify_metadata(metadata=dict(metadata),
+                                             key=pack_key,
+                                             data_length=len(data) if data is not None else length)
         except (KeyError, ValueError) as exception:
             raise InvalidBlockException('Object metadata of block {} (UID {}) is invalid.'.format(block.idx, block.uid),
                                         block) from exception
 
+        return block, data, metadata
+
+    def _read_packed_or_unpacked(self, block: DereferencedBlock,
+                                 metadata_only: bool) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
+        # Blocks can be packed or not regardless of the current configuration, but the pack index is only consulted
+        # first when packing is enabled.
+        if self._pack_size is not None:
+            packed_result = self._read_packed(block, metadata_only)
+            if packed_result is not None:
+                return packed_result
+            return self._read_unpacked(block, metadata_only)
+        else:
+            try:
+                return self._read_unpacked(block, metadata_only)
+            except FileNotFoundError:
+                packed_result = self._read_packed(block, metadata_only)
+                if packed_result is None:
+                    raise
+                return packed_result
+
+    def _read(self, block: DereferencedBlock, metadata_only: bool) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
+        try:
+            block, data, metadata = self._read_packed_or_unpacked(block, metadata_only)
+        except FileNotFoundError:
+            # The cached pack index might be outdated when another process has packed or repacked blocks of
+            # this range. Retry once with a fresh index.
+            self._uncache_pack_index(self._pack_range_key(block.uid))
+            try:
+                block, data, metadata = self._read_packed_or_unpacked(block, metadata_only)
+            except FileNotFoundError as exception:
+                raise InvalidBlockException(
+                    'Object metadata or data of block {} (UID {}) not found.'.format(block.idx, block.uid),
+                    block) from exception
+
         if self._CHECKSUM_KEY not in metadata:
             raise InvalidBlockException(
                 'Required object metadata key {} is missing for block {} (UID {}).'.format(
@@ -264,6 +543,23 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         if not metadata_only and self._TRANSFORMS_KEY in metadata:
             data = self._decapsulate(data, metadata[self._TRANSFORMS_KEY])  # type: ignore
 
+        return block, data, metadata
+
+    def _read_unpacked(self, block: DereferencedBlock,
+                       metadata_only: bool) -> Tuple[DereferencedBlock, Optional[bytes], Dict]:
+        key = block.uid.storage_object_to_path()
+        # A missing object raises FileNotFoundError, the block might be packed in this case.
+        t1 = time.time()
+        data, data_length, metadata_json = self._read_object_with_metadata(key, metadata_only=metadata_only)
+        time.sleep(self.read_throttling.consume(len(data) if data else 0 + len(metadata_json)))
+        t2 = time.time()
+
+        try:
+            metadata = self._decode_metadata(metadata_json=metadata_json, key=key, data_length=data_length)
+        except (KeyError, ValueError) as exception:
+            raise InvalidBlockException('Object metadata of block {} (UID {}) is invalid.'.format(block.idx, block.uid),
+                                        block) from exception
+
         logger.debug('{} read data of uid {} in {:.3f}s{}'.format(threading.current_thread().name, block.uid, t2 - t1,
                                                                   ' (metadata only)' if metadata_only else ''))
 
@@ -305,18 +601,44 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
                                  cast(str, block.checksum)[:16],  # We know that block.checksum is set
                                  metadata[self._CHECKSUM_KEY][:16]))
 
+    def _rm_packed_blocks(self, uids: Iterable[BlockUid]) -> Set[BlockUid]:
+        """ Removes the given blocks from their packs and returns the UIDs of all blocks which were packed. The pack
+        index of each range is only updated once.
+        """
+        uids_by_range: Dict[str, List[BlockUid]] = defaultdict(list)
+        for uid in uids:
+            uids_by_range[self._pack_range_key(uid)].append(uid)
+
+        removed_uids: Set[BlockUid] = set()
+        for range_key, range_uids in uids_by_range.items():
+            with self._pack_range_lock(range_key):
+                index = self._read_pack_index(range_key, cached=False)
+                rights = {str(uid.right) for uid in range_uids if str(uid.right) in index['blocks']}
+                if not rights:
+                    continue
+
+                new_index = {
+                    'packs': index['packs'],
+                    'blocks': {right: entry for right, entry in index['blocks'].items() if right not in rights},
+                    'next_pack': index['next_pack'],
+                }
+                self._update_pack_index(range_key, new_index)
+            removed_uids.update(uid for uid in range_uids if str(uid.right) in rights)
+        return removed_uids
+
     def _rm_block(self, uid: BlockUid) -> BlockUid:
+        # Packed blocks are only looked for first when packing is enabled, otherwise only when the block isn't
+        # found as a separate object.
+        if self._pack_size is not None and self._rm_packed_blocks([uid]):
+            return uid
+
         key = uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
         try:
-            self._rm_object(key)
+            self._rm_object_with_metadata(key)
         except FileNotFoundError as exception:
+            if self._pack_size is None and self._rm_packed_blocks([uid]):
+                return uid
             raise BlockNotFoundError('Block UID {} not found on storage.'.format(uid), uid) from exception
-        finally:
-            try:
-                self._rm_object(metadata_key)
-            except FileNotFoundError:
-                pass
         return uid
 
     def rm_block_async(self, uid: BlockUid) -> None:
@@ -329,49 +651,105 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     def rm_block(self, uid: BlockUid) -> None:
         self._rm_block(uid)
 
+    def _rm_many_blocks(self, uids: Sequence[BlockUid]) -> List[Union[BlockUid, BlockNotFoundError]]:
+        # Unlike in _rm_block() packed blocks are always looked for first, even when packing is disabled. Not all
+        # storage modules report missing objects when removing many of them at once, so blocks packed earlier
+        # wouldn't be found otherwise. The pack index of each range is only read once per batch.
+        packed_uids = self._rm_packed_blocks(uids)
+        unpacked_uids = [uid for uid in uids if uid not in packed_uids]
+        keys = [uid.storage_object_to_path() for uid in unpacked_uids]
+        # The metadata objects are removed in the same requests as the data objects. They might not exist when the
+        # metadata is stored together with the data, so missing metadata objects are ignored.
+        missing_keys = set(self._rm_many_objects(keys + [key + self._META_SUFFIX for key in keys]))
+
+        results: List[Union[BlockUid, BlockNotFoundError]] = list(packed_uids)
+        for uid, key in zip(unpacked_uids, keys):
+            if key in missing_keys:
+                results.append(BlockNotFoundError('Block UID {} not found on storage.'.format(uid), uid))
+            else:
+                results.append(uid)
+        return results
+
+    def rm_many_blocks_async(self, uids: Iterable[BlockUid]) -> None:
+        """ Removes the given blocks in batches. Each batch is removed by a single job which reports a result for
+        each block via rm_get_completed. Depending on the storage module blocks which don't exist at all might not
+        be reported as missing.
+        """
+        uids_list = list(uids)
+        for i in range(0, len(uids_list), self._RM_MANY_BLOCKS_BATCH_SIZE):
+            self._remove_executor.submit(
+                partial(self._rm_many_blocks, uids_list[i:i + self._RM_MANY_BLOCKS_BATCH_SIZE]))
+
     def rm_get_completed(self, timeout: int = None) -> Iterator[Union[BlockUid, BaseException]]:
-        return self._remove_executor.get_completed(timeout=timeout)
+        for entry in self._remove_executor.get_completed(timeout=timeout):
+            # Batched removals return a result for each block
+            if isinstance(entry, list):
+                yield from entry
+            else:
+                yield entry
 
     def wait_rms_finished(self):
         self._remove_executor.wait_for_all()
 
-    # def rm_many_blocks(self, uids: Union[Sequence[BlockUid], AbstractSet[BlockUid]]) -> List[BlockUid]:
-    #     keys = [uid.storage_object_to_path() for uid in uids]
-    #     metadata_keys = [key + self._META_SUFFIX for key in keys]
-    #
-    #     errors = self._rm_many_objects(keys)
-    #     self._rm_many_objects(metadata_keys)
-    #     return [cast(BlockUid, BlockUid.storage_path_to_object(error)) for error in errors]
+    def _list_shards(self, prefix: str, function: Callable[[str], Any]) -> Iterator[Any]:
+        """ Calls function for the prefix of each shard below prefix concurrently and yields the results in order of
+        completion.
+        """
+        executor = JobExecutor(name='Storage-List', workers=self._simultaneous_listings, blocking_submit=False)
+        try:
+            for shard in range(self._LIST_SHARDS):
+                executor.submit(partial(function, '{}{:02x}/'.format(prefix, shard)))
 
-    def list_blocks(self) -> Iterable[BlockUid]:
-        keys = self._list_objects(BlockUid.storage_prefix())
-        for key in keys:
+            for result in executor.get_completed():
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            executor.shutdown()
+
+    def _list_storage_objects(self, object_class: Type[StorageKeyMixIn], prefix: str) -> List[Any]:
+        storage_objects = []
+        for key in self._list_objects(prefix):
             assert isinstance(key, str)
             if key.endswith(self._META_SUFFIX):
                 continue
             try:
-                yield BlockUid.storage_path_to_object(key)
+                storage_objects.append(object_class.storage_path_to_object(key))
             except (RuntimeError, ValueError):
                 # Ignore any keys which don't match our pattern to account for stray objects/files
                 pass
+        return storage_objects
 
-    def list_versions(self) -> Iterable[VersionUid]:
-        keys = self._list_objects(VersionUid.storage_prefix())
-        for key in keys:
+    def _list_packed_blocks(self, prefix: str) -> List[BlockUid]:
+        uids = []
+        for key in self._list_objects(prefix):
             assert isinstance(key, str)
-            if key.endswith(self._META_SUFFIX):
+            if not key.endswith(self._PACK_INDEX_SUFFIX):
                 continue
-            try:
-                yield VersionUid.storage_path_to_object(key)
-            except (RuntimeError, ValueError):
-                # Ignore any keys which don't match our pattern to account for stray objects/files
-                pass
+            left = int(StorageKeyMixIn._from_path(self._PACK_PREFIX, key[:-len(self._PACK_INDEX_SUFFIX)])[0:16], 16)
+            index = json.loads(self._read_object(key).decode('utf-8'))
+            uids.extend(BlockUid(left, int(right)) for right in index['blocks'].keys())
+        return uids
+
+    def list_blocks(self) -> Iterable[BlockUid]:
+        for uids in self._list_shards(self._PACK_PREFIX, self._list_packed_blocks):
+            yield from uids
+
+        for uids in self._list_shards(BlockUid.storage_prefix(), partial(self._list_storage_objects, BlockUid)):
+            yield from uids
+
+    def list_versions(self) -> Iterable[VersionUid]:
+        for version_uids in self._list_shards(VersionUid.storage_prefix(),
+                                              partial(self._list_storage_objects, VersionUid)):
+            yield from version_uids
 
     def read_version(self, version_uid: VersionUid) -> str:
+        return self.read_version_data(version_uid).decode('utf-8')
+
+    def read_version_data(self, version_uid: VersionUid) -> bytes:
         key = version_uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
-        data = self._read_object(key)
-        metadata_json = self._read_object(metadata_key)
+        data, _, metadata_json = self._read_object_with_metadata(key, metadata_only=False)
+        assert data is not None
 
         metadata = self._decode_metadata(metadata_json=metadata_json, key=key, data_length=len(data))
 
@@ -382,11 +760,29 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
             raise ValueError('Length mismatch of original data for object {}. Expected: {}, got: {}.'.format(
                 key, metadata[self._SIZE_KEY], len(data)))
 
-        return data.decode('utf-8')
+        return data
 
-    def write_version(self, version_uid: VersionUid, data: str, overwrite: Optional[bool] = False) -> None:
+    def read_version_base(self, version_uid: VersionUid) -> Tuple[Optional[VersionUid], int]:
+        """ Returns the base version and the length of the chain of incremental metadata backups leading up to this
+        metadata backup. Only the object metadata is read. Full metadata backups have no base version and a chain
+        length of zero.
+        """
+        key = version_uid.storage_object_to_path()
+        _, data_length, metadata_json = self._read_object_with_metadata(key, metadata_only=True)
+        metadata = self._decode_metadata(metadata_json=metadata_json, key=key, data_length=data_length)
+
+        base_version_uid = metadata.get(self._BASE_VERSION_UID_KEY)
+        if base_version_uid is None:
+            return None, 0
+        return VersionUid(base_version_uid), metadata.get(self._DELTA_DEPTH_KEY, 1)
+
+    def write_version(self,
+                      version_uid: VersionUid,
+                      data: Union[str, bytes],
+                      overwrite: Optional[bool] = False,
+                      base_version_uid: VersionUid = None,
+                      delta_depth: int = 0) -> None:
         key = version_uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
 
         if not overwrite:
             try:
@@ -396,47 +792,50 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
             else:
                 raise FileExistsError('Version {} already exists in storage.'.format(version_uid))
 
-        data_bytes = data.encode('utf-8')
+        data_bytes = data.encode('utf-8') if isinstance(data, str) else data
         size = len(data_bytes)
 
         data_bytes, transforms_metadata = self._encapsulate(data_bytes)
+        extra_metadata = None
+        if base_version_uid is not None:
+            extra_metadata = {self._BASE_VERSION_UID_KEY: str(base_version_uid), self._DELTA_DEPTH_KEY: delta_depth}
         metadata, metadata_json = self._build_metadata(size=size,
                                                        object_size=len(data_bytes),
-                                                       transforms_metadata=transforms_metadata)
+                                                       transforms_metadata=transforms_metadata,
+                                                       extra_metadata=extra_metadata)
 
         try:
-            self._write_object(key, data_bytes)
-            self._write_object(metadata_key, metadata_json)
+            self._write_object_with_metadata(key, data_bytes, metadata_json)
         except:
             try:
-                self._rm_object(key)
-                self._rm_object(metadata_key)
+                self._rm_object_with_metadata(key)
             except FileNotFoundError:
                 pass
             raise
 
         if self._consistency_check_writes:
-            self._check_write(key=key, metadata_key=metadata_key, data_expected=data_bytes)
+            self._check_write(key=key, data_expected=data_bytes)
 
     def rm_version(self, version_uid: VersionUid) -> None:
-        key = version_uid.storage_object_to_path()
-        metadata_key = key + self._META_SUFFIX
-        try:
-            self._rm_object(key)
-        finally:
-            try:
-                self._rm_object(metadata_key)
-            except FileNotFoundError:
-                pass
+        self._rm_object_with_metadata(version_uid.storage_object_to_path())
 
-    def storage_stats(self) -> Tuple[int, int]:
+    def _shard_stats(self, prefix: str) -> Tuple[int, int]:
         objects_count = 0
         objects_size = 0
-        for key, size in cast(Iterable[Tuple[str, int]], self._list_objects(include_size=True)):
+        for key, size in cast(Iterable[Tuple[str, int]], self._list_objects(prefix, include_size=True)):
             objects_count += 1
             objects_size += size
         return objects_count, objects_size
 
+    def storage_stats(self) -> Tuple[int, int]:
+        objects_count = 0
+        objects_size = 0
+        for prefix in (BlockUid.storage_prefix(), VersionUid.storage_prefix(), self._PACK_PREFIX):
+            for shard_objects_count, shard_objects_size in self._list_shards(prefix, self._shard_stats):
+                objects_count += shard_objects_count
+                objects_size += shard_objects_size
+        return objects_count, objects_size
+
     def _encapsulate(self, data: bytes) -> Tuple[bytes, List]:
         if self._active_transforms is not None:
             transforms_metadata = []
@@ -476,6 +875,9 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
         return False
 
     def close(self) -> None:
+        if self._pack_buffers:
+            logger.warning('Storage {} is being closed with {} partially filled packs, discarding them.'.format(
+                self._name, len(self._pack_buffers)))
         self._read_executor.shutdown()
         self._write_executor.shutdown()
         self._remove_executor.shutdown()
@@ -488,6 +890,48 @@ class StorageBase(ReprMixIn, metaclass=ABCMeta):
     def _read_object(self, key: str) -> bytes:
         raise NotImplementedError
 
+    # The following three methods store the metadata of an object in a separate object. Storage modules which are able
+    # to store metadata together with the object data can override them, but they must still be able to read and
+    # remove objects with separate metadata objects.
+    def _write_object_with_metadata(self, key: str, data: bytes, metadata_json: bytes) -> None:
+        self._write_object(key, data)
+        self._write_object(key + self._META_SUFFIX, metadata_json)
+
+    def _read_object_with_metadata(self, key: str, *, metadata_only: bool) -> Tuple[Optional[bytes], int, bytes]:
+        """ Returns a tuple of data (None if metadata_only is True), data length and metadata. """
+        data: Optional[bytes] = None
+        if metadata_only:
+            data_length = self._read_object_length(key)
+        else:
+            data = self._read_object(key)
+            data_length = len(data)
+        return data, data_length, self._read_object(key + self._META_SUFFIX)
+
+    def _rm_object_with_metadata(self, key: str) -> None:
+        try:
+            self._rm_object(key)
+        finally:
+            try:
+                self._rm_object(key + self._META_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
+        """ Removes many objects and returns the keys of the objects which didn't exist. Storage modules which can
+        remove many objects with a single request should override this.
+        """
+        missing_keys = []
+        for key in keys:
+            try:
+                self._rm_object(key)
+            except FileNotFoundError:
+                missing_keys.append(key)
+        return missing_keys
+
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        # Fallback for storage modules without support for ranged reads
+        return self._read_object(key)[offset:offset + length]
+
     @abstractmethod
     def _read_object_length(self, key: str) -> int:
         raise NotImplementedError
@@ -50,6 +50,18 @@ class Storage(StorageBase):
 
         return data
 
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        filename = os.path.join(self.path, key)
+
+        if not os.path.exists(filename):
+            raise FileNotFoundError('File {} not found.'.format(filename))
+
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+
+        return data
+
     def _read_object_length(self, key: str) -> int:
         filename = os.path.join(self.path, key)
 
@@ -65,15 +77,6 @@ class Storage(StorageBase):
             raise FileNotFoundError('File {} not found.'.format(filename))
         os.unlink(filename)
 
-    # def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
-    #     errors = []
-    #     for key in keys:
-    #         try:
-    #             self._rm_object(key)
-    #         except FileNotFoundError:
-    #             errors.append(key)
-    #     return errors
-
     def _list_objects(self, prefix: str = None,
                       include_size: bool = False) -> Union[Iterable[str], Iterable[Tuple[str, int]]]:
         for root, dirnames, filenames in os.walk(os.path.join(self.path, prefix) if prefix is not None else self.path):
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 import threading
-from typing import Iterable, Union, Tuple
+from io import BytesIO
+from typing import Iterable, Union, Tuple, Optional, Dict, Sequence, List, Any
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config as BotoCoreClientConfig
 from botocore.exceptions import ClientError
 from botocore.handlers import set_list_objects_encoding_type_url
@@ -18,6 +20,13 @@ class Storage(ReadCacheStorageBase):
     WRITE_QUEUE_LENGTH = 20
     READ_QUEUE_LENGTH = 20
 
+    _USER_METADATA_KEY = 'benji-metadata'
+    # S3 limits the user-defined metadata of an object to 2 KB (key names and values). Leave some room for other
+    # metadata which might be added by the S3 implementation. Larger metadata falls back to a separate object.
+    _USER_METADATA_MAXIMUM_LENGTH = 1800
+    # S3 handles at most 1000 keys per DeleteObjects request
+    _MULTI_DELETE_MAXIMUM_KEYS = 1000
+
     def __init__(self, *, config: Config, name: str, module_configuration: ConfigDict):
         aws_access_key_id = Config.get_from_dict(module_configuration, 'awsAccessKeyId', None, types=str)
         if aws_access_key_id is None:
@@ -41,6 +50,12 @@ class Storage(ReadCacheStorageBase):
         self._bucket_name = Config.get_from_dict(module_configuration, 'bucketName', types=str)
         self._storage_class = Config.get_from_dict(module_configuration, 'storageClass', None, types=str)
         self._disable_encoding_type = Config.get_from_dict(module_configuration, 'disableEncodingType', types=bool)
+        self._use_user_metadata = Config.get_from_dict(module_configuration, 'useUserMetadata', types=bool)
+        self._multi_delete = Config.get_from_dict(module_configuration, 'multiDelete', types=bool)
+        multipart_threshold = Config.get_from_dict(module_configuration, 'multipartThreshold', types=int)
+        multipart_chunk_size = Config.get_from_dict(module_configuration, 'multipartChunkSize', types=int)
+        self._transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                               multipart_chunksize=multipart_chunk_size)
 
         self._resource_config = {
             'aws_access_key_id': aws_access_key_id,
@@ -88,13 +103,82 @@ class Storage(ReadCacheStorageBase):
             self._local.resource = self._local.session.resource('s3', **self._resource_config)
             self._local.bucket = self._local.resource.Bucket(self._bucket_name)
 
+    def _put_object(self, key: str, data: bytes, metadata: Optional[Dict[str, str]] = None) -> None:
+        self._init_connection()
+        put_arguments: Dict[str, Any] = {}
+        if self._storage_class is not None:
+            put_arguments['StorageClass'] = self._storage_class
+        if metadata is not None:
+            put_arguments['Metadata'] = metadata
+        if len(data) >= self._transfer_config.multipart_threshold:
+            # Large objects (usually metadata backups) are uploaded in parts which are transferred in parallel.
+            with BytesIO(data) as data_file:
+                self._local.bucket.upload_fileobj(data_file, key, ExtraArgs=put_arguments, Config=self._transfer_config)
+        else:
+            self._local.bucket.Object(key).put(Body=data, **put_arguments)
+
     def _write_object(self, key: str, data: bytes) -> None:
+        self._put_object(key, data)
+
+    def _write_object_with_metadata(self, key: str, data: bytes, metadata_json: bytes) -> None:
+        if self._use_user_metadata and len(metadata_json) <= self._USER_METADATA_MAXIMUM_LENGTH:
+            # The JSON encoding is pure ASCII, so it is safe to transfer it as an HTTP header value.
+            self._put_object(key, data, metadata={self._USER_METADATA_KEY: metadata_json.decode('ascii')})
+        else:
+            super()._write_object_with_metadata(key, data, metadata_json)
+
+    # Objects written with useUserMetadata disabled or by older versions of Benji don't have any user metadata, so
+    # we always check for it and fall back to the separate metadata object if it's missing.
+    def _read_object_with_metadata(self, key: str, *, metadata_only: bool) -> Tuple[Optional[bytes], int, bytes]:
         self._init_connection()
         object = self._local.bucket.Object(key)
-        if self._storage_class is not None:
-            object.put(Body=data, StorageClass=self._storage_class)
+        data: Optional[bytes] = None
+        try:
+            if metadata_only:
+                object.load()
+                data_length = object.content_length
+                user_metadata = object.metadata
+            else:
+                data_dict = object.get()
+                data = data_dict['Body'].read()
+                data_length = len(data)
+                user_metadata = data_dict.get('Metadata', {})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                raise FileNotFoundError('Key {} not found.'.format(key)) from None
+            else:
+                raise
+
+        if user_metadata and self._USER_METADATA_KEY in user_metadata:
+            metadata_json = user_metadata[self._USER_METADATA_KEY].encode('ascii')
         else:
-            object.put(Body=data)
+            metadata_json = self._read_object(key + self._META_SUFFIX)
+
+        return data, data_length, metadata_json
+
+    def _rm_object_with_metadata(self, key: str) -> None:
+        self._init_connection()
+        object = self._local.bucket.Object(key)
+        try:
+            object.load()
+            has_user_metadata = bool(object.metadata) and self._USER_METADATA_KEY in object.metadata
+            object.delete()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                # Remove a possibly orphaned metadata object
+                try:
+                    self._rm_object(key + self._META_SUFFIX)
+                except FileNotFoundError:
+                    pass
+                raise FileNotFoundError('Key {} not found.'.format(key)) from None
+            else:
+                raise
+
+        if not has_user_metadata:
+            try:
+                self._rm_object(key + self._META_SUFFIX)
+            except FileNotFoundError:
+                pass
 
     def _read_object(self, key: str) -> bytes:
         self._init_connection()
@@ -110,6 +194,20 @@ class Storage(ReadCacheStorageBase):
 
         return data
 
+    def _read_object_range(self, key: str, offset: int, length: int) -> bytes:
+        self._init_connection()
+        object = self._local.bucket.Object(key)
+        try:
+            data_dict = object.get(Range='bytes={}-{}'.format(offset, offset + length - 1))
+            data = data_dict['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                raise FileNotFoundError('Key {} not found.'.format(key)) from None
+            else:
+                raise
+
+        return data
+
     def _read_object_length(self, key: str) -> int:
         self._init_connection()
         object = self._local.bucket.Object(key)
@@ -137,29 +235,32 @@ class Storage(ReadCacheStorageBase):
             else:
                 raise
 
-    # def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
-    #     self._init_connection()
-    #     errors: List[str] = []
-    #     if self._multi_delete:
-    #         # Amazon (at least) only handles 1000 deletes at a time
-    #         # Split list into parts of at most 1000 elements
-    #         keys_parts = [islice(keys, i, i + 1000) for i in range(0, len(keys), 1000)]
-    #         for part in keys_parts:
-    #             response = self._local.resource.meta.client.delete_objects(
-    #                 Bucket=self._local.bucket.name, Delete={
-    #                     'Objects': [{
-    #                         'Key': key
-    #                     } for key in part],
-    #                 })
-    #             if 'Errors' in response:
-    #                 errors += list(map(lambda object: object['Key'], response['Errors']))
-    #     else:
-    #         for key in keys:
-    #             try:
-    #                 self._local.bucket.Object(key).delete()
-    #             except ClientError:
-    #                 errors.append(key)
-    #     return errors
+    def _rm_many_objects(self, keys: Sequence[str]) -> List[str]:
+        if not self._multi_delete:
+            return super()._rm_many_objects(keys)
+
+        self._init_connection()
+        missing_keys = []
+        for i in range(0, len(keys), self._MULTI_DELETE_MAXIMUM_KEYS):
+            response = self._local.resource.meta.client.delete_objects(
+                Bucket=self._bucket_name,
+                Delete={
+                    'Objects': [{
+                        'Key': key
+                    } for key in keys[i:i + self._MULTI_DELETE_MAXIMUM_KEYS]],
+                    'Quiet': True,
+                })
+            # S3 itself doesn't report missing keys but some S3 compatible implementations do.
+            errors = []
+            for error in response.get('Errors', []):
+                if error['Code'] == 'NoSuchKey':
+                    missing_keys.append(error['Key'])
+                else:
+                    errors.append(error)
+            if errors:
+                raise RuntimeError('Removal of {} object(s) failed, first error for key {}: {} ({}).'.format(
+                    len(errors), errors[0]['Key'], errors[0].get('Message', ''), errors[0]['Code']))
+        return missing_keys
 
     def _list_objects(self,
                       prefix: str = None,
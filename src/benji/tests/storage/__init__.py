@@ -61,9 +61,10 @@ class StorageTestCase(StorageTestCaseBase):
             data_by_uid[block.uid] = data
 
         self.storage.wait_writes_finished()
+        self.storage.flush_writes()
 
-        for _ in self.storage.write_get_completed(timeout=1):
-            pass
+        written_uids = [block.uid for block in self.storage.write_get_completed(timeout=1)]
+        self.assertEqual({block.uid for block in blocks}, set(written_uids))
 
         saved_uids = list(self.storage.list_blocks())
         self.assertEqual(NUM_BLOBS, len(saved_uids))
@@ -90,6 +91,27 @@ class StorageTestCase(StorageTestCaseBase):
         saved_uids = list(self.storage.list_blocks())
         self.assertEqual(0, len(saved_uids))
 
+    def test_rm_many_blocks_async(self):
+        NUM_BLOBS = 25
+        BLOB_SIZE = 4096
+
+        blocks = [
+            Block(uid=BlockUid(i + 1, i + 100), size=BLOB_SIZE, checksum='0000000000000000') for i in range(NUM_BLOBS)
+        ]
+        for block in blocks:
+            self.storage.write_block_async(block, self.random_bytes(BLOB_SIZE))
+
+        self.storage.wait_writes_finished()
+        self.storage.flush_writes()
+        self.assertEqual(NUM_BLOBS, len(list(self.storage.write_get_completed(timeout=1))))
+
+        self.storage.rm_many_blocks_async([block.uid for block in blocks])
+        self.storage.wait_rms_finished()
+
+        removed_uids = list(self.storage.rm_get_completed(timeout=1))
+        self.assertEqual({block.uid for block in blocks}, set(removed_uids))
+        self.assertEqual(0, len(list(self.storage.list_blocks())))
+
     def test_not_exists(self):
         block = Block(uid=BlockUid(1, 2), size=15, checksum='00000000000000000000')
         self.storage.write_block(block, b'test_not_exists')
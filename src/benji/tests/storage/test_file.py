@@ -1,5 +1,9 @@
+import copy
 from unittest import TestCase
+from unittest.mock import patch
 
+from benji.database import Block, BlockUid
+from benji.storage.base import InvalidBlockException, BlockNotFoundError
 from . import StorageTestCase
 
 
@@ -25,3 +29,105 @@ class StorageTestFile(StorageTestCase, TestCase):
             - name: file
               module: file              
         """
+
+
+class StorageTestFilePacking(StorageTestCase, TestCase):
+    CONFIG = """
+        configurationVersion: '1'
+        logFile: /dev/stderr
+        databaseEngine: sqlite://
+        defaultStorage: storage-1
+
+        storages:
+          - name: storage-1
+            module: file
+            configuration:
+              path: {testpath}/data
+              consistencyCheckWrites: True
+              # Blocks are distributed to the packs in the order they are written
+              simultaneousWrites: 1
+              packing:
+                packSize: 16384
+                compactionThreshold: 0.5
+              hmac:
+                password: geheim12345
+                kdfIterations: 1000
+                kdfSalt: BBiZ+lIVSefMCdE4eOPX211n/04KY1M4c2SM/9XHUcA=
+
+        ios:
+            - name: file
+              module: file
+        """
+
+    def test_write_rm_packed(self):
+        NUM_BLOBS = 40
+        BLOB_SIZE = 4096
+
+        blocks = [Block(uid=BlockUid(1, i + 1), size=BLOB_SIZE, checksum='0000000000000000') for i in range(NUM_BLOBS)]
+        data_by_uid = {}
+        for block in blocks:
+            data = self.random_bytes(BLOB_SIZE)
+            self.storage.write_block_async(block, data)
+            data_by_uid[block.uid] = data
+        self.storage.flush_writes()
+
+        written_uids = [block.uid for block in self.storage.write_get_completed(timeout=5)]
+        self.assertEqual(NUM_BLOBS, len(written_uids))
+        self.assertEqual({block.uid for block in blocks}, set(written_uids))
+        self.assertEqual({block.uid for block in blocks}, set(self.storage.list_blocks()))
+
+        # Ten packs with four blocks each and one index
+        objects_count, objects_size = self.storage.storage_stats()
+        self.assertEqual(NUM_BLOBS // 4 + 1, objects_count)
+
+        for block in blocks:
+            self.assertEqual(data_by_uid[block.uid], self.storage.read_block(block))
+            self.assertIsNone(self.storage.read_block(block, metadata_only=True))
+
+        # Outdated pack indexes cached before the packs are rewritten don't lead to invalid blocks
+        outdated_pack_indexes = copy.deepcopy(self.storage._pack_index_cache)
+
+        # Removing three of four blocks leads to rewriting of all packs
+        for block in blocks:
+            if block.uid.right % 4 != 0:
+                self.storage.rm_block(block.uid)
+        self.assertRaises(BlockNotFoundError, lambda: self.storage.rm_block(blocks[0].uid))
+        self.assertRaises(InvalidBlockException, lambda: self.storage.read_block(blocks[0]))
+        objects_count, compacted_objects_size = self.storage.storage_stats()
+        self.assertEqual(NUM_BLOBS // 4 + 1, objects_count)
+        self.assertLess(compacted_objects_size, objects_size // 2)
+        for block in blocks:
+            if block.uid.right % 4 == 0:
+                self.assertEqual(data_by_uid[block.uid], self.storage.read_block(block))
+
+        self.storage._pack_index_cache.update(outdated_pack_indexes)
+        for block in blocks:
+            if block.uid.right % 4 == 0:
+                self.assertEqual(data_by_uid[block.uid], self.storage.read_block(block))
+        self.assertRaises(InvalidBlockException, lambda: self.storage.read_block(blocks[0]))
+
+        for block in blocks:
+            if block.uid.right % 4 == 0:
+                self.storage.rm_block(block.uid)
+        self.assertEqual(0, len(list(self.storage.list_blocks())))
+        self.assertEqual((0, 0), self.storage.storage_stats())
+
+    def test_rm_many_packed_blocks_without_packing(self):
+        NUM_BLOBS = 8
+        BLOB_SIZE = 4096
+
+        blocks = [Block(uid=BlockUid(1, i + 1), size=BLOB_SIZE, checksum='0000000000000000') for i in range(NUM_BLOBS)]
+        for block in blocks:
+            self.storage.write_block_async(block, self.random_bytes(BLOB_SIZE))
+        self.storage.flush_writes()
+        self.assertEqual(NUM_BLOBS, len(list(self.storage.write_get_completed(timeout=5))))
+
+        # Blocks packed earlier are removed from their packs after packing has been disabled, even when the storage
+        # module doesn't report missing objects
+        with patch.object(self.storage, '_pack_size', None), patch.object(self.storage, '_rm_many_objects',
+                                                                          lambda keys: []):
+            self.storage.rm_many_blocks_async([block.uid for block in blocks])
+            self.storage.wait_rms_finished()
+        self.assertEqual({block.uid for block in blocks}, set(self.storage.rm_get_completed(timeout=1)))
+        self.assertEqual(0, len(list(self.storage.list_blocks())))
+        self.assertEqual((0, 0), self.storage.storage_stats())
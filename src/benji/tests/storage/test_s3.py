@@ -54,3 +54,8 @@ class test_s3(StorageTestCase, TestCase):
             - name: file
               module: file                  
         """
+
+
+@unittest.skipIf(os.environ.get('UNITTEST_SKIP_S3', False), 'No S3 setup available.')
+class test_s3_user_metadata(StorageTestCase, TestCase):
+    CONFIG = test_s3.CONFIG.replace('disableEncodingType: true', 'disableEncodingType: true\n            useUserMetadata: true')
@@ -171,6 +171,7 @@ class ConfigTestCase(TestCaseBase, TestCase):
                 'simultaneousReads': 3,
                 'simultaneousWrites': 3,
                 'simultaneousRemovals': 5,
+                'simultaneousListings': 8,
             }, config.validate(module='benji.storage.file', config=module_configuration))
         module_configuration = {'asdasdas': 'dasdasd'}
         self.assertRaises(ConfigurationError,
@@ -1,14 +1,18 @@
 import datetime
+import random
 import time
 import timeit
 import uuid
 from typing import List, Dict, Any
 from unittest import TestCase
+from unittest.mock import patch
 
 import math
+import sqlalchemy
 from dateutil import tz
 
-from benji.database import BlockUid, VersionUid, VersionStatus, Version, Storage, DeletedBlock, Locking
+from benji.database import BlockUid, VersionUid, VersionStatus, Version, Storage, BlockReference, Locking, Session, \
+    Block, SparseBlockRun
 from benji.exception import InternalError, UsageError, AlreadyLocked
 from benji.logging import logger
 from benji.tests.testcase import DatabaseBackendTestCaseBase
@@ -106,12 +110,10 @@ class DatabaseBackendTestCase(DatabaseBackendTestCaseBase):
 
         for idx, checksum in enumerate(checksums):
             block = version.get_block_by_checksum(checksum)
-            self.assertEqual(idx, block.idx)
-            self.assertEqual(version.id, block.version_id)
+            self.assertEqual(version.storage_id, block.storage_id)
             self.assertEqual(uids[idx], block.uid)
             self.assertEqual(checksum, block.checksum)
             self.assertEqual(1024 * 4096, block.size)
-            self.assertTrue(block.valid)
 
         for idx, uid in enumerate(uids):
             block = version.get_block_by_idx(idx)
@@ -146,13 +148,435 @@ class DatabaseBackendTestCase(DatabaseBackendTestCaseBase):
 
         version.remove()
         deleted_count = 0
-        for uids_deleted in DeletedBlock.get_unused_block_uids(-1):
+        for uids_deleted in BlockReference.get_unused_block_uids(-1):
             for storage in uids_deleted.values():
                 for uid in storage:
                     self.assertIn(uid, uids)
                     deleted_count += 1
         self.assertEqual(num_blocks, deleted_count)
 
+    def test_block_insert_many(self):
+        Storage.sync('s-1', storage_id=1)
+        version = Version.create(version_uid=VersionUid('v1'),
+                                 volume='name-' + self.random_string(12),
+                                 snapshot='snapshot-name-' + self.random_string(12),
+                                 size=16 * 4096,
+                                 block_size=4096,
+                                 storage_id=1)
+        blocks = []
+        for idx in range(16):
+            sparse = idx % 4 == 0
+            blocks.append({
+                'version_id': version.id,
+                'idx': idx,
+                'uid_left': None if sparse else 1,
+                'uid_right': None if sparse else idx,
+                'checksum': None if sparse else self.random_hex(64),
+                'size': 4096 - idx,
+                'valid': idx % 3 != 0,
+            })
+        Block.insert_many(blocks)
+        Session.commit()
+
+        self.assertEqual([(block['idx'], BlockUid(block['uid_left'], block['uid_right']), block['checksum'],
+                           block['size'], block['valid']) for block in blocks],
+                         [(block.idx, block.uid, block.checksum, block.size, block.valid) for block in version.blocks])
+
+    def test_block_writer(self):
+        Storage.sync('s-1', storage_id=1)
+        version = Version.create(version_uid=VersionUid('v1'),
+                                 volume='name-' + self.random_string(12),
+                                 snapshot='snapshot-name-' + self.random_string(12),
+                                 size=2048 * 4096,
+                                 block_size=4096,
+                                 storage_id=1)
+
+        checksums = [self.random_hex(32) for _ in range(2048)]
+        block_writer = version.block_writer()
+        for idx in range(2048):
+            block_writer.set_block(idx=idx, block_uid=BlockUid(1, idx + 1), checksum=checksums[idx], size=4096, valid=True)
+            if idx < 1500:
+                block_writer.set_resume_idx(idx + 1)
+        block_writer.close()
+        version.commit()
+        self.assertEqual(0, block_writer.pending)
+        self.assertEqual(0, version.sparse_blocks_count)
+        self.assertEqual(1500, Version.get_by_uid(VersionUid('v1')).resume_idx)
+
+        block_writer = version.block_writer()
+        for idx in range(0, 2048, 2):
+            # Turn every other block sparse
+            block_writer.set_block(idx=idx, block_uid=BlockUid(None, None), checksum=None, size=4096, valid=True)
+        # Later updates of the same block take precedence
+        block_writer.set_block(idx=1, block_uid=BlockUid(2, 2), checksum=checksums[0], size=4096, valid=False)
+        block_writer.set_block(idx=1, block_uid=BlockUid(3, 3), checksum=checksums[1], size=4096, valid=True)
+        block_writer.close()
+        version.commit()
+
+        self.assertEqual(1024, version.sparse_blocks_count)
+        self.assertEqual([SparseBlockRun(idx, 1) for idx in range(0, 2048, 2)], list(version.sparse_extents()))
+        for block in version.blocks:
+            if block.idx % 2 == 0:
+                self.assertFalse(block.uid)
+            elif block.idx == 1:
+                self.assertEqual(BlockUid(3, 3), block.uid)
+                self.assertEqual(checksums[1], block.checksum)
+                self.assertTrue(block.valid)
+            else:
+                self.assertEqual(BlockUid(1, block.idx + 1), block.uid)
+                self.assertEqual(checksums[block.idx], block.checksum)
+
+    def test_block_references(self):
+        Storage.sync('s-1', storage_id=1)
+        versions = []
+        for i in range(2):
+            version = Version.create(version_uid=VersionUid('v{}'.format(i + 1)),
+                                     volume='name-' + self.random_string(12),
+                                     snapshot='snapshot-name-' + self.random_string(12),
+                                     size=16 * 4096,
+                                     block_size=4096,
+                                     storage_id=1)
+            block_writer = version.block_writer()
+            for idx in range(16):
+                # The first eight blocks are shared between both versions
+                block_uid = BlockUid(1, idx + 1) if idx < 8 else BlockUid(version.id, idx + 1)
+                block_writer.set_block(idx=idx,
+                                       block_uid=block_uid,
+                                       checksum=self.random_hex(64),
+                                       size=4096,
+                                       valid=True)
+            block_writer.close()
+            version.commit()
+            versions.append(version)
+
+        # Replace a block of the first version
+        versions[0].set_block(idx=15, block_uid=BlockUid(versions[0].id, 100), checksum=None, size=4096, valid=True)
+        versions[0].commit()
+
+        def unused_block_uids():
+            return {
+                uid for hit_list in BlockReference.get_unused_block_uids(-1) for uids in hit_list.values()
+                for uid in uids
+            }
+
+        self.assertEqual({BlockUid(versions[0].id, 16)}, unused_block_uids())
+
+        versions[0].remove()
+        self.assertEqual({BlockUid(versions[0].id, idx + 1) for idx in range(8, 15)} | {BlockUid(versions[0].id, 100)},
+                         unused_block_uids())
+
+        # Base a third version on the second one
+        version = Version.create(version_uid=VersionUid('v3'),
+                                 volume=versions[1].volume,
+                                 snapshot='snapshot-name-' + self.random_string(12),
+                                 size=16 * 4096,
+                                 block_size=4096,
+                                 storage_id=1)
+        version.initialize_blocks(base_version=versions[1])
+
+        versions[1].remove()
+        self.assertEqual(set(), unused_block_uids())
+
+        version.remove()
+        self.assertEqual({BlockUid(1, idx + 1) for idx in range(8)} |
+                         {BlockUid(versions[1].id, idx + 1) for idx in range(8, 16)}, unused_block_uids())
+        self.assertEqual(set(), unused_block_uids())
+
+    def test_compact_block_map(self):
+        Storage.sync('s-1', storage_id=1)
+        versions = []
+        for i, compact_block_map in enumerate((False, True)):
+            versions.append(
+                Version.create(version_uid=VersionUid(f'v{i + 1}'),
+                               volume='backup-name',
+                               snapshot='snapshot-name.{}'.format(i),
+                               size=3000 * 4096 + 100,
+                               block_size=4096,
+                               storage_id=1,
+                               compact_block_map=compact_block_map))
+        self.assertFalse(versions[0].compact_block_map)
+        self.assertTrue(versions[1].compact_block_map)
+
+        def block_tuples(blocks):
+            return [(block.idx, block.uid, block.checksum, block.size, block.valid) for block in blocks]
+
+        # Apply the same random changes to both versions and compare the results
+        block_writers = [version.block_writer() for version in versions]
+        for _ in range(4000):
+            idx = random.randrange(versions[0].blocks_count)
+            size = min(4096, versions[0].size - idx * 4096)
+            if random.random() < 0.2:
+                block_uid, checksum = BlockUid(None, None), None
+            else:
+                block_uid, checksum = BlockUid(1, random.randrange(1, 1000)), self.random_hex(32)
+            valid = random.random() < 0.9
+            for block_writer in block_writers:
+                block_writer.set_block(idx=idx, block_uid=block_uid, checksum=checksum, size=size, valid=valid)
+        for block_writer in block_writers:
+            block_writer.close()
+        for version in versions:
+            version.set_block(idx=1, block_uid=BlockUid(2, 1), checksum='aabbcc', size=4096, valid=True)
+            version.set_block(idx=2, block_uid=BlockUid(None, None), checksum=None, size=4096, valid=True)
+            version.set_block(idx=3000, block_uid=BlockUid(2, 2), checksum='ddeeff', size=100, valid=True)
+            version.commit()
+
+        self.assertEqual(block_tuples(versions[0].blocks), block_tuples(versions[1].blocks))
+        self.assertEqual(versions[0].invalid_blocks_by_idx(), versions[1].invalid_blocks_by_idx())
+        for version in versions:
+            self.assertEqual(block_tuples(version.blocks), block_tuples(version.dereferenced_blocks))
+            # Sparse blocks are only returned as runs
+            sparse_idxs = []
+            for block in version.block_runs():
+                if isinstance(block, SparseBlockRun):
+                    self.assertGreater(block.count, 0)
+                    sparse_idxs.extend(range(block.idx, block.idx + block.count))
+            sparse_block = (BlockUid(None, None), None, 4096, True)
+            self.assertEqual([(idx, *sparse_block) for idx in sparse_idxs],
+                             [block for block in block_tuples(version.blocks) if block[1:] == sparse_block])
+        self.assertEqual(versions[0].sparse_blocks_count, versions[1].sparse_blocks_count)
+        self.assertEqual(list(versions[0].sparse_extents()), list(versions[1].sparse_extents()))
+        self.assertEqual(versions[0].sparse_blocks_count,
+                         sum(extent.count for extent in versions[0].sparse_extents()))
+        idxs = [2999, 0, 1, 2, 1500, 1024, 1023] + list(range(900, 1100))
+        self.assertEqual(block_tuples(versions[0].blocks_by_idx(idxs)), block_tuples(versions[1].blocks_by_idx(idxs)))
+        self.assertEqual(block_tuples(versions[0].get_block_by_idx(idx) for idx in idxs),
+                         block_tuples(versions[1].get_block_by_idx(idx) for idx in idxs))
+
+        self.assertEqual({'v1', 'v2'}, Version.set_block_valid(BlockUid(2, 1), False))
+        self.assertEqual(block_tuples(versions[0].blocks), block_tuples(versions[1].blocks))
+        self.assertFalse(versions[1].get_block_by_idx(1).valid)
+
+        # References outside of the chunk the block was originally written to are found, too
+        for version in versions:
+            version.set_block(idx=2500, block_uid=BlockUid(2, 1), checksum='aabbcc', size=4096, valid=True)
+            version.commit()
+        self.assertEqual({'v1', 'v2'}, Version.set_block_valid(BlockUid(2, 1), False))
+        self.assertEqual(block_tuples(versions[0].blocks), block_tuples(versions[1].blocks))
+        self.assertFalse(versions[1].get_block_by_idx(1).valid)
+        self.assertFalse(versions[1].get_block_by_idx(2500).valid)
+
+        usage = Version.storage_usage()['s-1']
+        self.assertEqual(usage, Version.storage_usage('uid == "v1" or uid == "v2"')['s-1'])
+        usage = Version.storage_usage('uid == "v1"')['s-1']
+        self.assertEqual(usage, Version.storage_usage('uid == "v2"')['s-1'])
+
+        # Copy between all combinations of layouts including a smaller version
+        for i, (base_version, compact_block_map, size) in enumerate(
+            ((versions[0], True, versions[0].size), (versions[1], False, versions[1].size),
+             (versions[1], True, versions[1].size), (versions[1], True, 1500 * 4096 + 200))):
+            version = Version.create(version_uid=VersionUid(f'v{i + 3}'),
+                                     volume='backup-name',
+                                     snapshot='snapshot-name.{}'.format(i + 2),
+                                     size=size,
+                                     block_size=4096,
+                                     storage_id=1,
+                                     compact_block_map=compact_block_map)
+            version.initialize_blocks(base_version=base_version)
+            expected_blocks = block_tuples(base_version.blocks)[:version.blocks_count]
+            if size != base_version.size:
+                expected_blocks[-1] = (version.blocks_count - 1, BlockUid(None, None), None, 200, False)
+            self.assertEqual(expected_blocks, block_tuples(version.blocks))
+            versions.append(version)
+
+        def unused_block_uids():
+            return {
+                uid for hit_list in BlockReference.get_unused_block_uids(-1) for uids in hit_list.values()
+                for uid in uids
+            }
+
+        used_uids = {block.uid for version in versions for block in version.blocks if block.uid}
+        # Block UIDs which have been replaced by the random changes above
+        self.assertFalse(unused_block_uids() & used_uids)
+        for version in versions:
+            version.remove()
+        self.assertEqual(used_uids, unused_block_uids())
+
+    def test_block_checksums(self):
+        Storage.sync('s-1', storage_id=1)
+        versions = []
+        for i, compact_block_map in enumerate((False, True)):
+            version = Version.create(version_uid=VersionUid(f'v{i + 1}'),
+                                     volume='backup-name',
+                                     snapshot='snapshot-name.{}'.format(i),
+                                     size=4 * 4096,
+                                     block_size=4096,
+                                     storage_id=1,
+                                     compact_block_map=compact_block_map)
+            block_writer = version.block_writer()
+            for idx in range(4):
+                block_writer.set_block(idx=idx,
+                                       block_uid=BlockUid(i + 1, idx + 1),
+                                       checksum='{:02x}{:02x}'.format(i, idx),
+                                       size=4096,
+                                       valid=idx != 3)
+            block_writer.close()
+            version.commit()
+            versions.append(version)
+
+        for i, version in enumerate(versions):
+            for idx in range(3):
+                block = version.get_block_by_checksum('{:02x}{:02x}'.format(i, idx))
+                self.assertEqual(BlockUid(i + 1, idx + 1), block.uid)
+                self.assertEqual(4096, block.size)
+            # Invalid blocks are not recorded
+            self.assertIsNone(version.get_block_by_checksum('{:02x}03'.format(i)))
+        self.assertEqual(6, Version.storage_checksums_count(1))
+        self.assertEqual({(bytes([i, idx]), i + 1, idx + 1, 4096) for i in range(2) for idx in range(3)},
+                         set(Version.storage_checksums(1)))
+
+        # The same data written again with another block UID is recorded, too, the newest block UID is preferred
+        versions[0].set_block(idx=3, block_uid=BlockUid(3, 1), checksum='0101', size=4096, valid=True)
+        versions[0].commit()
+        self.assertEqual(BlockUid(3, 1), versions[0].get_block_by_checksum('0101').uid)
+        versions[1].set_block(idx=3, block_uid=BlockUid(2, 5), checksum='0001', size=4096, valid=True)
+        versions[1].commit()
+        self.assertEqual(BlockUid(2, 5), versions[0].get_block_by_checksum('0001').uid)
+        self.assertEqual(8, Version.storage_checksums_count(1))
+
+        Version.set_block_valid(BlockUid(1, 1), False)
+        self.assertIsNone(versions[0].get_block_by_checksum('0000'))
+
+        # Unreferenced blocks are not found anymore and their entries are removed by cleanup. Other blocks with the
+        # same data are still found.
+        versions[1].remove()
+        self.assertIsNone(versions[0].get_block_by_checksum('0100'))
+        self.assertEqual(BlockUid(1, 2), versions[0].get_block_by_checksum('0001').uid)
+        self.assertEqual(7, Version.storage_checksums_count(1))
+        for _ in BlockReference.get_unused_block_uids(-1):
+            pass
+        self.assertEqual(3, Version.storage_checksums_count(1))
+        self.assertEqual(BlockUid(3, 1), versions[0].get_block_by_checksum('0101').uid)
+        self.assertEqual(BlockUid(1, 2), versions[0].get_block_by_checksum('0001').uid)
+
+    def test_initialize_blocks(self):
+        Storage.sync('s-1', storage_id=1)
+        base_version = Version.create(version_uid=VersionUid('v1'),
+                                      volume='backup-name',
+                                      snapshot='snapshot-name',
+                                      size=10 * 4096 + 100,
+                                      block_size=4096,
+                                      storage_id=1)
+        blocks: List[Dict[str, Any]] = []
+        for idx in range(base_version.blocks_count):
+            if idx == 5:
+                # Sparse
+                continue
+            blocks.append({
+                'idx': idx,
+                'uid_left': 1,
+                'uid_right': idx + 1,
+                'checksum': self.random_hex(32),
+                'size': min(4096, base_version.size - idx * 4096),
+                'valid': True
+            })
+        base_version.create_blocks(blocks=blocks)
+        base_version.commit()
+        base_blocks = list(base_version.blocks)
+
+        # Same size
+        version = Version.create(version_uid=VersionUid('v2'),
+                                 volume='backup-name',
+                                 snapshot='snapshot-name',
+                                 size=base_version.size,
+                                 block_size=4096,
+                                 storage_id=1)
+        version.initialize_blocks(base_version=base_version)
+        for base_block, block in zip(base_blocks, version.blocks):
+            self.assertEqual((base_block.idx, base_block.uid, base_block.checksum, base_block.size, base_block.valid),
+                             (block.idx, block.uid, block.checksum, block.size, block.valid))
+
+        # Bigger, the old last block is reset, the new last block needs to be read
+        version = Version.create(version_uid=VersionUid('v3'),
+                                 volume='backup-name',
+                                 snapshot='snapshot-name',
+                                 size=12 * 4096 + 200,
+                                 block_size=4096,
+                                 storage_id=1)
+        version.initialize_blocks(base_version=base_version)
+        blocks = list(version.blocks)
+        self.assertEqual(13, len(blocks))
+        for block in blocks[:10]:
+            base_block = base_blocks[block.idx]
+            self.assertEqual((base_block.uid, base_block.checksum, base_block.size, base_block.valid),
+                             (block.uid, block.checksum, block.size, block.valid))
+        self.assertFalse(blocks[10].uid)
+        self.assertEqual(4096, blocks[10].size)
+        self.assertFalse(blocks[12].uid)
+        self.assertEqual(200, blocks[12].size)
+        self.assertFalse(blocks[12].valid)
+
+        # Smaller, the new last block is reset
+        version = Version.create(version_uid=VersionUid('v4'),
+                                 volume='backup-name',
+                                 snapshot='snapshot-name',
+                                 size=3 * 4096 + 300,
+                                 block_size=4096,
+                                 storage_id=1)
+        version.initialize_blocks(base_version=base_version)
+        blocks = list(version.blocks)
+        self.assertEqual(4, len(blocks))
+        self.assertEqual(base_blocks[2].uid, blocks[2].uid)
+        self.assertFalse(blocks[3].uid)
+        self.assertIsNone(blocks[3].checksum)
+        self.assertEqual(300, blocks[3].size)
+        self.assertFalse(blocks[3].valid)
+
+        # No base version
+        version = Version.create(version_uid=VersionUid('v5'),
+                                 volume='backup-name',
+                                 snapshot='snapshot-name',
+                                 size=3 * 4096 + 300,
+                                 block_size=4096,
+                                 storage_id=1)
+        version.initialize_blocks()
+        self.assertEqual(4, version.sparse_blocks_count)
+        self.assertEqual(300, version.get_block_by_idx(3).size)
+        self.assertFalse(version.get_block_by_idx(3).valid)
+
+    def test_blocks_by_idx(self):
+        Storage.sync('s-1', storage_id=1)
+        version = Version.create(version_uid=VersionUid('v1'),
+                                 volume='backup-name',
+                                 snapshot='snapshot-name',
+                                 size=2048 * 4096,
+                                 block_size=4096,
+                                 storage_id=1)
+        blocks: List[Dict[str, Any]] = []
+        for idx in range(0, 2048, 2):
+            blocks.append({
+                'idx': idx,
+                'uid_left': 1,
+                'uid_right': idx + 1,
+                'checksum': self.random_hex(32),
+                'size': 4096,
+                'valid': idx % 8 != 0
+            })
+        version.create_blocks(blocks=blocks)
+        version.commit()
+
+        idxs = list(range(0, 2048, 3))
+        blocks_by_idx = list(version.blocks_by_idx(idxs))
+        self.assertEqual(idxs, [block.idx for block in blocks_by_idx])
+        for block in blocks_by_idx:
+            if block.idx % 2 == 0:
+                self.assertEqual(BlockUid(1, block.idx + 1), block.uid)
+            else:
+                self.assertFalse(block.uid)
+                self.assertTrue(block.valid)
+
+        self.assertEqual(list(range(0, 2048, 8)), version.invalid_blocks_by_idx())
+
+        # Mix of contiguous runs, which are queried as ranges, and scattered indices
+        idxs = [7, 5] + list(range(100, 1200)) + list(range(1300, 1340)) + [2047, 3]
+        with patch.object(Version, 'BLOCKS_PER_CALL', 256):
+            batches = list(Version._idx_batches(idxs))
+            self.assertEqual([[7, 5], range(100, 356), range(356, 612), range(612, 868), range(868, 1124),
+                              range(1124, 1200), list(range(1300, 1340)) + [2047, 3]], batches)
+            blocks_by_idx = list(version.blocks_by_idx(idxs))
+        self.assertEqual(idxs, [block.idx for block in blocks_by_idx])
+        for block in blocks_by_idx:
+            self.assertEqual(BlockUid(1, block.idx + 1) if block.idx % 2 == 0 else BlockUid(None, None), block.uid)
+
     def test_lock_version(self):
         Locking.lock_version(VersionUid('v1'), reason='locking test')
         self.assertRaises(InternalError, lambda: Locking.lock_version(VersionUid('v1'), reason='locking test'))
@@ -432,6 +856,44 @@ class DatabaseBackendTestCase(DatabaseBackendTestCaseBase):
             self.assertEqual(VersionStatus.valid, versions[i].status)
             self.assertTrue(list(versions[i].blocks)[0].valid)
 
+    def test_set_block_valid_compact_block_map(self):
+        Storage.sync('s-1', storage_id=1)
+        versions = []
+        for i in range(3):
+            version = Version.create(version_uid=VersionUid(f'v{i + 1}'),
+                                     volume='backup-name',
+                                     snapshot='snapshot-name.{}'.format(i),
+                                     size=4 * 4096,
+                                     block_size=4096,
+                                     storage_id=1,
+                                     compact_block_map=True)
+            if i == 1:
+                version.initialize_blocks(base_version=versions[0])
+            else:
+                for idx in range(4):
+                    version.set_block(idx=idx,
+                                      block_uid=BlockUid(version.id, idx + 1),
+                                      checksum=self.random_hex(32),
+                                      size=4096,
+                                      valid=True)
+                version.commit()
+            versions.append(version)
+
+        # Only the chunks of versions referencing blocks written by the first version are decoded
+        read_chunks = Version._read_chunks
+        decoded_version_uids = set()
+
+        def recording_read_chunks(version, chunk_idxs):
+            decoded_version_uids.add(version.uid)
+            return read_chunks(version, chunk_idxs)
+
+        with patch.object(Version, '_read_chunks', recording_read_chunks):
+            self.assertEqual({'v1', 'v2'}, Version.set_block_valid(BlockUid(versions[0].id, 2), False))
+        self.assertEqual({'v1', 'v2'}, decoded_version_uids)
+        for version in versions[:2]:
+            self.assertEqual([1], version.invalid_blocks_by_idx())
+        self.assertEqual([], versions[2].invalid_blocks_by_idx())
+
     def test_version_blocks_count(self):
         Storage.sync('s-1', storage_id=1)
         for i in range(256):
@@ -535,6 +997,20 @@ class DatabaseBackendTestSQLLite(DatabaseBackendTestCase, TestCase):
         databaseEngine: sqlite:///{testpath}/benji.sqlite
         """
 
+    def test_sqlite_pragmas(self):
+        # SQLite reports some pragmas as integers, see https://www.sqlite.org/pragma.html.
+        synchronous_values = {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3}
+        temp_store_values = {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2}
+        pragmas = {
+            'journal_mode': self.config.get('sqlite.journalMode', types=str).lower(),
+            'synchronous': synchronous_values[self.config.get('sqlite.synchronous', types=str)],
+            'cache_size': self.config.get('sqlite.cacheSize', types=int),
+            'mmap_size': self.config.get('sqlite.mmapSize', types=int),
+            'temp_store': temp_store_values[self.config.get('sqlite.tempStore', types=str)],
+        }
+        for name, value in pragmas.items():
+            self.assertEqual(value, Session.execute(sqlalchemy.text('PRAGMA {}'.format(name))).scalar())
+
 
 class DatabaseBackendTestSQLLiteInMemory(DatabaseBackendTestCase, TestCase):
 
@@ -0,0 +1,140 @@
+import os
+from binascii import unhexlify
+from typing import List, Dict, Any
+from unittest import TestCase
+from unittest.mock import patch
+
+from parameterized import parameterized
+
+from benji.database import VersionUid, Version, Storage, BlockUid
+from benji.dedupindex import DedupIndex, BloomFilterDedupIndex, DatabaseDedupIndex, MemoryDedupIndex
+from benji.tests.testcase import DatabaseBackendTestCaseBase
+
+
+class DedupIndexTestCase(DatabaseBackendTestCaseBase, TestCase):
+
+    CONFIG = """
+        configurationVersion: '1'
+        logFile: /dev/stderr
+        ios:
+        - name: file
+          module: file
+        defaultStorage: s1
+        storages:
+        - name: s1
+          storageId: 1
+          module: file
+          configuration:
+            path: {testpath}/data
+        databaseEngine: sqlite:///{testpath}/benji.sqlite
+        dedupIndex:
+          mode: bloomFilter
+          bloomFilter:
+            directory: {testpath}/dedup-index
+        """
+
+    def _create_version(self, version_uid: str, num_blocks: int = 256) -> Version:
+        version = Version.create(version_uid=VersionUid(version_uid),
+                                 volume='name-' + self.random_string(12),
+                                 snapshot='snapshot-name-' + self.random_string(12),
+                                 size=num_blocks * 4096,
+                                 block_size=4096,
+                                 storage_id=1)
+
+        blocks: List[Dict[str, Any]] = []
+        for idx in range(num_blocks):
+            blocks.append({
+                'idx': idx,
+                'uid_left': version.id,
+                'uid_right': idx + 1,
+                'checksum': self.random_hex(32),
+                'size': 4096,
+                'valid': True
+            })
+        version.create_blocks(blocks=blocks)
+        version.commit()
+        return version
+
+    def _bloom_filter_dedup_index(self, version: Version) -> BloomFilterDedupIndex:
+        return BloomFilterDedupIndex(version=version,
+                                     directory=self.testpath.path + '/dedup-index',
+                                     false_positive_rate=0.001)
+
+    @parameterized.expand([('database',), ('memory',), ('bloom_filter',)])
+    def test_lookup(self, mode):
+        Storage.sync('s1', storage_id=1)
+        version = self._create_version('v1')
+
+        if mode == 'database':
+            dedup_index = DatabaseDedupIndex(version=version)
+        elif mode == 'memory':
+            dedup_index = MemoryDedupIndex(version=version)
+        else:
+            dedup_index = self._bloom_filter_dedup_index(version)
+        for block in version.blocks:
+            self.assertEqual((block.uid, block.size), dedup_index.lookup(block.checksum))
+        self.assertIsNone(dedup_index.lookup(self.random_hex(32)))
+
+        version_2 = self._create_version('v2', num_blocks=1)
+        block = version_2.get_block_by_idx(0)
+        dedup_index.add(block.checksum, block.uid, block.size)
+        self.assertEqual((block.uid, block.size), dedup_index.lookup(block.checksum))
+        dedup_index.close()
+
+    def test_memory_trust_period_expired(self):
+        Storage.sync('s1', storage_id=1)
+        version = self._create_version('v1')
+
+        with patch.object(MemoryDedupIndex, '_TRUST_PERIOD', 0):
+            dedup_index = MemoryDedupIndex(version=version)
+            for block in version.blocks:
+                self.assertEqual((block.uid, block.size), dedup_index.lookup(block.checksum))
+
+            # Stale entries are confirmed by the database
+            stale_checksum = self.random_hex(32)
+            dedup_index._index[unhexlify(stale_checksum)] = dedup_index._pack(1, 1, 4096)
+            self.assertIsNone(dedup_index.lookup(stale_checksum))
+
+            # Blocks added during the backup aren't in the database yet and are trusted
+            added_checksum = self.random_hex(32)
+            dedup_index.add(added_checksum, BlockUid(1000, 1), 4096)
+            self.assertEqual((BlockUid(1000, 1), 4096), dedup_index.lookup(added_checksum))
+            dedup_index.close()
+
+    def test_bloom_filter_incremental(self):
+        Storage.sync('s1', storage_id=1)
+        version = self._create_version('v1')
+
+        dedup_index = DedupIndex.create(config=self.config, version=version)
+        self.assertIsInstance(dedup_index, BloomFilterDedupIndex)
+        dedup_index.close()
+        self.assertTrue(os.path.exists(self.testpath.path + '/dedup-index/storage-1.bloom'))
+
+        version_2 = self._create_version('v2')
+        dedup_index = self._bloom_filter_dedup_index(version_2)
+        for block in list(version.blocks) + list(version_2.blocks):
+            self.assertEqual((block.uid, block.size), dedup_index.lookup(block.checksum))
+        self.assertEqual(512, dedup_index._count)
+
+    def test_bloom_filter_concurrent_versions(self):
+        Storage.sync('s1', storage_id=1)
+        version = self._create_version('v1')
+
+        dedup_index = self._bloom_filter_dedup_index(version)
+        # Blocks added during the backup aren't in the database yet
+        added_checksum = self.random_hex(32)
+        dedup_index.add(added_checksum, BlockUid(1000, 1), 4096)
+        self.assertEqual((BlockUid(1000, 1), 4096), dedup_index.lookup(added_checksum))
+        # Known checksums don't count against the capacity
+        count = dedup_index._count
+        for block in version.blocks:
+            dedup_index.add(block.checksum, block.uid, block.size)
+        self.assertEqual(count, dedup_index._count)
+        # A version written concurrently is committed before this filter is saved
+        version_2 = self._create_version('v2')
+        dedup_index.close()
+
+        dedup_index = self._bloom_filter_dedup_index(version_2)
+        for block in version_2.blocks:
+            self.assertEqual((block.uid, block.size), dedup_index.lookup(block.checksum))
+        dedup_index.close()
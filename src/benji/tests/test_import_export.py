@@ -5,10 +5,12 @@ import os
 import random
 import uuid
 from collections.abc import Iterable
-from io import StringIO
+from io import StringIO, BytesIO
 from unittest import TestCase
+from unittest.mock import patch
 
-from benji.database import VersionUid, VersionStatus, Block, Label
+from benji.database import VersionUid, VersionStatus, Block, Label, MetadataFormat, Database, _JSONStreamReader
+from benji.exception import InputDataError
 from benji.logging import logger
 from benji.tests.testcase import BenjiTestCaseBase
 from benji.utils import hints_from_rbd_diff
@@ -117,6 +119,151 @@ class ImportExportTestCase():
             self.assertIsInstance(block['valid'], bool)
             self.assertIsInstance(block['checksum'], (str, type(None)))
 
+    def test_export_import_stream(self):
+        benji_obj = self.benji_open(init_database=True)
+        benji_obj.close()
+        self.version_uids = self.generate_versions(self.testpath.path)
+        benji_obj = self.benji_open()
+        expected_blocks = {}
+        for version_uid, _ in self.version_uids:
+            expected_blocks[version_uid] = [(block.idx, block.uid, block.checksum, block.size, block.valid)
+                                            for block in benji_obj.get_version_by_uid(version_uid).blocks]
+        with StringIO() as f:
+            benji_obj.metadata_export([version_uid[0] for version_uid in self.version_uids], f)
+            export = f.getvalue()
+        benji_obj.close()
+
+        benji_obj = self.benji_open(init_database=True)
+        # Use a tiny read size so that values are split between reads
+        with patch.object(_JSONStreamReader, '_READ_SIZE', 7):
+            benji_obj.metadata_import(StringIO(export))
+        for version_uid, size in self.version_uids:
+            version = benji_obj.get_version_by_uid(version_uid)
+            self.assertEqual(size, version.size)
+            self.assertEqual(expected_blocks[version_uid],
+                             [(block.idx, block.uid, block.checksum, block.size, block.valid)
+                              for block in version.blocks])
+        benji_obj.close()
+
+    def test_export_import_binary(self):
+        benji_obj = self.benji_open(init_database=True)
+        benji_obj.close()
+        self.version_uids = self.generate_versions(self.testpath.path)
+        benji_obj = self.benji_open()
+        expected_versions = {}
+        for version_uid, _ in self.version_uids:
+            version = benji_obj.get_version_by_uid(version_uid)
+            expected_versions[version_uid] = (version.size, version.date, dict(version.labels),
+                                              [(block.idx, block.uid, block.checksum, block.size, block.valid)
+                                               for block in version.blocks])
+        exports = {}
+        for compress in (False, True):
+            with BytesIO() as f:
+                benji_obj.metadata_export([version_uid[0] for version_uid in self.version_uids],
+                                          f,
+                                          metadata_format=MetadataFormat.binary,
+                                          compress=compress)
+                exports[compress] = f.getvalue()
+        with StringIO() as f:
+            benji_obj.metadata_export([version_uid[0] for version_uid in self.version_uids], f)
+            exports['json'] = f.getvalue().encode('utf-8')
+        benji_obj.close()
+
+        self.assertLess(len(exports[True]), len(exports[False]))
+        self.assertLess(len(exports[False]), len(exports['json']))
+
+        for export in exports.values():
+            benji_obj = self.benji_open(init_database=True)
+            # The format is detected automatically
+            benji_obj.metadata_import(BytesIO(export))
+            for version_uid, expected_version in expected_versions.items():
+                version = benji_obj.get_version_by_uid(version_uid)
+                self.assertEqual(expected_version,
+                                 (version.size, version.date, dict(version.labels),
+                                  [(block.idx, block.uid, block.checksum, block.size, block.valid)
+                                   for block in version.blocks]))
+            benji_obj.close()
+
+        benji_obj = self.benji_open(init_database=True)
+        self.assertRaises(InputDataError, lambda: benji_obj.metadata_import(BytesIO(exports[False][:-1])))
+        self.assertRaises(InputDataError,
+                          lambda: benji_obj.metadata_import(BytesIO(exports['json']), MetadataFormat.binary))
+        benji_obj.close()
+
+    def test_read_versions(self):
+        benji_obj = self.benji_open(init_database=True)
+        benji_obj.close()
+        self.version_uids = self.generate_versions(self.testpath.path)
+        benji_obj = self.benji_open()
+        expected_versions = []
+        for version_uid, _ in self.version_uids:
+            version = benji_obj.get_version_by_uid(version_uid)
+            expected_versions.append((version.uid, version.size, version.block_size, version.storage.name,
+                                      [(block.idx, block.uid, block.checksum, block.size, block.valid)
+                                       for block in version.blocks]))
+        exports = []
+        for metadata_format in (MetadataFormat.json, MetadataFormat.binary):
+            with BytesIO() as f:
+                if metadata_format == MetadataFormat.json:
+                    with StringIO() as text_f:
+                        benji_obj.metadata_export([version_uid[0] for version_uid in self.version_uids], text_f)
+                        f.write(text_f.getvalue().encode('utf-8'))
+                else:
+                    benji_obj.metadata_export([version_uid[0] for version_uid in self.version_uids],
+                                              f,
+                                              metadata_format=metadata_format)
+                exports.append(f.getvalue())
+        benji_obj.close()
+
+        for export in exports:
+            versions = []
+            for version_dict, blocks in Database.read_versions(BytesIO(export)):
+                versions.append((version_dict['uid'], version_dict['size'], version_dict['block_size'],
+                                 version_dict['storage'],
+                                 [(block.idx, block.uid, block.checksum, block.size, block.valid) for block in blocks]))
+            self.assertEqual(expected_versions, versions)
+
+            # Blocks which aren't consumed are skipped
+            version_uids = [version_dict['uid'] for version_dict, _ in Database.read_versions(BytesIO(export))]
+            self.assertEqual([version_uid[0] for version_uid in self.version_uids], version_uids)
+
+    def test_export_delta(self):
+        benji_obj = self.benji_open(init_database=True)
+        benji_obj.close()
+        self.version_uids = self.generate_versions(self.testpath.path)
+        benji_obj = self.benji_open()
+        base_version_uid, version_uid = self.version_uids[0][0], self.version_uids[1][0]
+        base_blocks = {
+            block.idx: (block.uid, block.checksum, block.size, block.valid)
+            for block in benji_obj.get_version_by_uid(base_version_uid).blocks
+        }
+        expected_blocks = [(block.idx, block.uid, block.checksum, block.size, block.valid)
+                           for block in benji_obj.get_version_by_uid(version_uid).blocks]
+        for metadata_format in (MetadataFormat.json, MetadataFormat.binary):
+            with (StringIO() if metadata_format == MetadataFormat.json else BytesIO()) as f:
+                Database.export_delta(version_uid, base_version_uid, f, metadata_format=metadata_format)
+                export = f.getvalue()
+            if metadata_format == MetadataFormat.json:
+                export = export.encode('utf-8')
+
+            (version_dict, blocks), = list(
+                (version_dict, list(blocks)) for version_dict, blocks in Database.read_versions(BytesIO(export)))
+            self.assertEqual(version_uid, version_dict['uid'])
+            self.assertEqual(base_version_uid, version_dict['base_version_uid'])
+            merged_blocks = dict(base_blocks)
+            merged_blocks.update({block.idx: (block.uid, block.checksum, block.size, block.valid) for block in blocks})
+            self.assertEqual(expected_blocks, [(idx, *merged_blocks[idx]) for idx in range(len(expected_blocks))])
+
+            # Incremental exports can't be imported on their own
+            self.assertRaises(InputDataError, lambda: benji_obj.metadata_import(BytesIO(export)))
+        benji_obj.close()
+
+    def test_import_invalid(self):
+        benji_obj = self.benji_open(init_database=True)
+        for document in ('', '[]', '{"metadata_version": "3.0.0", "versions": [{"uid": "V1"', '{} {}'):
+            self.assertRaises(InputDataError, lambda: benji_obj.metadata_import(StringIO(document)))
+        benji_obj.close()
+
     def test_import_1_0_0(self):
         benji_obj = self.benji_open(init_database=True)
 
@@ -2,16 +2,23 @@
 import json
 import os
 import random
+import re
+import textwrap
 import unittest
 import uuid
 from functools import reduce
 from operator import and_
 from shutil import copyfile
 from unittest import TestCase
+from unittest.mock import patch
 
 from benji.blockuidhistory import BlockUidHistory
-from benji.database import VersionUid, Version
+from benji.config import Config
+from benji.database import VersionUid, Version, VersionStatus
+from benji.exception import UsageError, InputDataError
+from benji.io.file import IO as FileIO
 from benji.logging import logger
+from benji.storage.factory import StorageFactory
 from benji.tests.testcase import BenjiTestCaseBase
 from benji.utils import hints_from_rbd_diff
 
@@ -201,8 +208,11 @@ class SmokeTestCase(BenjiTestCaseBase):
             logger.debug('Restore successful')
 
             benji_obj = self.benji_open(in_memory_database=True)
-            benji_obj.metadata_restore([version_uid], storage_name)
-            benji_obj.restore(version_uid, 'file:' + restore_filename_mdl, sparse=False, force=False)
+            benji_obj.restore_from_metadata_backup(version_uid,
+                                                   'file:' + restore_filename_mdl,
+                                                   sparse=False,
+                                                   force=False,
+                                                   storage_name=storage_name)
             benji_obj.close()
             self.assertTrue(self.same(image_filename, restore_filename_mdl))
             logger.debug('Database-less non-sparse restore successful')
@@ -229,6 +239,10 @@ class SmokeTestCase(BenjiTestCaseBase):
                                                                         'latest10,hours24,days30')
                 for dismissed_version in dismissed_versions:
                     version_uids.remove(dismissed_version.uid)
+                # Incremental metadata backups based on removed versions have been replaced by full ones
+                for version in benji_obj.find_versions_with_filter():
+                    if version.metadata_backup_base_uid is not None:
+                        self.assertIn(version.metadata_backup_base_uid, version_uids)
                 benji_obj.close()
 
             if (i % 7) == 0:
@@ -245,6 +259,286 @@ class SmokeTestCase(BenjiTestCaseBase):
                 else:
                     storage_name = 's1'
 
+        benji_obj = self.benji_open()
+        benji_obj.metadata_backup(version_uids, overwrite=True)
+        storage_names = {version.uid: version.storage.name for version in benji_obj.find_versions_with_filter()}
+        benji_obj.close()
+        logger.debug('Metadata backup of all versions successful')
+
+        benji_obj = self.benji_open()
+        for version_uid in version_uids:
+            benji_obj.rm(version_uid, force=True, keep_metadata_backup=True)
+            benji_obj.metadata_restore([version_uid], storage_names[version_uid])
+        self.assertEqual(set(version_uids), {version.uid for version in benji_obj.find_versions_with_filter()})
+        benji_obj.close()
+        logger.debug('Metadata restore of all versions successful')
+
+    def test_rm_base_after_disabling_incremental_metadata_backups(self):
+        if self.config.get('metadataBackup.deltaChainLength', types=int) == 0:
+            self.skipTest('Incremental metadata backups are disabled.')
+        testpath = self.testpath.path
+        image_filename = os.path.join(testpath, 'image')
+        self.patch(image_filename, 0, self.random_bytes(16 * 4 * kB))
+
+        benji_obj = self.benji_open(init_database=True)
+        base_version_uid = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                            volume='data-backup',
+                                            snapshot='snapshot-name',
+                                            source='file:' + image_filename,
+                                            block_size=4 * kB).uid
+        self.patch(image_filename, 4 * kB, self.random_bytes(4 * kB))
+        version_uid = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                       volume='data-backup',
+                                       snapshot='snapshot-name',
+                                       source='file:' + image_filename,
+                                       block_size=4 * kB,
+                                       base_version_uid=base_version_uid).uid
+        self.assertEqual(base_version_uid, Version.get_by_uid(version_uid).metadata_backup_base_uid)
+        benji_obj.close()
+
+        self.config = Config(ad_hoc_config=re.sub(r'deltaChainLength: \d+', 'deltaChainLength: 0', self.CONFIG).format(
+            testpath=testpath))
+        benji_obj = self.benji_open()
+        benji_obj.rm(base_version_uid, force=True)
+        self.assertIsNone(Version.get_by_uid(version_uid).metadata_backup_base_uid)
+        benji_obj.rm(version_uid, force=True, keep_metadata_backup=True)
+        benji_obj.metadata_restore([version_uid])
+        restore_filename = os.path.join(testpath, 'restore')
+        benji_obj.restore(version_uid, 'file:' + restore_filename, sparse=False, force=False)
+        benji_obj.close()
+        self.assertTrue(self.same(image_filename, restore_filename))
+
+    def test_backup_simultaneous_hashes(self):
+        testpath = self.testpath.path
+        image_filename = os.path.join(testpath, 'image')
+        distinct_blocks = [self.random_bytes(4 * kB) for _ in range(48)]
+        self.patch(image_filename, 0,
+                   b''.join(distinct_blocks) + b'\0' * 16 * 4 * kB + b''.join(distinct_blocks[:8]) +
+                   self.random_bytes(3 * kB))
+        image_size = os.path.getsize(image_filename)
+
+        benji_obj = self.benji_open(init_database=True)
+        reference_version_uid = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                                 volume='data-backup',
+                                                 snapshot='snapshot-name',
+                                                 source='file:' + image_filename,
+                                                 block_size=4 * kB).uid
+        benji_obj.close()
+
+        self.config = Config(ad_hoc_config=textwrap.dedent(self.CONFIG).format(testpath=testpath) +
+                             'simultaneousHashes: 4\n')
+        benji_obj = self.benji_open()
+        version = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                   volume='data-backup',
+                                   snapshot='snapshot-name',
+                                   source='file:' + image_filename,
+                                   block_size=4 * kB)
+        self.assertEqual(VersionStatus.valid, version.status)
+        self.assertEqual(image_size, version.bytes_read)
+        self.assertEqual(16 * 4 * kB, version.bytes_sparse)
+        # All blocks are already present in the storage
+        self.assertEqual(0, version.bytes_written)
+        self.assertEqual(image_size - 16 * 4 * kB, version.bytes_deduplicated)
+        # Identical blocks in flight during the first backup may have been stored separately, so the UIDs can differ
+        self.assertEqual([(block.idx, bool(block.uid), block.checksum, block.size, block.valid)
+                          for block in Version.get_by_uid(reference_version_uid).blocks],
+                         [(block.idx, bool(block.uid), block.checksum, block.size, block.valid)
+                          for block in version.blocks])
+        self.assertEqual(list(range(48, 64)), [block.idx for block in version.blocks if not block.uid])
+        benji_obj.close()
+
+    def test_resume(self):
+        testpath = self.testpath.path
+        image_filename = os.path.join(testpath, 'image')
+        self.patch(image_filename, 0, self.random_bytes(64 * 4 * kB) + b'\0' * 16 * 4 * kB + self.random_bytes(3 * kB))
+        version_uid = VersionUid(str(uuid.uuid4()))
+
+        benji_obj = self.benji_open(init_database=True)
+        storage = StorageFactory.get_by_name('s1')
+        write_block_async = storage.write_block_async
+        writes = 0
+
+        def failing_write_block_async(*args, **kwargs):
+            nonlocal writes
+            writes += 1
+            if writes > 32:
+                raise OSError('Simulated failure.')
+            return write_block_async(*args, **kwargs)
+
+        storage.write_block_async = failing_write_block_async
+        try:
+            self.assertRaises(OSError,
+                              lambda: benji_obj.backup(version_uid=version_uid,
+                                                       volume='data-backup',
+                                                       snapshot='snapshot-name',
+                                                       source='file:' + image_filename,
+                                                       block_size=4 * kB))
+        finally:
+            del storage.write_block_async
+        self.assertEqual(VersionStatus.incomplete, Version.get_by_uid(version_uid).status)
+        resume_idx = Version.get_by_uid(version_uid).resume_idx
+        self.assertIsNotNone(resume_idx)
+        self.assertLess(resume_idx, 81)
+        benji_obj.close()
+
+        benji_obj = self.benji_open()
+        self.assertRaises(
+            UsageError, lambda: benji_obj.backup(version_uid=version_uid,
+                                                 volume='data-backup',
+                                                 snapshot='other-snapshot-name',
+                                                 source='file:' + image_filename,
+                                                 resume=True))
+        version = benji_obj.backup(version_uid=version_uid,
+                                   volume='data-backup',
+                                   snapshot='snapshot-name',
+                                   source='file:' + image_filename,
+                                   resume=True)
+        self.assertEqual(VersionStatus.valid, version.status)
+        self.assertEqual(0, len(version.invalid_blocks_by_idx()))
+        self.assertLess(version.bytes_read, 81 * 4 * kB)
+        benji_obj.close()
+
+        restore_filename = os.path.join(testpath, 'restore')
+        benji_obj = self.benji_open()
+        benji_obj.deep_scrub(version_uid)
+        benji_obj.restore(version_uid, 'file:' + restore_filename, sparse=False, force=False)
+        benji_obj.close()
+        self.assertTrue(self.same(image_filename, restore_filename))
+
+    def test_empty_block_ranges(self):
+        testpath = self.testpath.path
+        image_filename = os.path.join(testpath, 'image')
+        restore_filename = os.path.join(testpath, 'restore')
+
+        # Empty source
+        open(image_filename, 'wb').close()
+        benji_obj = self.benji_open(init_database=True)
+        version = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                   volume='data-backup',
+                                   snapshot='snapshot-name',
+                                   source='file:' + image_filename,
+                                   block_size=4 * kB)
+        self.assertEqual(VersionStatus.valid, version.status)
+        self.assertEqual(0, version.blocks_count)
+        benji_obj.close()
+
+        # Zero-length hints
+        self.patch(image_filename, 0, self.random_bytes(16 * 4 * kB))
+        benji_obj = self.benji_open()
+        base_version = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                        volume='data-backup',
+                                        snapshot='snapshot-name',
+                                        source='file:' + image_filename,
+                                        block_size=4 * kB)
+        self.patch(image_filename, 4 * kB, self.random_bytes(4 * kB))
+        version = benji_obj.backup(version_uid=VersionUid(str(uuid.uuid4())),
+                                   volume='data-backup',
+                                   snapshot='snapshot-name',
+                                   source='file:' + image_filename,
+                                   block_size=4 * kB,
+                                   base_version_uid=base_version.uid,
+                                   hints=[(4 * kB, 4 * kB, True), (8 * kB, 0, True), (12 * kB + 5, 0, False)])
+        self.assertEqual(VersionStatus.valid, version.status)
+        self.assertEqual(0, version.sparse_blocks_count)
+        benji_obj.restore(version.uid, 'file:' + restore_filename, sparse=False, force=False)
+        self.assertTrue(self.same(image_filename, restore_filename))
+
+        # Resuming a backup which has committed all of its blocks but wasn't marked as valid anymore
+        version = Version.get_by_uid(version.uid)
+        version.resume_idx = version.blocks_count
+        version.set(status=VersionStatus.incomplete)
+        version = benji_obj.backup(version_uid=version.uid,
+                                   volume='data-backup',
+                                   snapshot='snapshot-name',
+                                   source='file:' + image_filename,
+                                   resume=True)
+        self.assertEqual(VersionStatus.valid, version.status)
+        benji_obj.close()
+
+    def test_restore_sparse_blocks_to_existing_file(self):
+        testpath = self.testpath.path
+        image_filename = os.path.join(testpath, 'image')
+        self.patch(image_filename, 0,
+                   self.random_bytes(16 * 4 * kB) + b'\0' * 32 * 4 * kB + self.random_bytes(16 * 4 * kB))
+        version_uid = VersionUid(str(uuid.uuid4()))
+
+        benji_obj = self.benji_open(init_database=True)
+        benji_obj.backup(version_uid=version_uid,
+                         volume='data-backup',
+                         snapshot='snapshot-name',
+                         source='file:' + image_filename,
+                         block_size=4 * kB)
+        benji_obj.close()
+
+        # The sparse blocks are zeroed with a single call, either by punching a hole or by writing zeroes
+        restore_filename = os.path.join(testpath, 'restore')
+        self.patch(restore_filename, 0, self.random_bytes(64 * 4 * kB))
+        benji_obj = self.benji_open()
+        write_zeroes = FileIO.write_zeroes
+        write_zeroes_calls = []
+
+        def recording_write_zeroes(io, offset, length):
+            write_zeroes_calls.append((offset, length))
+            return write_zeroes(io, offset, length)
+
+        with patch.object(FileIO, 'write_zeroes', recording_write_zeroes):
+            benji_obj.restore(version_uid, 'file:' + restore_filename, sparse=False, force=True)
+        benji_obj.close()
+        self.assertEqual([(16 * 4 * kB, 32 * 4 * kB)], write_zeroes_calls)
+        self.assertTrue(self.same(image_filename, restore_filename))
+
+    def test_restore_duplicate_blocks(self):
+        testpath = self.testpath.path
+        image_filename = os.path.join(testpath, 'image')
+        distinct_blocks = [self.random_bytes(4 * kB) for _ in range(3)]
+        self.patch(image_filename, 0, b''.join(distinct_blocks * 16) + b'\0' * 16 * 4 * kB + distinct_blocks[0])
+        version_uid = VersionUid(str(uuid.uuid4()))
+
+        benji_obj = self.benji_open(init_database=True)
+        benji_obj.backup(version_uid=version_uid,
+                         volume='data-backup',
+                         snapshot='snapshot-name',
+                         source='file:' + image_filename,
+                         block_size=4 * kB)
+        # Identical blocks in flight during the backup may still have been stored separately
+        block_uids = {block.uid for block in Version.get_by_uid(version_uid).dereferenced_blocks if block.uid}
+        self.assertLess(len(block_uids), 49)
+        benji_obj.close()
+
+        restore_filename = os.path.join(testpath, 'restore')
+        self.patch(restore_filename, 0, self.random_bytes(65 * 4 * kB))
+        benji_obj = self.benji_open()
+        storage = StorageFactory.get_by_name('s1')
+        read_block_async = storage.read_block_async
+        reads = 0
+
+        def counting_read_block_async(*args, **kwargs):
+            nonlocal reads
+            reads += 1
+            return read_block_async(*args, **kwargs)
+
+        storage.read_block_async = counting_read_block_async
+        try:
+            benji_obj.restore(version_uid, 'file:' + restore_filename, sparse=False, force=True)
+        finally:
+            del storage.read_block_async
+        benji_obj.close()
+        self.assertEqual(len(block_uids), reads)
+        self.assertTrue(self.same(image_filename, restore_filename))
+
+        # All blocks referencing a missing object are reported and invalidated
+        blocks = [block for block in Version.get_by_uid(version_uid).dereferenced_blocks if block.uid]
+        missing_uid = max(block_uids, key=lambda uid: sum(1 for block in blocks if block.uid == uid))
+        missing_idxs = {block.idx for block in blocks if block.uid == missing_uid}
+        self.assertGreater(len(missing_idxs), 1)
+        benji_obj = self.benji_open()
+        StorageFactory.get_by_name('s1').rm_block(missing_uid)
+        self.assertRaises(
+            InputDataError,
+            lambda: benji_obj.restore(version_uid, 'file:' + restore_filename, sparse=False, force=True))
+        self.assertEqual(sorted(missing_idxs), Version.get_by_uid(version_uid).invalid_blocks_by_idx())
+        benji_obj.close()
+
 
 class SmokeTestCaseSQLLite_File(SmokeTestCase, TestCase):
 
@@ -254,6 +548,8 @@ class SmokeTestCaseSQLLite_File(SmokeTestCase, TestCase):
             logFile: /dev/stderr
             hashFunction: BLAKE2b,digest_bits=256
             blockSize: 4096
+            metadataBackup:
+              deltaChainLength: 5
             ios:
             - name: file
               module: file
@@ -282,6 +578,8 @@ class SmokeTestCaseSQLLite_File(SmokeTestCase, TestCase):
                 consistencyCheckWrites: True
                 simultaneousWrites: 5
                 simultaneousReads: 5
+                packing:
+                  packSize: 16384
                 activeTransforms:
                   - zstd
                   - k1
@@ -313,6 +611,11 @@ class SmokeTestCaseSQLLite_File_storageId(SmokeTestCase, TestCase):
             logFile: /dev/stderr
             hashFunction: BLAKE2b,digest_bits=256
             blockSize: 4096
+            metadataBackup:
+              format: binary
+              compression: zstd
+              deltaChainLength: 3
+              simultaneousWrites: 3
             ios:
             - name: file
               module: file